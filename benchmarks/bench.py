@@ -0,0 +1,279 @@
+"""
+Benchmarks for the UserVisitMiddleware hot path and management commands.
+
+Runs against a throwaway database (SQLite by default, or PostgreSQL if
+BENCH_DATABASE=postgres - see `database_settings`) and prints the results
+as JSON. Compare against a saved baseline to catch regressions:
+
+    python -m benchmarks.bench --output baseline.json
+    python -m benchmarks.bench --compare baseline.json
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List
+from unittest import mock
+
+import django
+from django.conf import settings
+
+UA_STRING = (
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+)
+
+Result = Dict[str, Any]
+
+
+def database_settings() -> Dict[str, Any]:
+    if os.getenv("BENCH_DATABASE", "sqlite") == "postgres":
+        return {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.getenv("PGDATABASE", "user_visit_bench"),
+            "USER": os.getenv("PGUSER", "postgres"),
+            "PASSWORD": os.getenv("PGPASSWORD", ""),
+            "HOST": os.getenv("PGHOST", "localhost"),
+            "PORT": os.getenv("PGPORT", "5432"),
+        }
+    return {"ENGINE": "django.db.backends.sqlite3", "NAME": "user_visit_bench.db"}
+
+
+def setup() -> None:
+    settings.configure(
+        DEBUG=False,
+        USE_TZ=True,
+        SECRET_KEY="bench",  # noqa: S106
+        DATABASES={"default": database_settings()},
+        INSTALLED_APPS=[
+            "django.contrib.auth",
+            "django.contrib.contenttypes",
+            "django.contrib.sessions",
+            "user_visit",
+        ],
+    )
+    django.setup()
+
+
+def time_calls(func: Callable[[int], Any], iterations: int) -> Result:
+    """Call func(i) iterations times, returning latency stats in microseconds."""
+    timings: List[float] = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(i)
+        timings.append((time.perf_counter() - start) * 1_000_000)
+    timings.sort()
+    return {
+        "iterations": iterations,
+        "mean_us": round(statistics.mean(timings), 2),
+        "median_us": round(statistics.median(timings), 2),
+        "p95_us": round(timings[int(len(timings) * 0.95) - 1], 2),
+    }
+
+
+def count_queries(func: Callable[[int], Any], offset: int, samples: int = 50) -> float:
+    """Return the mean number of queries per call to func."""
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as ctx:
+        for i in range(offset, offset + samples):
+            func(i)
+    return len(ctx.captured_queries) / samples
+
+
+def bench(func: Callable[[int], Any], iterations: int) -> Result:
+    result = time_calls(func, iterations)
+    # run the query count on fresh inputs so that e.g. new visits stay new
+    result["queries_per_call"] = count_queries(func, offset=iterations)
+    return result
+
+
+def bench_middleware(iterations: int) -> Dict[str, Result]:
+    from django.contrib.auth.models import AnonymousUser, User
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+
+    from user_visit.dedup import SeenHashCache
+    from user_visit.middleware import UserVisitMiddleware
+
+    user = User.objects.create(username="bench")
+    factory = RequestFactory(HTTP_USER_AGENT=UA_STRING)
+
+    def make_request(session_key: str, request_user: Any = user) -> Any:
+        request = factory.get("/")
+        request.user = request_user
+        request.session = SimpleNamespace(session_key=session_key)
+        return request
+
+    middleware = UserVisitMiddleware(lambda r: HttpResponse())
+    anonymous = make_request("anon", AnonymousUser())
+    duplicate = make_request("duplicate")
+    middleware(duplicate)
+
+    results = {
+        "middleware_anonymous": bench(lambda i: middleware(anonymous), iterations),
+        "middleware_duplicate_seen": bench(lambda i: middleware(duplicate), iterations),
+        "middleware_new_visit": bench(
+            lambda i: middleware(make_request(f"new-{i}")), iterations
+        ),
+    }
+    with mock.patch("user_visit.middleware.RECORDING_BYPASS", lambda r: True):
+        results["middleware_bypass"] = bench(
+            lambda i: middleware(duplicate), iterations
+        )
+    # seen cache disabled - every duplicate goes to the database
+    middleware.seen_cache = SeenHashCache(0)
+    results["middleware_duplicate_db"] = bench(
+        lambda i: middleware(duplicate), iterations
+    )
+    return results
+
+
+def bench_models(iterations: int) -> Dict[str, Result]:
+    from django.contrib.auth.models import User
+    from django.test import RequestFactory
+    from django.utils import timezone
+
+    from user_visit.models import UserVisit
+
+    request = RequestFactory(HTTP_USER_AGENT=UA_STRING).get("/")
+    request.user = User.objects.get(username="bench")
+    request.session = SimpleNamespace(session_key="build")
+    timestamp = timezone.now()
+    uv = UserVisit.objects.build(request, timestamp)
+    return {
+        "manager_build": bench(
+            lambda i: UserVisit.objects.build(request, timestamp), iterations
+        ),
+        "uservisit_md5": bench(lambda i: uv.md5(), iterations),
+    }
+
+
+def bench_backfill(rows: int, batch_size: int) -> Dict[str, Result]:
+    from io import StringIO
+
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from django.utils import timezone
+
+    from user_visit.models import UserVisit
+
+    user = User.objects.get(username="bench")
+    timestamp = timezone.now() - datetime.timedelta(days=1)
+    UserVisit.objects.bulk_create(
+        (
+            UserVisit(
+                user=user,
+                timestamp=timestamp,
+                visit_date=timestamp.date(),
+                session_key=str(i),
+                ua_string=f"{UA_STRING} {i % 100}",
+                hash=f"backfill-{i}",
+            )
+            for i in range(rows)
+        ),
+        batch_size=batch_size,
+    )
+    start = time.perf_counter()
+    call_command(
+        "update_user_visit_user_agent_data",
+        batch_size=batch_size,
+        stdout=StringIO(),
+    )
+    elapsed = time.perf_counter() - start
+    return {
+        "backfill_user_agent_data": {
+            "rows": rows,
+            "seconds": round(elapsed, 3),
+            "rows_per_second": round(rows / elapsed),
+        }
+    }
+
+
+def compare(results: Dict[str, Result], baseline_path: str, tolerance: float) -> int:
+    """Print regressions against a baseline, returning the number found."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    regressions = 0
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        checks = [
+            ("mean_us", 1 + tolerance),
+            ("queries_per_call", 1),
+            ("seconds", 1 + tolerance),
+        ]
+        for key, limit in checks:
+            if key in result and key in base and result[key] > base[key] * limit:
+                regressions += 1
+                print(  # noqa: T201
+                    f"REGRESSION {name}.{key}: {base[key]} -> {result[key]}",
+                    file=sys.stderr,
+                )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=10_000, help="backfill rows")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--output", help="write results to file (default stdout)")
+    parser.add_argument("--compare", help="baseline results file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed slowdown against the baseline (default 0.2 = 20%%)",
+    )
+    args = parser.parse_args()
+
+    setup()
+    from django.db import connection
+
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        results: Dict[str, Result] = {}
+        results.update(bench_middleware(args.iterations))
+        results.update(bench_models(args.iterations))
+        if args.rows:
+            results.update(bench_backfill(args.rows, args.batch_size))
+        vendor = connection.vendor
+    finally:
+        connection.creation.destroy_test_db(
+            settings.DATABASES["default"]["NAME"], verbosity=0
+        )
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": vendor,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)  # noqa: T201
+    if args.compare:
+        return 1 if compare(results, args.compare, args.tolerance) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
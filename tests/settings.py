@@ -1,4 +1,4 @@
-from os import path
+from os import getenv, path
 
 import django
 
@@ -9,6 +9,20 @@ USE_L10N = True
 
 DATABASES = {"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": "test.db"}}
 
+# run the tests (including the PostgreSQL-only partitioning tests) against
+# PostgreSQL, with connection details from the standard PG* variables
+if getenv("TEST_DATABASE", "sqlite") == "postgres":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": getenv("PGDATABASE", "user_visit"),
+            "USER": getenv("PGUSER", "postgres"),
+            "PASSWORD": getenv("PGPASSWORD", ""),
+            "HOST": getenv("PGHOST", "localhost"),
+            "PORT": getenv("PGPORT", "5432"),
+        }
+    }
+
 INSTALLED_APPS = (
     "django.contrib.admin",
     "django.contrib.auth",
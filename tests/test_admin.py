@@ -0,0 +1,125 @@
+import csv
+import io
+from typing import Any, List
+from unittest import mock
+
+import pytest
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from user_visit.admin import (
+    EstimatedCountPaginator,
+    ScalableUserVisitAdmin,
+    UserVisitAdmin,
+)
+from user_visit.models import UserVisit, get_user_agent
+
+
+@pytest.fixture
+def visits() -> List[UserVisit]:
+    return [
+        UserVisit.objects.create(
+            user=User.objects.create(username=f"user{i}"),
+            session_key=str(i),
+            ua_string="Chrome",
+            browser="Chrome",
+            timestamp=timezone.now(),
+        )
+        for i in range(5)
+    ]
+
+
+def changelist(model_admin: type, **params: str) -> Any:
+    request = RequestFactory().get("/", params)
+    request.user = User(is_superuser=True, is_staff=True)
+    return model_admin(UserVisit, admin.site).get_changelist_instance(request)
+
+
+@pytest.mark.django_db
+def test_admin_export_action(visits: List[UserVisit], admin_client: Any) -> None:
+    response = admin_client.post(
+        "/admin/user_visit/uservisit/",
+        {"action": "export_csv", "_selected_action": [v.pk for v in visits[:2]]},
+    )
+    assert response.status_code == 200
+    assert response["Content-Type"] == "text/csv"
+    content = b"".join(response.streaming_content).decode()
+    assert len(list(csv.DictReader(io.StringIO(content)))) == 2
+
+
+@pytest.mark.django_db
+def test_changelist__select_related(visits: List[UserVisit]) -> None:
+    cl = changelist(UserVisitAdmin)
+    with CaptureQueriesContext(connection) as ctx:
+        users = [uv.user.username for uv in cl.result_list]
+    assert len(users) == 5
+    assert len(ctx.captured_queries) == 1
+
+
+@pytest.mark.django_db
+def test_changelist__user_agent(visits: List[UserVisit]) -> None:
+    get_user_agent.cache_clear()
+    visits[0].link_user_agent()
+    visits[0].browser = ""
+    visits[0].save()
+    model_admin = UserVisitAdmin(UserVisit, admin.site)
+    cl = changelist(UserVisitAdmin)
+    with CaptureQueriesContext(connection) as ctx:
+        browsers = {model_admin.browser_name(uv) for uv in cl.result_list}
+    assert browsers == {"Chrome", "Other"}
+    assert len(ctx.captured_queries) == 1
+
+
+@pytest.mark.django_db
+class TestEstimatedCountPaginator:
+    def test_count__no_estimate(self, visits: List[UserVisit]) -> None:
+        paginator = EstimatedCountPaginator(UserVisit.objects.order_by("pk"), 2)
+        assert paginator.count == 5
+
+    @mock.patch("user_visit.admin.estimated_count", lambda qs: 1_000_000)
+    def test_count__estimate(self, visits: List[UserVisit]) -> None:
+        paginator = EstimatedCountPaginator(UserVisit.objects.order_by("pk"), 2)
+        assert paginator.count == 1_000_000
+
+    @mock.patch("user_visit.admin.estimated_count", lambda qs: 10)
+    def test_count__small_table(self, visits: List[UserVisit]) -> None:
+        paginator = EstimatedCountPaginator(UserVisit.objects.order_by("pk"), 2)
+        assert paginator.count == 5
+
+    @mock.patch("user_visit.admin.estimated_count", lambda qs: 1_000_000)
+    def test_count__filtered(self, visits: List[UserVisit]) -> None:
+        queryset = UserVisit.objects.filter(session_key="1").order_by("pk")
+        assert EstimatedCountPaginator(queryset, 2).count == 1
+
+
+@pytest.mark.django_db
+class TestScalableUserVisitAdmin:
+    @mock.patch("user_visit.admin.estimated_count", lambda qs: 1_000_000)
+    def test_changelist(self, visits: List[UserVisit]) -> None:
+        cl = changelist(ScalableUserVisitAdmin)
+        assert cl.result_count == 1_000_000
+        assert cl.full_result_count is None
+        assert len(cl.result_list) == 5
+
+    def test_search__exact(self, visits: List[UserVisit]) -> None:
+        cl = changelist(ScalableUserVisitAdmin, q="3")
+        assert [uv.session_key for uv in cl.result_list] == ["3"]
+
+    def test_search__prefix(self, visits: List[UserVisit]) -> None:
+        assert len(changelist(ScalableUserVisitAdmin, q="user").result_list) == 5
+        # no substring matches
+        assert len(changelist(ScalableUserVisitAdmin, q="ser").result_list) == 0
+
+    def test_date_hierarchy(self, visits: List[UserVisit]) -> None:
+        today = timezone.now().date()
+        cl = changelist(
+            ScalableUserVisitAdmin,
+            visit_date__year=str(today.year),
+            visit_date__month=str(today.month),
+            visit_date__day=str(today.day),
+        )
+        assert len(cl.result_list) == 5
@@ -0,0 +1,56 @@
+import pathlib
+from unittest import mock
+
+import pytest
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from user_visit.bulk import RateLimiter, keyset_ranges, load_checkpoint, save_checkpoint
+from user_visit.models import UserVisit
+
+
+@pytest.mark.django_db
+def test_keyset_ranges() -> None:
+    user = User.objects.create(username="Bob")
+    pks = [
+        UserVisit.objects.create(
+            user=user, session_key=str(i), timestamp=timezone.now()
+        ).pk
+        for i in range(5)
+    ]
+    visits = UserVisit.objects.all()
+    assert list(keyset_ranges(visits, 2)) == [
+        (None, pks[1]),
+        (pks[1], pks[3]),
+        (pks[3], pks[4]),
+    ]
+    assert list(keyset_ranges(visits, 2, after_pk=pks[0], until_pk=pks[2])) == [
+        (pks[0], pks[2])
+    ]
+    assert list(keyset_ranges(visits.none(), 2)) == []
+
+
+@mock.patch("user_visit.bulk.time")
+def test_rate_limiter(mock_time: mock.Mock) -> None:
+    mock_time.monotonic.return_value = 0
+    limiter = RateLimiter(max_per_second=10)
+    mock_time.monotonic.return_value = 1
+    limiter.throttle(5)
+    assert mock_time.sleep.call_count == 0
+    limiter.throttle(15)
+    mock_time.sleep.assert_called_once_with(1)
+
+
+@mock.patch("user_visit.bulk.time")
+def test_rate_limiter__disabled(mock_time: mock.Mock) -> None:
+    limiter = RateLimiter(max_per_second=None)
+    limiter.throttle(1000)
+    assert mock_time.sleep.call_count == 0
+
+
+def test_checkpoint(tmp_path: pathlib.Path) -> None:
+    path = str(tmp_path / "checkpoint.json")
+    assert load_checkpoint(path) == {}
+    save_checkpoint(path, {"last_pk": 1})
+    save_checkpoint(path, {"last_pk": 2})
+    assert load_checkpoint(path) == {"last_pk": 2}
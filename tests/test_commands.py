@@ -0,0 +1,522 @@
+import csv
+import gzip
+import io
+import json
+import pathlib
+from concurrent.futures import Executor, Future
+from io import StringIO
+from typing import Any, Callable, List
+from unittest import mock
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.utils import timezone
+from freezegun import freeze_time
+
+from user_visit.models import (
+    UserAgent,
+    UserVisit,
+    UserVisitDailySummary,
+    get_user_agent,
+    user_agent_data,
+)
+from user_visit.signals import suspicious_activity
+
+UA_STRING = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.116 Safari/537.36"
+
+
+def create_visit(user: User, session_key: str, **kwargs: str) -> UserVisit:
+    return UserVisit.objects.create(
+        user=user,
+        session_key=session_key,
+        remote_addr="127.0.0.1",
+        timestamp=timezone.now(),
+        **kwargs,
+    )
+
+
+class InlineExecutor(Executor):
+    """Stand-in for ProcessPoolExecutor that runs tasks in-process."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def submit(self, fn: Callable, /, *args: Any, **kwargs: Any) -> Future:
+        future: Future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+@pytest.mark.django_db
+class TestUpdateUserAgentData:
+    def test_backfill(self) -> None:
+        user = User.objects.create(username="Bob")
+        blank = create_visit(user, "blank", ua_string=UA_STRING)
+        done = create_visit(
+            user, "done", ua_string=UA_STRING, browser="x", device="y", os="z"
+        )
+        out = StringIO()
+        call_command("update_user_visit_user_agent_data", stdout=out)
+        blank.refresh_from_db()
+        done.refresh_from_db()
+        assert (blank.browser, blank.device, blank.os) == user_agent_data(UA_STRING)
+        assert (done.browser, done.device, done.os) == ("x", "y", "z")
+        assert "Updated 1 UserVisit objects." in out.getvalue()
+
+    def test_link(self) -> None:
+        get_user_agent.cache_clear()
+        user = User.objects.create(username="Bob")
+        visits = [
+            create_visit(user, f"session-{i}", ua_string=UA_STRING, browser="x")
+            for i in range(3)
+        ]
+        create_visit(user, "other", ua_string="Chrome")
+        out = StringIO()
+        call_command(
+            "update_user_visit_user_agent_data", link=True, batch_size=2, stdout=out
+        )
+        assert "Updated 4 UserVisit objects." in out.getvalue()
+        assert UserAgent.objects.count() == 2
+        visit = UserVisit.objects.select_related("agent").get(pk=visits[0].pk)
+        assert visit.browser == ""
+        assert visit.get_user_agent_data() == user_agent_data(UA_STRING)
+        # only unlinked visits are updated
+        out = StringIO()
+        call_command("update_user_visit_user_agent_data", link=True, stdout=out)
+        assert "Updated 0 UserVisit objects." in out.getvalue()
+        # and the default backfill does not re-fill the linked visits
+        out = StringIO()
+        call_command("update_user_visit_user_agent_data", stdout=out)
+        assert "Updated 0 UserVisit objects." in out.getvalue()
+        assert UserVisit.objects.get(pk=visits[0].pk).browser == ""
+
+    def test_force(self) -> None:
+        user = User.objects.create(username="Bob")
+        done = create_visit(
+            user, "done", ua_string=UA_STRING, browser="x", device="y", os="z"
+        )
+        call_command("update_user_visit_user_agent_data", force=True, stdout=StringIO())
+        done.refresh_from_db()
+        assert (done.browser, done.device, done.os) == user_agent_data(UA_STRING)
+
+    def test_batches(self) -> None:
+        user = User.objects.create(username="Bob")
+        for i in range(5):
+            create_visit(user, f"session-{i}", ua_string=UA_STRING)
+        with mock.patch.object(
+            UserVisit.objects, "bulk_update", wraps=UserVisit.objects.bulk_update
+        ) as bulk_update:
+            call_command(
+                "update_user_visit_user_agent_data", batch_size=2, stdout=StringIO()
+            )
+        assert bulk_update.call_count == 3
+        assert UserVisit.objects.filter(browser="").count() == 0
+
+    def test_workers(self) -> None:
+        user = User.objects.create(username="Bob")
+        for i in range(5):
+            create_visit(user, f"session-{i}", ua_string=UA_STRING)
+        out = StringIO()
+        with mock.patch(
+            "user_visit.management.commands.update_user_visit_user_agent_data.ProcessPoolExecutor",
+            InlineExecutor,
+        ):
+            call_command(
+                "update_user_visit_user_agent_data",
+                batch_size=2,
+                workers=2,
+                stdout=out,
+            )
+        assert "Updated 5 UserVisit objects." in out.getvalue()
+        assert UserVisit.objects.filter(browser="").count() == 0
+
+    def test_no_visits(self) -> None:
+        out = StringIO()
+        call_command("update_user_visit_user_agent_data", stdout=out)
+        assert "Updated 0 UserVisit objects." in out.getvalue()
+
+    def test_invalid_batch_size(self) -> None:
+        with pytest.raises(CommandError):
+            call_command("update_user_visit_user_agent_data", batch_size=0)
+
+    def test_pk_bounds(self) -> None:
+        user = User.objects.create(username="Bob")
+        visits = [
+            create_visit(user, f"session-{i}", ua_string=UA_STRING) for i in range(5)
+        ]
+        call_command(
+            "update_user_visit_user_agent_data",
+            since_pk=visits[1].pk,
+            until_pk=visits[3].pk,
+            stdout=StringIO(),
+        )
+        updated = [v.pk for v in UserVisit.objects.exclude(browser="").order_by("pk")]
+        assert updated == [v.pk for v in visits[1:4]]
+
+    def test_checkpoint(self, tmp_path: pathlib.Path) -> None:
+        user = User.objects.create(username="Bob")
+        visits = [
+            create_visit(user, f"session-{i}", ua_string=UA_STRING) for i in range(5)
+        ]
+        checkpoint = str(tmp_path / "checkpoint.json")
+        call_command(
+            "update_user_visit_user_agent_data",
+            batch_size=2,
+            until_pk=visits[2].pk,
+            checkpoint_file=checkpoint,
+            stdout=StringIO(),
+        )
+        with open(checkpoint) as f:
+            assert json.load(f) == {"last_pk": visits[2].pk}
+        # reset the first visit - it should not be revisited on resume
+        UserVisit.objects.filter(pk=visits[0].pk).update(browser="")
+        out = StringIO()
+        call_command(
+            "update_user_visit_user_agent_data",
+            checkpoint_file=checkpoint,
+            resume=True,
+            stdout=out,
+        )
+        assert "Updated 2 UserVisit objects." in out.getvalue()
+        assert list(
+            UserVisit.objects.filter(browser="").values_list("pk", flat=True)
+        ) == [visits[0].pk]
+        with open(checkpoint) as f:
+            assert json.load(f) == {"last_pk": visits[4].pk}
+
+    def test_resume__no_checkpoint_file(self) -> None:
+        with pytest.raises(CommandError):
+            call_command("update_user_visit_user_agent_data", resume=True)
+
+    @mock.patch("user_visit.bulk.time.sleep")
+    def test_max_rows_per_second(self, mock_sleep: mock.Mock) -> None:
+        user = User.objects.create(username="Bob")
+        for i in range(4):
+            create_visit(user, f"session-{i}", ua_string=UA_STRING)
+        call_command(
+            "update_user_visit_user_agent_data",
+            batch_size=2,
+            max_rows_per_second=1,
+            stdout=StringIO(),
+        )
+        assert mock_sleep.call_count == 2
+
+
+@pytest.mark.django_db
+class TestUpdateUserVisitSummary:
+    def test_summary(self) -> None:
+        user = User.objects.create(username="Bob")
+        with freeze_time("2020-07-04"):
+            create_visit(user, "1", ua_string=UA_STRING)
+        with freeze_time("2020-07-06"):
+            create_visit(user, "2", ua_string=UA_STRING)
+            call_command("update_user_visit_summary", stdout=StringIO())
+        dates = UserVisitDailySummary.objects.filter(dimension="all").values_list(
+            "date", flat=True
+        )
+        assert [str(d) for d in dates.order_by("date")] == ["2020-07-04", "2020-07-06"]
+
+    def test_watermark(self) -> None:
+        user = User.objects.create(username="Bob")
+        with freeze_time("2020-07-04"):
+            create_visit(user, "1", ua_string=UA_STRING)
+            call_command("update_user_visit_summary", stdout=StringIO())
+            # a later visit on the same day is picked up by the next run
+            create_visit(user, "2", ua_string=UA_STRING)
+        with freeze_time("2020-07-05"):
+            out = StringIO()
+            call_command("update_user_visit_summary", stdout=out)
+        assert out.getvalue().splitlines() == [
+            "Summarised 2020-07-04 (4 rows)",
+            "Summarised 2020-07-05 (0 rows)",
+        ]
+        assert UserVisitDailySummary.objects.get(dimension="all").visit_count == 2
+
+    def test_watermark__summary_on_write(self) -> None:
+        """Check that history before the on-write rows is summarised."""
+        user = User.objects.create(username="Bob")
+        for day in ("2020-07-01", "2020-07-02"):
+            with freeze_time(day):
+                create_visit(user, day, ua_string=UA_STRING)
+        with freeze_time("2020-07-04"):
+            UserVisitDailySummary.objects.increment(
+                create_visit(user, "3", ua_string=UA_STRING)
+            )
+            out = StringIO()
+            call_command("update_user_visit_summary", stdout=out)
+        assert out.getvalue().splitlines()[0] == "Summarised 2020-07-01 (4 rows)"
+        dates = UserVisitDailySummary.objects.filter(dimension="all").values_list(
+            "date", flat=True
+        )
+        assert [str(d) for d in dates.order_by("date")] == [
+            "2020-07-01",
+            "2020-07-02",
+            "2020-07-04",
+        ]
+
+    def test_since_until(self) -> None:
+        user = User.objects.create(username="Bob")
+        for day in ("2020-07-04", "2020-07-05", "2020-07-06"):
+            with freeze_time(day):
+                create_visit(user, day, ua_string=UA_STRING)
+        out = StringIO()
+        call_command(
+            "update_user_visit_summary",
+            "--since=2020-07-05",
+            "--until=2020-07-05",
+            stdout=out,
+        )
+        assert out.getvalue().splitlines() == ["Summarised 2020-07-05 (4 rows)"]
+
+    def test_no_visits(self) -> None:
+        out = StringIO()
+        call_command("update_user_visit_summary", stdout=out)
+        assert "No visits to summarise." in out.getvalue()
+
+    def test_invalid_date(self) -> None:
+        with pytest.raises(CommandError):
+            call_command("update_user_visit_summary", "--since", "yesterday")
+
+
+@pytest.mark.django_db
+class TestPruneUserVisits:
+    def create_visits(self) -> None:
+        user = User.objects.create(username="Bob")
+        for day in ("2020-07-01", "2020-07-02", "2020-07-03", "2020-07-10"):
+            with freeze_time(day):
+                create_visit(user, day, ua_string=UA_STRING)
+
+    @freeze_time("2020-07-11")
+    def test_prune(self) -> None:
+        self.create_visits()
+        out = StringIO()
+        with mock.patch(
+            "user_visit.management.commands.prune_user_visits.time.sleep"
+        ) as sleep:
+            call_command(
+                "prune_user_visits", days=7, batch_size=2, sleep=0.1, stdout=out
+            )
+        assert sleep.call_count == 2
+        assert "Deleted 3 UserVisit objects" in out.getvalue()
+        assert list(UserVisit.objects.values_list("session_key", flat=True)) == [
+            "2020-07-10"
+        ]
+
+    @freeze_time("2020-07-11")
+    def test_dry_run(self) -> None:
+        self.create_visits()
+        out = StringIO()
+        call_command("prune_user_visits", days=7, dry_run=True, stdout=out)
+        assert "Would delete 3 UserVisit objects" in out.getvalue()
+        assert UserVisit.objects.count() == 4
+
+    @freeze_time("2020-07-11")
+    @mock.patch("user_visit.management.commands.prune_user_visits.RETENTION_DAYS", 7)
+    def test_retention_days_setting(self) -> None:
+        self.create_visits()
+        # the --days default is bound when the parser is created
+        call_command("prune_user_visits", stdout=StringIO())
+        assert UserVisit.objects.count() == 1
+
+    def test_no_days(self) -> None:
+        with pytest.raises(CommandError):
+            call_command("prune_user_visits")
+
+    @freeze_time("2020-07-11")
+    @pytest.mark.parametrize("filename", ["archive.jsonl.gz", "archive.jsonl"])
+    def test_archive__jsonl(self, tmp_path: pathlib.Path, filename: str) -> None:
+        self.create_visits()
+        path = tmp_path / filename
+        call_command(
+            "prune_user_visits",
+            days=7,
+            batch_size=2,
+            archive=str(path),
+            stdout=StringIO(),
+        )
+        opener = gzip.open if filename.endswith(".gz") else open
+        with opener(path, "rt") as f:
+            rows = [json.loads(line) for line in f]
+        assert [r["session_key"] for r in rows] == [
+            "2020-07-01",
+            "2020-07-02",
+            "2020-07-03",
+        ]
+        assert rows[0]["ua_string"] == UA_STRING
+
+    @freeze_time("2020-07-11")
+    def test_archive__csv(self, tmp_path: pathlib.Path) -> None:
+        self.create_visits()
+        path = tmp_path / "archive.csv.gz"
+        call_command("prune_user_visits", days=7, archive=str(path), stdout=StringIO())
+        with gzip.open(path, "rt") as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 3
+        assert rows[0]["context"] == "{}"
+
+    @freeze_time("2020-07-11")
+    @mock.patch("user_visit.export.USER_AGENT_TABLE", True)
+    def test_archive__user_agent_table(self, tmp_path: pathlib.Path) -> None:
+        get_user_agent.cache_clear()
+        self.create_visits()
+        call_command("update_user_visit_user_agent_data", link=True, stdout=StringIO())
+        path = tmp_path / "archive.jsonl"
+        call_command("prune_user_visits", days=7, archive=str(path), stdout=StringIO())
+        with open(path) as f:
+            rows = [json.loads(line) for line in f]
+        assert len(rows) == 3
+        assert (rows[0]["browser"], rows[0]["device"], rows[0]["os"]) == (
+            user_agent_data(UA_STRING)
+        )
+
+    def test_archive__invalid_format(self) -> None:
+        with pytest.raises(CommandError):
+            call_command("prune_user_visits", days=7, archive="visits.xml")
+
+    @freeze_time("2020-07-11")
+    def test_archive__exists(self, tmp_path: pathlib.Path) -> None:
+        self.create_visits()
+        path = tmp_path / "archive.jsonl"
+        path.write_text("archived\n")
+        with pytest.raises(CommandError):
+            call_command("prune_user_visits", days=7, archive=str(path))
+        assert path.read_text() == "archived\n"
+        assert UserVisit.objects.count() == 4
+
+    @freeze_time("2020-07-11")
+    def test_archive__fsync(self, tmp_path: pathlib.Path) -> None:
+        """Check each batch is synced to disk before it is deleted."""
+        self.create_visits()
+        path = tmp_path / "archive.jsonl.gz"
+        counts = []
+        with mock.patch(
+            "user_visit.management.commands.prune_user_visits.os.fsync",
+            side_effect=lambda fd: counts.append(UserVisit.objects.count()),
+        ):
+            call_command(
+                "prune_user_visits",
+                days=7,
+                batch_size=2,
+                archive=str(path),
+                stdout=StringIO(),
+            )
+        assert counts == [4, 2]
+
+
+@pytest.mark.django_db
+class TestExportUserVisits:
+    def create_visits(self) -> None:
+        bob = User.objects.create(username="Bob")
+        alice = User.objects.create(username="Alice")
+        for user, day in (
+            (bob, "2020-07-01"),
+            (alice, "2020-07-02"),
+            (bob, "2020-07-03"),
+        ):
+            with freeze_time(day):
+                create_visit(user, day, ua_string=UA_STRING)
+
+    def export(self, path: pathlib.Path, *args: str) -> List[dict]:
+        call_command(
+            "export_user_visits", "--output", str(path), *args, stdout=StringIO()
+        )
+        with gzip.open(path, "rt") if str(path).endswith(".gz") else open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_export__jsonl(self, tmp_path: pathlib.Path) -> None:
+        self.create_visits()
+        rows = self.export(tmp_path / "visits.jsonl.gz")
+        assert [r["session_key"] for r in rows] == [
+            "2020-07-01",
+            "2020-07-02",
+            "2020-07-03",
+        ]
+
+    def test_export__filters(self, tmp_path: pathlib.Path) -> None:
+        self.create_visits()
+        path = tmp_path / "visits.jsonl"
+        rows = self.export(path, "--since", "2020-07-02")
+        assert [r["session_key"] for r in rows] == ["2020-07-02", "2020-07-03"]
+        rows = self.export(path, "--until", "2020-07-02", "--user", "Bob")
+        assert [r["session_key"] for r in rows] == ["2020-07-01"]
+        alice = User.objects.get(username="Alice")
+        rows = self.export(path, "--user", str(alice.pk), "--user", "Bob")
+        assert len(rows) == 3
+
+    def test_export__stdout(self, capsysbinary: pytest.CaptureFixture) -> None:
+        self.create_visits()
+        call_command("export_user_visits", "--chunk-size=1")
+        rows = list(csv.DictReader(io.StringIO(capsysbinary.readouterr().out.decode())))
+        assert len(rows) == 3
+
+    def test_export__stdout_gzip(self, capsysbinary: pytest.CaptureFixture) -> None:
+        self.create_visits()
+        call_command("export_user_visits", "--gzip", "--format=jsonl")
+        content = gzip.decompress(capsysbinary.readouterr().out).decode()
+        assert len(content.splitlines()) == 3
+
+    def test_export__parquet(self, tmp_path: pathlib.Path) -> None:
+        pq = pytest.importorskip("pyarrow.parquet")
+        self.create_visits()
+        path = tmp_path / "visits.parquet"
+        call_command("export_user_visits", "--output", str(path), stdout=StringIO())
+        assert pq.read_table(path).num_rows == 3
+
+    def test_export__parquet_stdout(self) -> None:
+        with pytest.raises(CommandError):
+            call_command("export_user_visits", "--format=parquet")
+
+    def test_export__unknown_extension(self) -> None:
+        with pytest.raises(CommandError):
+            call_command("export_user_visits", "--output=visits.xml")
+
+
+@pytest.mark.django_db
+class TestDetectSuspiciousVisits:
+    def create_visits(self, user: User, *ua_strings: str) -> List[UserVisit]:
+        return [create_visit(user, "session", ua_string=ua) for ua in ua_strings]
+
+    def test_detect(self) -> None:
+        bob = User.objects.create(username="Bob")
+        alice = User.objects.create(username="Alice")
+        self.create_visits(bob, "Chrome", "Firefox", "Safari")
+        self.create_visits(alice, "Chrome", "Firefox")
+        receiver = mock.Mock()
+        suspicious_activity.connect(receiver)
+        out = StringIO()
+        try:
+            call_command(
+                "detect_suspicious_visits",
+                max_combinations=2,
+                batch_size=2,
+                stdout=out,
+            )
+        finally:
+            suspicious_activity.disconnect(receiver)
+        assert receiver.call_count == 1
+        assert receiver.call_args.kwargs["alert"].user_id == bob.pk
+        assert f"combinations: user {bob.pk}" in out.getvalue()
+        assert "Checked 5 visits, 1 alerts." in out.getvalue()
+
+    def test_checkpoint(self, tmp_path: pathlib.Path) -> None:
+        bob = User.objects.create(username="Bob")
+        visits = self.create_visits(bob, "Chrome", "Firefox")
+        checkpoint = str(tmp_path / "checkpoint.json")
+        options = {"max_combinations": 2, "checkpoint_file": checkpoint}
+        call_command("detect_suspicious_visits", stdout=StringIO(), **options)
+        with open(checkpoint) as f:
+            assert json.load(f) == {"last_pk": visits[1].pk}
+        latest = self.create_visits(bob, "Safari")[0]
+        out = StringIO()
+        call_command("detect_suspicious_visits", resume=True, stdout=out, **options)
+        # the earlier visits are replayed into the window, not re-checked
+        assert "Replayed 2 visits" in out.getvalue()
+        assert f"visit {latest.pk}" in out.getvalue()
+        assert "Checked 1 visits, 1 alerts." in out.getvalue()
+        with open(checkpoint) as f:
+            assert json.load(f) == {"last_pk": latest.pk}
+
+    def test_resume__no_checkpoint_file(self) -> None:
+        with pytest.raises(CommandError):
+            call_command("detect_suspicious_visits", resume=True)
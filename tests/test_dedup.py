@@ -0,0 +1,122 @@
+import datetime
+from unittest import mock
+
+import pytest
+from django.core.cache import InvalidCacheBackendError, caches
+from django.utils import timezone
+
+from user_visit.dedup import (
+    RecentCheckCache,
+    SeenHashCache,
+    SharedHashCache,
+    seconds_until_midnight,
+)
+
+TODAY = datetime.date(2020, 7, 4)
+TOMORROW = TODAY + datetime.timedelta(days=1)
+
+
+class TestSeenHashCache:
+    def test_contains(self) -> None:
+        cache = SeenHashCache(maxsize=10)
+        assert not cache.contains(TODAY, "foo")
+        cache.add(TODAY, "foo")
+        assert cache.contains(TODAY, "foo")
+        assert cache.stats() == {"size": 1, "maxsize": 10, "hits": 1, "misses": 1}
+
+    def test_lru_eviction(self) -> None:
+        cache = SeenHashCache(maxsize=2)
+        cache.add(TODAY, "foo")
+        cache.add(TODAY, "bar")
+        # touch foo so that bar becomes the least recently used
+        assert cache.contains(TODAY, "foo")
+        cache.add(TODAY, "baz")
+        assert len(cache) == 2
+        assert cache.contains(TODAY, "foo")
+        assert not cache.contains(TODAY, "bar")
+        assert cache.contains(TODAY, "baz")
+
+    def test_date_rollover(self) -> None:
+        cache = SeenHashCache(maxsize=10)
+        cache.add(TODAY, "foo")
+        assert not cache.contains(TOMORROW, "foo")
+        assert len(cache) == 0
+
+    def test_disabled(self) -> None:
+        cache = SeenHashCache(maxsize=0)
+        cache.add(TODAY, "foo")
+        assert not cache.contains(TODAY, "foo")
+        assert len(cache) == 0
+
+    def test_clear(self) -> None:
+        cache = SeenHashCache(maxsize=10)
+        cache.add(TODAY, "foo")
+        cache.contains(TODAY, "foo")
+        cache.clear()
+        assert cache.stats() == {"size": 0, "maxsize": 10, "hits": 0, "misses": 0}
+
+
+class TestRecentCheckCache:
+    def test_contains(self) -> None:
+        cache = RecentCheckCache(maxsize=10, interval=60)
+        assert not cache.contains(TODAY, (1, "foo"))
+        cache.add(TODAY, (1, "foo"))
+        assert cache.contains(TODAY, (1, "foo"))
+        assert not cache.contains(TODAY, (2, "foo"))
+        assert cache.hits == 1
+
+    def test_interval(self) -> None:
+        cache = RecentCheckCache(maxsize=10, interval=60)
+        with mock.patch("user_visit.dedup.time.monotonic", return_value=1000):
+            cache.add(TODAY, "foo")
+        with mock.patch("user_visit.dedup.time.monotonic", return_value=1060):
+            assert cache.contains(TODAY, "foo")
+        with mock.patch("user_visit.dedup.time.monotonic", return_value=1061):
+            assert not cache.contains(TODAY, "foo")
+
+    def test_date_rollover(self) -> None:
+        cache = RecentCheckCache(maxsize=10, interval=60)
+        cache.add(TODAY, "foo")
+        assert not cache.contains(TOMORROW, "foo")
+        assert len(cache) == 0
+
+    def test_lru_eviction(self) -> None:
+        cache = RecentCheckCache(maxsize=2, interval=60)
+        for key in ("a", "b", "c"):
+            cache.add(TODAY, key)
+        assert len(cache) == 2
+        assert not cache.contains(TODAY, "a")
+
+
+class TestSharedHashCache:
+    def setup_method(self) -> None:
+        caches["default"].clear()
+
+    def test_add(self) -> None:
+        cache = SharedHashCache("default")
+        timestamp = datetime.datetime(2020, 7, 4, 23, 59, tzinfo=datetime.timezone.utc)
+        assert cache.add("foo", timestamp) is True
+        assert cache.add("foo", timestamp) is False
+        cache.discard("foo")
+        assert cache.add("foo", timestamp) is True
+
+    def test_add__unavailable(self) -> None:
+        cache = SharedHashCache("default")
+        with mock.patch.object(caches["default"], "add", side_effect=ConnectionError):
+            assert cache.add("foo", timezone.now()) is None
+
+    def test_invalid_alias(self) -> None:
+        with pytest.raises(InvalidCacheBackendError):
+            SharedHashCache("does-not-exist")
+
+
+@pytest.mark.parametrize(
+    "timestamp,seconds",
+    (
+        (datetime.datetime(2020, 7, 4, 0, 0, tzinfo=datetime.timezone.utc), 86400),
+        (datetime.datetime(2020, 7, 4, 23, 0, tzinfo=datetime.timezone.utc), 3600),
+        (datetime.datetime(2020, 7, 4, 23, 59, 59, 999999), 1),
+    ),
+)
+def test_seconds_until_midnight(timestamp: datetime.datetime, seconds: int) -> None:
+    assert seconds_until_midnight(timestamp) == seconds
@@ -0,0 +1,136 @@
+import datetime
+from typing import Any, List
+from unittest import mock
+
+import pytest
+
+from user_visit import detection
+from user_visit.detection import (
+    Alert,
+    SuspiciousActivityDetector,
+    haversine,
+    on_visit_recorded,
+)
+from user_visit.models import UserVisit
+from user_visit.signals import suspicious_activity
+
+START = datetime.datetime(2020, 7, 1, 12, tzinfo=datetime.timezone.utc)
+
+LONDON = {"geoip": {"latitude": 51.5, "longitude": -0.1}}
+OXFORD = {"geoip": {"latitude": 51.75, "longitude": -1.26}}
+NEW_YORK = {"geoip": {"latitude": 40.7, "longitude": -74.0}}
+
+
+def visit(
+    minutes: float,
+    user_id: int = 1,
+    remote_addr: str = "127.0.0.1",
+    ua_string: str = "Chrome",
+    **kwargs: Any,
+) -> UserVisit:
+    return UserVisit(
+        user_id=user_id,
+        timestamp=START + datetime.timedelta(minutes=minutes),
+        remote_addr=remote_addr,
+        ua_string=ua_string,
+        **kwargs,
+    )
+
+
+def kinds(alerts: List[Alert]) -> List[str]:
+    return [alert.kind for alert in alerts]
+
+
+def test_haversine() -> None:
+    assert haversine(51.5, -0.1, 51.5, -0.1) == 0
+    assert haversine(51.5, -0.1, 40.7, -74.0) == pytest.approx(5570, rel=0.01)
+
+
+class TestCombinations:
+    def test_threshold(self) -> None:
+        detector = SuspiciousActivityDetector(window=3600, max_combinations=2)
+        assert not detector.process(visit(0, remote_addr="1.1.1.1"))
+        assert not detector.process(visit(1, remote_addr="2.2.2.2"))
+        # repeat combinations don't count
+        assert not detector.process(visit(2, remote_addr="1.1.1.1"))
+        alerts = detector.process(visit(3, ua_string="Firefox"))
+        assert kinds(alerts) == ["combinations"]
+        assert alerts[0].user_id == 1
+        assert alerts[0].details["combinations"] == 3
+        addrs = alerts[0].details["remote_addrs"]
+        assert addrs == ["1.1.1.1", "127.0.0.1", "2.2.2.2"]
+        # only alerted once while over the threshold
+        assert not detector.process(visit(4, remote_addr="3.3.3.3"))
+
+    def test_window_expiry(self) -> None:
+        detector = SuspiciousActivityDetector(window=600, max_combinations=2)
+        for i, minutes in enumerate((0, 5, 20)):
+            assert not detector.process(visit(minutes, remote_addr=f"{i}.0.0.0"))
+
+    def test_users(self) -> None:
+        detector = SuspiciousActivityDetector(max_combinations=1)
+        assert not detector.process(visit(0, user_id=1, remote_addr="1.1.1.1"))
+        assert not detector.process(visit(0, user_id=2, remote_addr="2.2.2.2"))
+        assert detector.process(visit(1, user_id=2, remote_addr="3.3.3.3"))
+
+    def test_disabled(self) -> None:
+        detector = SuspiciousActivityDetector(max_combinations=0)
+        assert not detector.process(visit(0, remote_addr="1.1.1.1"))
+        assert not detector.process(visit(1, remote_addr="2.2.2.2"))
+
+    def test_max_users(self) -> None:
+        detector = SuspiciousActivityDetector(max_combinations=1, max_users=2)
+        detector.process(visit(0, user_id=1, remote_addr="1.1.1.1"))
+        detector.process(visit(0, user_id=2))
+        detector.process(visit(0, user_id=3))
+        assert len(detector) == 2
+        # user 1 was evicted, so this is their first combination again
+        assert not detector.process(visit(1, user_id=1, remote_addr="2.2.2.2"))
+
+
+class TestTravel:
+    def test_impossible_travel(self) -> None:
+        detector = SuspiciousActivityDetector(max_combinations=0, max_speed=1000)
+        assert not detector.process(visit(0, context=LONDON))
+        alerts = detector.process(visit(60, context=NEW_YORK))
+        assert kinds(alerts) == ["travel"]
+        assert alerts[0].details["distance"] == pytest.approx(5570, rel=0.01)
+        assert alerts[0].details["seconds"] == 3600
+
+    def test_possible_travel(self) -> None:
+        detector = SuspiciousActivityDetector(max_combinations=0, max_speed=1000)
+        assert not detector.process(visit(0, context=LONDON))
+        assert not detector.process(visit(60 * 8, context=NEW_YORK))
+        # within the GeoIP margin of error
+        assert not detector.process(visit(60 * 8, context=NEW_YORK))
+
+    def test_min_distance(self) -> None:
+        detector = SuspiciousActivityDetector(max_combinations=0, max_speed=10)
+        assert not detector.process(visit(0, context=LONDON))
+        assert not detector.process(visit(1, context=OXFORD))
+
+    def test_simultaneous(self) -> None:
+        detector = SuspiciousActivityDetector(max_combinations=0)
+        detector.process(visit(0, context=LONDON))
+        alerts = detector.process(visit(0, context=NEW_YORK))
+        assert alerts[0].details["speed"] is None
+
+    def test_no_location(self) -> None:
+        detector = SuspiciousActivityDetector(max_combinations=0)
+        assert not detector.process(visit(0, context=LONDON))
+        assert not detector.process(visit(1, context={}))
+        assert not detector.process(visit(2, context={"geoip": {"city": "X"}}))
+        assert not detector.process(visit(3, context=LONDON))
+
+
+@mock.patch.object(detection, "_detector", None)
+def test_on_visit_recorded() -> None:
+    receiver = mock.Mock()
+    suspicious_activity.connect(receiver)
+    try:
+        on_visit_recorded(None, user_visit=visit(0, context=LONDON))
+        on_visit_recorded(None, user_visit=visit(1, context=NEW_YORK))
+    finally:
+        suspicious_activity.disconnect(receiver)
+    assert receiver.call_count == 1
+    assert receiver.call_args.kwargs["alert"].kind == "travel"
@@ -0,0 +1,115 @@
+import csv
+import io
+import json
+import pathlib
+from typing import List
+from unittest import mock
+
+import pytest
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from user_visit.export import (
+    EXPORT_FIELDS,
+    get_writer,
+    infer_format,
+    iter_chunks,
+    stream_export,
+)
+from user_visit.models import UserVisit, get_user_agent
+
+
+@pytest.fixture
+def visits() -> List[UserVisit]:
+    user = User.objects.create(username="Bob")
+    return [
+        UserVisit.objects.create(
+            user=user,
+            session_key=str(i),
+            ua_string="Chrome",
+            timestamp=timezone.now(),
+            context={"i": i},
+        )
+        for i in range(5)
+    ]
+
+
+@pytest.mark.parametrize(
+    "path,fmt",
+    (
+        ("visits.csv", "csv"),
+        ("visits.csv.gz", "csv"),
+        ("visits.jsonl.gz", "jsonl"),
+        ("exports/visits.parquet", "parquet"),
+    ),
+)
+def test_infer_format(path: str, fmt: str) -> None:
+    assert infer_format(path) == fmt
+
+
+def test_infer_format__unknown() -> None:
+    with pytest.raises(ValueError):
+        infer_format("visits.xml")
+
+
+def test_get_writer__unknown() -> None:
+    with pytest.raises(ValueError):
+        get_writer("xml", io.BytesIO())
+
+
+@pytest.mark.django_db
+def test_iter_chunks(visits: List[UserVisit]) -> None:
+    chunks = list(iter_chunks(UserVisit.objects.all(), 2))
+    assert [len(c) for c in chunks] == [2, 2, 1]
+    assert list(chunks[0][0].keys()) == EXPORT_FIELDS
+
+
+@pytest.mark.django_db
+@mock.patch("user_visit.export.USER_AGENT_TABLE", True)
+def test_iter_chunks__user_agent_table(visits: List[UserVisit]) -> None:
+    get_user_agent.cache_clear()
+    visits[0].link_user_agent()
+    visits[0].save()
+    UserVisit.objects.filter(pk=visits[1].pk).update(browser="Safari")
+    rows = next(iter_chunks(UserVisit.objects.all(), 5))
+    assert list(rows[0].keys()) == EXPORT_FIELDS
+    # linked visits use the UserAgent values, others their own fields
+    assert [row["browser"] for row in rows[:3]] == ["Other", "Safari", ""]
+
+
+@pytest.mark.django_db
+def test_stream_export__csv(visits: List[UserVisit]) -> None:
+    content = b"".join(stream_export(UserVisit.objects.all(), "csv", chunk_size=2))
+    rows = list(csv.DictReader(io.StringIO(content.decode())))
+    assert [r["session_key"] for r in rows] == ["0", "1", "2", "3", "4"]
+    assert json.loads(rows[1]["context"]) == {"i": 1}
+
+
+@pytest.mark.django_db
+def test_stream_export__jsonl(visits: List[UserVisit]) -> None:
+    content = b"".join(stream_export(UserVisit.objects.all(), "jsonl"))
+    rows = [json.loads(line) for line in content.decode().splitlines()]
+    assert [r["context"] for r in rows] == [{"i": i} for i in range(5)]
+    assert rows[0]["uuid"] == str(visits[0].uuid)
+
+
+@pytest.mark.django_db
+def test_stream_export__csv_empty() -> None:
+    content = b"".join(stream_export(UserVisit.objects.all(), "csv"))
+    assert content.decode().strip() == ",".join(EXPORT_FIELDS)
+
+
+@pytest.mark.django_db
+def test_parquet_writer(visits: List[UserVisit], tmp_path: pathlib.Path) -> None:
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = tmp_path / "visits.parquet"
+    with open(path, "wb") as f:
+        writer = get_writer("parquet", f)
+        for chunk in iter_chunks(UserVisit.objects.all(), 2):
+            writer.write_rows(chunk)
+        writer.close()
+    parquet_file = pq.ParquetFile(path)
+    assert parquet_file.metadata.num_row_groups == 3
+    table = parquet_file.read()
+    assert table.column("session_key").to_pylist() == ["0", "1", "2", "3", "4"]
+    assert table.column("visit_date").to_pylist()[0] == visits[0].visit_date
@@ -0,0 +1,113 @@
+from typing import Any, Dict, Optional
+from unittest import mock
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory
+
+from user_visit import geoip
+from user_visit.geoip import GeoIPContextExtractor, parse_city
+
+LONDON = {
+    "city": {"names": {"en": "London"}},
+    "country": {"iso_code": "GB"},
+    "location": {"latitude": 51.5, "longitude": -0.1},
+}
+
+
+class FakeReader:
+    def __init__(self, records: Dict[str, Any]) -> None:
+        self.records = records
+        self.lookups = 0
+
+    def get(self, ip_address: str) -> Optional[Dict[str, Any]]:
+        self.lookups += 1
+        if ip_address == "invalid":
+            raise ValueError("not an IP address")
+        return self.records.get(ip_address)
+
+
+def get_extractor(**kwargs: Any) -> GeoIPContextExtractor:
+    extractor = GeoIPContextExtractor("GeoLite2-City.mmdb", **kwargs)
+    extractor._reader = FakeReader({"81.2.69.160": LONDON})
+    return extractor
+
+
+def request_from(ip_address: str) -> Any:
+    return RequestFactory().get("/", REMOTE_ADDR=ip_address)
+
+
+def test_parse_city() -> None:
+    assert parse_city(LONDON) == {
+        "country": "GB",
+        "city": "London",
+        "latitude": 51.5,
+        "longitude": -0.1,
+    }
+    assert parse_city({"country": {"iso_code": "GB"}})["city"] is None
+    assert parse_city(None) == {}
+
+
+class TestGeoIPContextExtractor:
+    def test_lookup(self) -> None:
+        extractor = get_extractor()
+        context = extractor(request_from("81.2.69.160"))
+        assert context == {"geoip": parse_city(LONDON)}
+        assert extractor(request_from("127.0.0.1")) == {}
+        assert extractor(request_from("")) == {}
+
+    def test_cache(self) -> None:
+        extractor = get_extractor()
+        for _ in range(3):
+            extractor(request_from("81.2.69.160"))
+        assert extractor._reader.lookups == 1
+        assert extractor.stats()["hits"] == 2
+
+    def test_invalid_ip(self) -> None:
+        extractor = get_extractor()
+        assert extractor(request_from("invalid")) == {}
+        assert extractor.stats()["errors"] == 0
+
+    def test_over_budget(self) -> None:
+        extractor = get_extractor(time_budget=0.01, cooldown=60)
+        with mock.patch("user_visit.geoip.time.monotonic", side_effect=[0, 1, 1]):
+            # the slow lookup's result is still used
+            assert extractor(request_from("81.2.69.160"))
+        with mock.patch("user_visit.geoip.time.monotonic", return_value=30):
+            assert extractor(request_from("81.2.69.160")) == {}
+        assert extractor.stats()["over_budget"] == 1
+        assert extractor.stats()["skipped"] == 1
+        # cooldown has expired, and the lookup is cached
+        assert extractor(request_from("81.2.69.160"))
+
+    def test_error(self) -> None:
+        extractor = get_extractor()
+        extractor._reader.get = mock.Mock(side_effect=OSError)
+        assert extractor(request_from("81.2.69.160")) == {}
+        assert extractor(request_from("81.2.69.161")) == {}
+        assert extractor._reader.get.call_count == 1
+        assert extractor.stats()["errors"] == 1
+
+    def test_missing_maxminddb(self) -> None:
+        extractor = GeoIPContextExtractor("GeoLite2-City.mmdb")
+        with mock.patch.dict("sys.modules", {"maxminddb": None}):
+            with pytest.raises(ImproperlyConfigured):
+                extractor(request_from("81.2.69.160"))
+
+
+@mock.patch("user_visit.geoip._extractor", None)
+def test_geoip_context() -> None:
+    with mock.patch("user_visit.geoip.GEOIP_DATABASE", "GeoLite2-City.mmdb"):
+        extractor = geoip.get_extractor()
+        assert geoip.get_extractor() is extractor
+    extractor._reader = FakeReader({"81.2.69.160": LONDON})
+    assert geoip.geoip_context(request_from("81.2.69.160"))["geoip"]["city"] == (
+        "London"
+    )
+
+
+@mock.patch("user_visit.geoip._extractor", None)
+@mock.patch("user_visit.geoip.GEOIP_DATABASE", None)
+def test_geoip_context__not_configured() -> None:
+    with pytest.raises(ImproperlyConfigured):
+        geoip.geoip_context(request_from("81.2.69.160"))
@@ -0,0 +1,84 @@
+import socket
+from unittest import mock
+
+import pytest
+
+from user_visit.metrics import (
+    InMemoryMetrics,
+    NullMetrics,
+    StatsdMetrics,
+    get_metrics_backend,
+)
+
+
+def test_get_metrics_backend() -> None:
+    assert isinstance(get_metrics_backend(None), NullMetrics)
+    backend = get_metrics_backend(
+        "user_visit.metrics.StatsdMetrics", {"host": "statsd", "port": 9125}
+    )
+    assert isinstance(backend, StatsdMetrics)
+    assert backend.address == ("statsd", 9125)
+
+
+def test_in_memory_metrics() -> None:
+    metrics = InMemoryMetrics()
+    metrics.increment("recorded")
+    metrics.increment("recorded", 2)
+    with metrics.timer("insert"):
+        pass
+    assert metrics.counters == {"recorded": 3}
+    assert len(metrics.timings["insert"]) == 1
+    assert metrics.timings["insert"][0] >= 0
+    metrics.reset()
+    assert metrics.counters == {}
+
+
+def test_timer__error() -> None:
+    metrics = InMemoryMetrics()
+    with pytest.raises(ValueError):
+        with metrics.timer("insert"):
+            raise ValueError
+    assert len(metrics.timings["insert"]) == 1
+
+
+class TestStatsdMetrics:
+    def test_send(self) -> None:
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(1)
+        metrics = StatsdMetrics(port=server.getsockname()[1], host="127.0.0.1")
+        metrics.increment("recorded")
+        assert server.recv(100) == b"user_visit.recorded:1|c"
+        metrics.timing("insert", 0.0015)
+        assert server.recv(100) == b"user_visit.insert:1.500|ms"
+        server.close()
+
+    def test_send__error(self) -> None:
+        metrics = StatsdMetrics()
+        metrics.socket = mock.Mock(sendto=mock.Mock(side_effect=OSError))
+        metrics.increment("recorded")
+        assert metrics.socket.sendto.call_count == 1
+
+
+def test_prometheus_metrics() -> None:
+    prometheus_client = pytest.importorskip("prometheus_client")
+    from user_visit.metrics import PrometheusMetrics
+
+    metrics = PrometheusMetrics(namespace="test_user_visit")
+    metrics.increment("duplicate.cache")
+    metrics.increment("duplicate.cache")
+    metrics.timing("insert", 0.1)
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("test_user_visit_duplicate_cache_total") == 2
+    assert registry.get_sample_value("test_user_visit_insert_seconds_count") == 1
+
+
+def test_prometheus_metrics__shared() -> None:
+    prometheus_client = pytest.importorskip("prometheus_client")
+    from user_visit.metrics import PrometheusMetrics
+
+    # a second instance (e.g. another middleware instance) reuses the collectors
+    PrometheusMetrics(namespace="test_shared").increment("recorded")
+    PrometheusMetrics(namespace="test_shared").increment("recorded")
+    registry = prometheus_client.REGISTRY
+    assert registry.get_sample_value("test_shared_recorded_total") == 2
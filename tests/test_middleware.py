@@ -1,16 +1,46 @@
+from typing import Any
 from unittest import mock
 
 import django.db
 import freezegun
 import pytest
-from django.contrib.auth.models import User
-from django.core.exceptions import MiddlewareNotUsed
-from django.http import HttpResponse
-from django.test import Client
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends import cache as cache_sessions, signed_cookies
+from django.contrib.sessions.backends.base import SessionBase
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.http import HttpRequest, HttpResponse
+from django.test import AsyncClient, Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from user_visit.middleware import UserVisitMiddleware, save_user_visit
-from user_visit.models import UserVisit, UserVisitManager
+from user_visit.metrics import InMemoryMetrics
+from user_visit.middleware import (
+    SESSION_MARKER_KEY,
+    UserVisitMiddleware,
+    bulk_save_user_visits,
+    insert_user_visit,
+    save_user_visit,
+)
+from user_visit.models import (
+    UserVisit,
+    UserVisitDailySummary,
+    UserVisitManager,
+    get_user_agent,
+)
+from user_visit.signals import (
+    visit_bypassed,
+    visit_duplicate,
+    visit_error,
+    visit_recorded,
+)
+from user_visit.writers import BatchWriter
+
+# the async middleware path relies on Model.asave
+requires_async = pytest.mark.skipif(
+    django.VERSION < (4, 2), reason="async middleware requires Django 4.2+"
+)
 
 
 @pytest.mark.django_db
@@ -68,6 +98,83 @@ def test_save_user_visit__duplicate__log_levels(mock_logger: mock.Mock) -> None:
     assert mock_logger.debug.call_count == 1
 
 
+@pytest.mark.django_db
+def test_bulk_save_user_visits() -> None:
+    """Test bulk save skips duplicate hashes."""
+    user = User.objects.create(username="Yoda")
+    timestamp = timezone.now()
+    uv = UserVisit.objects.create(
+        user=user,
+        session_key="test",
+        ua_string="Chrome",
+        remote_addr="127.0.0.1",
+        timestamp=timestamp,
+    )
+    uv.id = None
+    uv2 = UserVisit(
+        user=user,
+        session_key="test2",
+        ua_string="Chrome",
+        remote_addr="127.0.0.1",
+        timestamp=timestamp,
+    )
+    uv2.hash = uv2.md5().hexdigest()
+    assert bulk_save_user_visits([uv, uv2, uv2]) == {uv2.hash}
+    assert UserVisit.objects.count() == 2
+    assert UserVisit.objects.get(session_key="test2").created_at is not None
+
+
+@pytest.mark.django_db
+def test_bulk_save_user_visits__no_returning() -> None:
+    """Test bulk save looks up existing hashes if INSERT cannot return rows."""
+    user = User.objects.create(username="Yoda")
+    uv = UserVisit.objects.create(user=user, session_key="test")
+    uv.id = None
+    uv2 = UserVisit(user=user, session_key="test2", timestamp=uv.timestamp)
+    uv2.hash = uv2.md5().hexdigest()
+    with mock.patch.object(
+        django.db.connection.features, "can_return_columns_from_insert", False
+    ):
+        assert bulk_save_user_visits([uv, uv2]) == {uv2.hash}
+    assert UserVisit.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_insert_user_visit() -> None:
+    user = User.objects.create(username="Yoda")
+    uv = UserVisit(
+        user=user,
+        session_key="test",
+        ua_string="Chrome",
+        timestamp=timezone.now(),
+        context={"foo": "bar"},
+    )
+    with CaptureQueriesContext(django.db.connection) as ctx:
+        assert insert_user_visit(uv)
+    assert len(ctx.captured_queries) == 1
+    saved = UserVisit.objects.get()
+    assert saved.pk == uv.pk
+    assert saved.hash == uv.hash
+    assert saved.visit_date == uv.timestamp.date()
+    assert saved.context == {"foo": "bar"}
+    assert saved.created_at is not None
+    assert not uv._state.adding
+
+
+@pytest.mark.django_db
+@mock.patch("user_visit.middleware.logger")
+def test_insert_user_visit__duplicate(mock_logger: mock.Mock) -> None:
+    user = User.objects.create(username="Yoda")
+    uv = UserVisit.objects.create(user=user, session_key="test", ua_string="Chrome")
+    uv2 = UserVisit(user=user, session_key="test", ua_string="Chrome")
+    uv2.timestamp = uv.timestamp
+    assert not insert_user_visit(uv2)
+    assert uv2.pk is None
+    assert UserVisit.objects.count() == 1
+    assert mock_logger.warning.call_count == 0
+    assert mock_logger.debug.call_count == 1
+
+
 @pytest.mark.django_db
 class TestUserVisitMiddleware:
     """RequestTokenMiddleware tests."""
@@ -97,6 +204,314 @@ class TestUserVisitMiddleware:
         client.get("/")
         assert UserVisit.objects.count() == 1
 
+    def test_middleware__seen_cache(self) -> None:
+        """Check that a repeat visit is served from the seen hash cache."""
+        user = User.objects.create_user("Fred")
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        middleware = self.get_middleware()
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            middleware(request)
+        assert len(ctx.captured_queries) > 0
+        assert UserVisit.objects.count() == 1
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            with mock.patch.object(UserVisitManager, "build") as build:
+                middleware(request)
+        assert len(ctx.captured_queries) == 0
+        assert build.call_count == 0
+        assert middleware.seen_cache.hits == 1
+
+    @mock.patch("user_visit.middleware.DEDUP_CACHE", "default")
+    def test_middleware__shared_cache(self) -> None:
+        """Check that a hash claimed by another worker is not re-checked."""
+        caches["default"].clear()
+        user = User.objects.create_user("Fred")
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        # first worker records the visit without an EXISTS query
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            self.get_middleware()(request)
+        assert UserVisit.objects.count() == 1
+        assert not any("EXISTS" in q["sql"].upper() for q in ctx.captured_queries)
+        # second worker has an empty local cache, but the shared cache hits
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            self.get_middleware()(request)
+        assert len(ctx.captured_queries) == 0
+
+    @mock.patch("user_visit.middleware.DEDUP_CACHE", "default")
+    def test_middleware__shared_cache__unavailable(self) -> None:
+        """Check that the database is used if the shared cache is down."""
+        client = Client()
+        client.force_login(User.objects.create_user("Fred"))
+        with mock.patch.object(caches["default"], "add", side_effect=ConnectionError):
+            client.get("/")
+            client.get("/")
+        assert UserVisit.objects.count() == 1
+
+    @mock.patch("user_visit.middleware.DEDUP_CACHE", "default")
+    def test_middleware__shared_cache__save_error(self) -> None:
+        """Check that a claimed hash is released if the save fails."""
+        caches["default"].clear()
+        user = User.objects.create_user("Fred")
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        middleware = self.get_middleware()
+        with mock.patch.object(
+            UserVisit, "save", side_effect=django.db.OperationalError
+        ):
+            with pytest.raises(django.db.OperationalError):
+                middleware(request)
+        assert middleware.shared_cache is not None
+        assert (
+            caches["default"].get(
+                middleware.shared_cache.key(
+                    UserVisit.objects.build(request, timezone.now()).hash
+                )
+            )
+            is None
+        )
+
+    @mock.patch("user_visit.middleware.WRITE_MODE", "deferred")
+    def test_middleware__deferred(self) -> None:
+        """Check that deferred visits are queued after the response."""
+        user = User.objects.create_user("Fred")
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        middleware = self.get_middleware()
+        assert middleware.writer is not None
+        with mock.patch.object(
+            middleware.writer, "submit", return_value=True
+        ) as submit:
+            middleware(request)
+            middleware(request)
+        assert submit.call_count == 1
+        assert UserVisit.objects.count() == 0
+        # writer calls back into the middleware to save the visit
+        middleware.record_visit(submit.call_args[0][0])
+        assert UserVisit.objects.count() == 1
+
+    @mock.patch("user_visit.middleware.WRITE_MODE", "deferred")
+    def test_middleware__deferred__dropped(self) -> None:
+        """Check that a dropped visit is not marked as seen."""
+        user = User.objects.create_user("Fred")
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        middleware = self.get_middleware()
+        assert middleware.writer is not None
+        with mock.patch.object(
+            middleware.writer, "submit", return_value=False
+        ) as submit:
+            middleware(request)
+            middleware(request)
+        assert submit.call_count == 2
+
+    @mock.patch("user_visit.middleware.WRITE_MODE", "batch")
+    @mock.patch("user_visit.middleware.DEDUP_CACHE", "default")
+    def test_middleware__batch(self) -> None:
+        """Check that batched visits skip hashes claimed elsewhere."""
+        caches["default"].clear()
+        user = User.objects.create_user("Fred")
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        middleware = self.get_middleware()
+        assert isinstance(middleware.writer, BatchWriter)
+        with mock.patch.object(
+            middleware.writer, "submit", return_value=True
+        ) as submit:
+            middleware(request)
+        uv = submit.call_args[0][0]
+        middleware.record_visits([uv])
+        assert UserVisit.objects.count() == 1
+        # a second batch with the same hash is filtered by the shared cache
+        with mock.patch("user_visit.middleware.bulk_save_user_visits") as bulk_save:
+            middleware.record_visits([uv])
+        assert bulk_save.call_count == 0
+
+    @mock.patch("user_visit.middleware.WRITE_MODE", "batch")
+    @mock.patch("user_visit.middleware.DEDUP_CACHE", "default")
+    def test_middleware__batch__error(self) -> None:
+        """Check that a failed batch releases its shared cache claims."""
+        caches["default"].clear()
+        user = User.objects.create_user("Fred")
+        uv = UserVisit(user=user, session_key="test", timestamp=timezone.now())
+        uv.hash = uv.md5().hexdigest()
+        middleware = self.get_middleware()
+        with mock.patch(
+            "user_visit.middleware.bulk_save_user_visits",
+            side_effect=django.db.OperationalError,
+        ):
+            with pytest.raises(django.db.OperationalError):
+                middleware.record_visits([uv])
+        middleware.record_visits([uv])
+        assert UserVisit.objects.count() == 1
+
+    @mock.patch("user_visit.middleware.WRITE_MODE", "batch")
+    def test_middleware__batch__duplicate(self) -> None:
+        """Check that only the visits actually inserted are signalled."""
+        user = User.objects.create_user("Fred")
+        visits = [
+            UserVisit(user=user, session_key=session_key, timestamp=timezone.now())
+            for session_key in ("test", "test", "test2")
+        ]
+        for uv in visits:
+            uv.hash = uv.md5().hexdigest()
+        middleware = self.get_middleware()
+        middleware.metrics = InMemoryMetrics()
+        recorded = mock.Mock()
+        visit_recorded.connect(recorded)
+        try:
+            middleware.record_visits(visits)
+            middleware.record_visits(visits[-1:])
+        finally:
+            visit_recorded.disconnect(recorded)
+        assert UserVisit.objects.count() == 2
+        assert recorded.call_count == 2
+        assert middleware.metrics.counters == {"recorded": 2, "duplicate.insert": 2}
+
+    @mock.patch("user_visit.middleware.USER_AGENT_PARSING", "lazy")
+    def test_middleware__lazy_user_agent(self) -> None:
+        """Check that the UA is only parsed for visits that are written."""
+        user = User.objects.create_user("Fred")
+        request = RequestFactory().get("/", HTTP_USER_AGENT="Chrome 99")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        with mock.patch.object(
+            UserVisit,
+            "update_user_agent_data",
+            autospec=True,
+            side_effect=UserVisit.update_user_agent_data,
+        ) as update:
+            self.get_middleware()(request)
+            # new middleware (empty seen cache) - visit exists in the db
+            self.get_middleware()(request)
+        assert update.call_count == 1
+        assert UserVisit.objects.get().browser == "Other"
+
+    @mock.patch("user_visit.middleware.USER_AGENT_PARSING", "offline")
+    def test_middleware__offline_user_agent(self) -> None:
+        client = Client()
+        client.force_login(User.objects.create_user("Fred"))
+        client.get("/", HTTP_USER_AGENT="Chrome 99")
+        uv = UserVisit.objects.get()
+        assert (uv.browser, uv.device, uv.os) == ("", "", "")
+
+    @mock.patch("user_visit.middleware.USER_AGENT_TABLE", True)
+    def test_middleware__user_agent_table(self) -> None:
+        get_user_agent.cache_clear()
+        client = Client()
+        client.force_login(User.objects.create_user("Fred"))
+        client.get("/", HTTP_USER_AGENT="Chrome 99")
+        client.get("/", HTTP_USER_AGENT="Firefox 99")
+        uv = UserVisit.objects.select_related("agent").get(ua_string="Chrome 99")
+        assert (uv.browser, uv.device, uv.os) == ("", "", "")
+        assert uv.agent.ua_string == "Chrome 99"
+        assert uv.agent.browser == "Other"
+        # a new visit (another session) reuses the cached UserAgent
+        client = Client()
+        client.force_login(User.objects.create_user("Ginger"))
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            client.get("/", HTTP_USER_AGENT="Chrome 99")
+        assert not [q for q in ctx.captured_queries if "user_agent" in q["sql"]]
+        assert UserVisit.objects.filter(agent=uv.agent).count() == 2
+
+    @mock.patch("user_visit.middleware.USER_AGENT_TABLE", True)
+    @mock.patch("user_visit.middleware.USER_AGENT_PARSING", "offline")
+    def test_middleware__user_agent_table__offline(self) -> None:
+        client = Client()
+        client.force_login(User.objects.create_user("Fred"))
+        client.get("/", HTTP_USER_AGENT="Chrome 99")
+        assert UserVisit.objects.get().agent is None
+
+    @mock.patch("user_visit.middleware.USER_AGENT_PARSING", "never")
+    def test_middleware__invalid_user_agent_parsing(self) -> None:
+        with pytest.raises(ImproperlyConfigured):
+            self.get_middleware()
+
+    @mock.patch("user_visit.middleware.SUMMARY_ON_WRITE", True)
+    def test_middleware__summary_on_write(self) -> None:
+        client = Client()
+        client.force_login(User.objects.create_user("Fred"))
+        client.get("/")
+        client.get("/")
+        summary = UserVisitDailySummary.objects.get(dimension="all")
+        assert (summary.visit_count, summary.user_count) == (1, 1)
+
+    def test_middleware__context_extractor(self) -> None:
+        """Check that the context is only extracted for new visits."""
+        extractor = mock.Mock(return_value={"foo": "bar"})
+        user = User.objects.create_user("Fred")
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        with mock.patch("user_visit.models.REQUEST_CONTEXT_EXTRACTOR", extractor):
+            self.get_middleware()(request)
+            # seen cache hit
+            middleware = self.get_middleware()
+            middleware(request)
+            # database hit
+            self.get_middleware()(request)
+        extractor.assert_called_once_with(request)
+        assert UserVisit.objects.get().context == {"foo": "bar"}
+
+    @mock.patch("user_visit.middleware.WRITE_MODE", "deferred")
+    def test_middleware__context_extractor__deferred(self) -> None:
+        """Check that the context is extracted by the writer, not the request."""
+        extractor = mock.Mock(return_value={"foo": "bar"})
+        user = User.objects.create_user("Fred")
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        middleware = self.get_middleware()
+        assert middleware.writer is not None
+        with mock.patch("user_visit.models.REQUEST_CONTEXT_EXTRACTOR", extractor):
+            with mock.patch.object(
+                middleware.writer, "submit", return_value=True
+            ) as submit:
+                middleware(request)
+            assert extractor.call_count == 0
+            middleware.record_visit(submit.call_args[0][0])
+        extractor.assert_called_once_with(request)
+        assert UserVisit.objects.get().context == {"foo": "bar"}
+
+    @mock.patch("user_visit.middleware.RECORDING_STRATEGY", "upsert")
+    def test_middleware__upsert(self) -> None:
+        """Check that a new visit is recorded in a single query."""
+        user = User.objects.create_user("Fred")
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            self.get_middleware()(request)
+        assert len(ctx.captured_queries) == 1
+        assert UserVisit.objects.count() == 1
+        # a second worker goes straight to the INSERT, which does nothing
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            self.get_middleware()(request)
+        assert len(ctx.captured_queries) == 1
+        assert UserVisit.objects.count() == 1
+
+    @mock.patch("user_visit.middleware.RECORDING_STRATEGY", "merge")
+    def test_middleware__invalid_recording_strategy(self) -> None:
+        with pytest.raises(ImproperlyConfigured):
+            self.get_middleware()
+
+    @mock.patch("user_visit.middleware.WRITE_MODE", "later")
+    def test_middleware__invalid_write_mode(self) -> None:
+        with pytest.raises(ImproperlyConfigured):
+            self.get_middleware()
+
+    @mock.patch("user_visit.middleware.WRITE_MODE", "batch")
+    @mock.patch("user_visit.middleware.SUMMARY_ON_WRITE", True)
+    def test_middleware__batch_summary_on_write(self) -> None:
+        with pytest.raises(ImproperlyConfigured):
+            self.get_middleware()
+
     def test_middleware__new_day(self) -> None:
         """Check that same user, new day, gets new visit."""
         user = User.objects.create_user("Fred")
@@ -137,3 +552,429 @@ class TestUserVisitMiddleware:
         client.get("/")
         count = 0 if user.username == "Fred" else 1
         assert UserVisit.objects.count() == count
+
+
+@pytest.mark.django_db
+class TestUserVisitMiddlewareRules:
+    """Exclusion rules and the recheck interval."""
+
+    def get_middleware(self) -> UserVisitMiddleware:
+        middleware = UserVisitMiddleware(get_response=lambda r: HttpResponse())
+        middleware.metrics = InMemoryMetrics()
+        return middleware
+
+    def get_request(self, user: User, path: str = "/", **extra: str) -> HttpRequest:
+        request = RequestFactory().get(path, **extra)
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        return request
+
+    @mock.patch("user_visit.middleware.EXCLUDE_PATHS", ["/api/poll/"])
+    def test_excluded_path(self) -> None:
+        middleware = self.get_middleware()
+        # the user is never loaded for excluded requests
+        middleware(self.get_request(mock.Mock(spec=[]), "/api/poll/1"))
+        assert middleware.metrics.counters == {"excluded": 1}
+        middleware(self.get_request(User.objects.create_user("Fred"), "/api/"))
+        assert UserVisit.objects.count() == 1
+
+    @mock.patch("user_visit.middleware.EXCLUDE_METHODS", ["OPTIONS"])
+    def test_excluded_method(self) -> None:
+        middleware = self.get_middleware()
+        request = RequestFactory().options("/")
+        request.user = mock.Mock(spec=[])
+        middleware(request)
+        assert middleware.metrics.counters == {"excluded": 1}
+
+    @requires_async
+    @mock.patch("user_visit.middleware.EXCLUDE_PATHS", ["/api/poll/"])
+    def test_excluded_path__async(self) -> None:
+        async def get_response(request: HttpRequest) -> HttpResponse:
+            return HttpResponse()
+
+        middleware = UserVisitMiddleware(get_response=get_response)
+        request = self.get_request(mock.Mock(spec=[]), "/api/poll/")
+        request.auser = mock.Mock(side_effect=AssertionError)
+        response = async_to_sync(middleware)(request)
+        assert response.status_code == 200
+
+    @mock.patch("user_visit.middleware.RECHECK_INTERVAL", 300)
+    def test_recheck_interval(self) -> None:
+        user = User.objects.create_user("Fred")
+        middleware = self.get_middleware()
+        middleware(self.get_request(user, HTTP_USER_AGENT="Chrome"))
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            middleware(self.get_request(user, HTTP_USER_AGENT="Firefox"))
+        assert len(ctx.captured_queries) == 0
+        assert UserVisit.objects.count() == 1
+        assert middleware.metrics.counters["recent_check_hit"] == 1
+        # once the window has expired the new device is recorded
+        with mock.patch("user_visit.dedup.time.monotonic", return_value=10**9):
+            middleware(self.get_request(user, HTTP_USER_AGENT="Firefox"))
+        assert UserVisit.objects.count() == 2
+
+    @mock.patch("user_visit.middleware.RECHECK_INTERVAL", 300)
+    def test_recheck_interval__new_day(self) -> None:
+        user = User.objects.create_user("Fred")
+        middleware = self.get_middleware()
+        with freezegun.freeze_time("2020-07-04"):
+            middleware(self.get_request(user))
+        with freezegun.freeze_time("2020-07-05"):
+            middleware(self.get_request(user))
+        assert UserVisit.objects.count() == 2
+
+    @mock.patch("user_visit.middleware.RECHECK_INTERVAL", 300)
+    @mock.patch("user_visit.middleware.SEEN_HASH_CACHE_SIZE", 0)
+    def test_recheck_interval__no_seen_cache(self) -> None:
+        """Check that disabling the seen hash cache keeps the recheck window."""
+        user = User.objects.create_user("Fred")
+        middleware = self.get_middleware()
+        middleware(self.get_request(user, HTTP_USER_AGENT="Chrome"))
+        middleware(self.get_request(user, HTTP_USER_AGENT="Firefox"))
+        assert UserVisit.objects.count() == 1
+        assert middleware.metrics.counters["recent_check_hit"] == 1
+
+    def test_recheck_interval__disabled(self) -> None:
+        user = User.objects.create_user("Fred")
+        middleware = self.get_middleware()
+        assert middleware.recent_checks is None
+        middleware(self.get_request(user, HTTP_USER_AGENT="Chrome"))
+        middleware(self.get_request(user, HTTP_USER_AGENT="Firefox"))
+        assert UserVisit.objects.count() == 2
+
+
+@pytest.mark.django_db
+@mock.patch("user_visit.middleware.SESSION_MARKER", True)
+class TestUserVisitMiddlewareSessionMarker:
+    """Visits recorded for a session are marked in the session itself."""
+
+    def get_middleware(self) -> UserVisitMiddleware:
+        middleware = UserVisitMiddleware(get_response=lambda r: HttpResponse())
+        middleware.metrics = InMemoryMetrics()
+        return middleware
+
+    def get_request(self, user: User, session: SessionBase) -> HttpRequest:
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = session
+        return request
+
+    def next_session(self, session: SessionBase) -> SessionBase:
+        """Save the session (as the response would), and reload it."""
+        session.save()
+        return session.__class__(session_key=session.session_key)
+
+    @pytest.mark.parametrize(
+        "engine",
+        [
+            signed_cookies,
+            cache_sessions,
+        ],
+    )
+    def test_session_marker(self, engine: Any) -> None:
+        user = User.objects.create_user("Fred")
+        session = engine.SessionStore()
+        session.save()
+        self.get_middleware()(self.get_request(user, session))
+        assert UserVisit.objects.count() == 1
+        assert session.modified
+        assert SESSION_MARKER_KEY in session
+        # a new worker (empty seen cache) trusts the marker in the session
+        session = self.next_session(session)
+        middleware = self.get_middleware()
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            middleware(self.get_request(user, session))
+        assert len(ctx.captured_queries) == 0
+        assert not session.modified
+        assert middleware.metrics.counters == {"session_marker_hit": 1}
+        assert UserVisit.objects.count() == 1
+
+    def test_session_marker__seen_cache(self) -> None:
+        user = User.objects.create_user("Fred")
+        session = cache_sessions.SessionStore()
+        session.save()
+        middleware = self.get_middleware()
+        middleware(self.get_request(user, session))
+        del session[SESSION_MARKER_KEY]
+        session.modified = False
+        middleware(self.get_request(user, session))
+        assert middleware.metrics.counters["seen_cache_hit"] == 1
+        assert session.modified
+        assert SESSION_MARKER_KEY in session
+
+    def test_session_marker__new_day(self) -> None:
+        user = User.objects.create_user("Fred")
+        session = cache_sessions.SessionStore()
+        session.save()
+        with freezegun.freeze_time("2020-07-04"):
+            self.get_middleware()(self.get_request(user, session))
+        session = self.next_session(session)
+        with freezegun.freeze_time("2020-07-05"):
+            self.get_middleware()(self.get_request(user, session))
+        assert UserVisit.objects.count() == 2
+
+    def test_session_marker__new_device(self) -> None:
+        user = User.objects.create_user("Fred")
+        session = cache_sessions.SessionStore()
+        session.save()
+        self.get_middleware()(self.get_request(user, session))
+        session = self.next_session(session)
+        request = self.get_request(user, session)
+        request.META["HTTP_USER_AGENT"] = "Firefox"
+        self.get_middleware()(request)
+        assert UserVisit.objects.count() == 2
+
+
+@pytest.mark.django_db
+class TestUserVisitMiddlewareMetrics:
+    """Metrics and signals sent by the middleware."""
+
+    def get_middleware(self) -> UserVisitMiddleware:
+        middleware = UserVisitMiddleware(get_response=lambda r: HttpResponse())
+        middleware.metrics = InMemoryMetrics()
+        return middleware
+
+    def get_request(self, user: User) -> HttpRequest:
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        return request
+
+    def test_recorded(self) -> None:
+        request = self.get_request(User.objects.create_user("Fred"))
+        middleware = self.get_middleware()
+        handler = mock.Mock()
+        visit_recorded.connect(handler)
+        try:
+            middleware(request)
+            middleware(request)
+        finally:
+            visit_recorded.disconnect(handler)
+        assert handler.call_count == 1
+        assert handler.call_args.kwargs["user_visit"] == UserVisit.objects.get()
+        metrics = middleware.metrics
+        assert isinstance(metrics, InMemoryMetrics)
+        assert metrics.counters == {"recorded": 1, "seen_cache_hit": 1}
+        for name in ("build", "dedup_check", "insert"):
+            assert len(metrics.timings[name]) == 1
+        assert len(metrics.timings["overhead"]) == 2
+
+    def test_duplicate(self) -> None:
+        request = self.get_request(User.objects.create_user("Fred"))
+        self.get_middleware()(request)
+        middleware = self.get_middleware()
+        handler = mock.Mock()
+        visit_duplicate.connect(handler)
+        try:
+            middleware(request)
+        finally:
+            visit_duplicate.disconnect(handler)
+        assert handler.call_args.kwargs["source"] == "database"
+        assert middleware.metrics.counters == {"duplicate.database": 1}
+
+    def test_duplicate__insert(self) -> None:
+        request = self.get_request(User.objects.create_user("Fred"))
+        middleware = self.get_middleware()
+        with mock.patch.object(UserVisit, "save", side_effect=django.db.IntegrityError):
+            middleware(request)
+        assert middleware.metrics.counters == {"duplicate.insert": 1}
+
+    def test_error(self) -> None:
+        request = self.get_request(User.objects.create_user("Fred"))
+        middleware = self.get_middleware()
+        handler = mock.Mock()
+        visit_error.connect(handler)
+        try:
+            with mock.patch.object(
+                UserVisit, "save", side_effect=django.db.OperationalError
+            ):
+                with pytest.raises(django.db.OperationalError):
+                    middleware(request)
+        finally:
+            visit_error.disconnect(handler)
+        assert isinstance(
+            handler.call_args.kwargs["exception"], django.db.OperationalError
+        )
+        assert middleware.metrics.counters == {"error": 1}
+
+    @mock.patch("user_visit.middleware.RECORDING_BYPASS", lambda r: True)
+    def test_bypassed(self) -> None:
+        request = self.get_request(User.objects.create_user("Fred"))
+        middleware = self.get_middleware()
+        handler = mock.Mock()
+        visit_bypassed.connect(handler)
+        try:
+            middleware(request)
+        finally:
+            visit_bypassed.disconnect(handler)
+        assert handler.call_args.kwargs["request"] == request
+        assert middleware.metrics.counters == {"bypassed": 1}
+
+    def test_anonymous(self) -> None:
+        middleware = self.get_middleware()
+        middleware(self.get_request(AnonymousUser()))
+        assert middleware.metrics.counters == {"anonymous": 1}
+
+    @mock.patch("user_visit.middleware.logger")
+    def test_backend_error(self, mock_logger: mock.Mock) -> None:
+        middleware = self.get_middleware()
+        middleware.metrics = mock.Mock(
+            increment=mock.Mock(side_effect=ValueError),
+            timing=mock.Mock(side_effect=ValueError),
+        )
+        response = middleware(self.get_request(User.objects.create_user("Fred")))
+        assert response.status_code == 200
+        assert UserVisit.objects.count() == 1
+        assert mock_logger.exception.call_count == 5
+
+    @requires_async
+    @mock.patch("user_visit.middleware.RECORDING_BYPASS", lambda r: True)
+    def test_bypassed__async(self) -> None:
+        async def get_response(request: HttpRequest) -> HttpResponse:
+            return HttpResponse()
+
+        middleware = UserVisitMiddleware(get_response=get_response)
+        middleware.metrics = InMemoryMetrics()
+        request = self.get_request(User.objects.create_user("Fred"))
+        handler = mock.Mock()
+        visit_bypassed.connect(handler)
+        try:
+            async_to_sync(middleware)(request)
+        finally:
+            visit_bypassed.disconnect(handler)
+        assert handler.call_count == 1
+        assert middleware.metrics.counters == {"bypassed": 1}
+
+
+@requires_async
+@pytest.mark.django_db
+class TestUserVisitMiddlewareAsync:
+    """Async (ASGI) middleware tests."""
+
+    def get_middleware(self) -> UserVisitMiddleware:
+        async def get_response(request: HttpRequest) -> HttpResponse:
+            return HttpResponse()
+
+        return UserVisitMiddleware(get_response=get_response)
+
+    def get_request(self, user: User) -> HttpRequest:
+        request = RequestFactory().get("/")
+        request.user = user
+        request.session = mock.Mock(session_key="test")
+        return request
+
+    def test_middleware__is_async(self) -> None:
+        assert iscoroutinefunction(self.get_middleware())
+        assert not iscoroutinefunction(
+            UserVisitMiddleware(get_response=lambda r: HttpResponse())
+        )
+
+    @mock.patch.object(UserVisitMiddleware, "async_capable", False)
+    def test_middleware__not_async_capable(self) -> None:
+        middleware = self.get_middleware()
+        assert not middleware.is_async
+        assert not iscoroutinefunction(middleware)
+
+    def test_middleware__anon(self) -> None:
+        request = self.get_request(AnonymousUser())
+        with mock.patch.object(UserVisitManager, "build") as build:
+            async_to_sync(self.get_middleware())(request)
+            assert build.call_count == 0
+
+    def test_middleware__auth(self) -> None:
+        request = self.get_request(User.objects.create_user("Fred"))
+        middleware = self.get_middleware()
+        response = async_to_sync(middleware)(request)
+        assert response.status_code == 200
+        assert UserVisit.objects.count() == 1
+        async_to_sync(middleware)(request)
+        assert UserVisit.objects.count() == 1
+        assert middleware.seen_cache.hits == 1
+
+    @mock.patch("user_visit.middleware.USER_AGENT_TABLE", True)
+    def test_middleware__user_agent_table(self) -> None:
+        get_user_agent.cache_clear()
+        request = self.get_request(User.objects.create_user("Fred"))
+        request.META["HTTP_USER_AGENT"] = "Chrome 99"
+        async_to_sync(self.get_middleware())(request)
+        assert UserVisit.objects.get().agent.ua_string == "Chrome 99"
+
+    def test_middleware__auser(self) -> None:
+        """Check that request.auser() is used to load the user."""
+        user = User.objects.create_user("Fred")
+        request = self.get_request(user)
+
+        async def auser() -> User:
+            return user
+
+        request.user = mock.Mock(side_effect=AssertionError)
+        request.auser = auser
+        async_to_sync(self.get_middleware())(request)
+        assert request.user == user
+        assert UserVisit.objects.count() == 1
+
+    def test_middleware__duplicate(self) -> None:
+        """Check that an existing visit is not saved again."""
+        request = self.get_request(User.objects.create_user("Fred"))
+        async_to_sync(self.get_middleware())(request)
+        with mock.patch("user_visit.middleware.asave_user_visit") as asave:
+            async_to_sync(self.get_middleware())(request)
+        assert asave.call_count == 0
+
+    @mock.patch("user_visit.middleware.DEDUP_CACHE", "default")
+    def test_middleware__shared_cache(self) -> None:
+        caches["default"].clear()
+        request = self.get_request(User.objects.create_user("Fred"))
+        async_to_sync(self.get_middleware())(request)
+        assert UserVisit.objects.count() == 1
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            async_to_sync(self.get_middleware())(request)
+        assert len(ctx.captured_queries) == 0
+
+    @mock.patch("user_visit.middleware.RECORDING_STRATEGY", "upsert")
+    def test_middleware__upsert(self) -> None:
+        request = self.get_request(User.objects.create_user("Fred"))
+        async_to_sync(self.get_middleware())(request)
+        middleware = self.get_middleware()
+        middleware.metrics = InMemoryMetrics()
+        async_to_sync(middleware)(request)
+        # no pre-check, the INSERT itself finds the duplicate
+        assert middleware.metrics.counters == {"duplicate.insert": 1}
+        assert UserVisit.objects.count() == 1
+
+    def test_middleware__recorded(self) -> None:
+        request = self.get_request(User.objects.create_user("Fred"))
+        middleware = self.get_middleware()
+        middleware.metrics = InMemoryMetrics()
+        handler = mock.Mock()
+        visit_recorded.connect(handler)
+        try:
+            async_to_sync(middleware)(request)
+            async_to_sync(self.get_middleware())(request)
+        finally:
+            visit_recorded.disconnect(handler)
+        assert handler.call_count == 1
+        assert middleware.metrics.counters == {"recorded": 1}
+
+    def test_middleware__client(self) -> None:
+        """Check the full ASGI request cycle."""
+        client = AsyncClient()
+        client.force_login(User.objects.create_user("Fred"))
+        async_to_sync(client.get)("/")
+        assert UserVisit.objects.count() == 1
+
+    def test_middleware__client__database_callables(self) -> None:
+        """Check that RECORDING_BYPASS and the extractor may use the ORM."""
+
+        def bypass(request: HttpRequest) -> bool:
+            return not User.objects.filter(pk=request.user.pk).exists()
+
+        def extractor(request: HttpRequest) -> dict:
+            return {"users": User.objects.count()}
+
+        client = AsyncClient()
+        client.force_login(User.objects.create_user("Fred"))
+        with mock.patch("user_visit.middleware.RECORDING_BYPASS", bypass):
+            with mock.patch("user_visit.models.REQUEST_CONTEXT_EXTRACTOR", extractor):
+                async_to_sync(client.get)("/")
+        assert UserVisit.objects.get().context == {"users": 1}
@@ -0,0 +1,73 @@
+import datetime
+import importlib
+from unittest import mock
+
+import pytest
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test.utils import CaptureQueriesContext
+
+BEFORE = [("user_visit", "0004_uservisit_browser_uservisit_device_uservisit_os")]
+AFTER = [("user_visit", "0005_uservisit_visit_date")]
+
+set_visit_date_migration = importlib.import_module(
+    "user_visit.migrations.0005_uservisit_visit_date"
+)
+
+
+@pytest.mark.django_db(transaction=True)
+@mock.patch.object(set_visit_date_migration, "BATCH_SIZE", 2)
+def test_set_visit_date() -> None:
+    """Check that the visit_date backfill covers every batch."""
+    executor = MigrationExecutor(connection)
+    executor.migrate(BEFORE)
+    try:
+        apps = executor.loader.project_state(BEFORE).apps
+        user = apps.get_model("auth", "User").objects.create(username="Bob")
+        UserVisit = apps.get_model("user_visit", "UserVisit")
+        timestamps = [
+            datetime.datetime(2020, 7, day, 23, tzinfo=datetime.timezone.utc)
+            for day in range(1, 6)
+        ]
+        for i, timestamp in enumerate(timestamps):
+            UserVisit.objects.create(
+                user=user, timestamp=timestamp, session_key=str(i), hash=str(i)
+            )
+        executor = MigrationExecutor(connection)
+        executor.migrate(AFTER)
+        apps = executor.loader.project_state(AFTER).apps
+        UserVisit = apps.get_model("user_visit", "UserVisit")
+        assert [
+            (uv.timestamp, uv.visit_date) for uv in UserVisit.objects.order_by("pk")
+        ] == [(timestamp, timestamp.date()) for timestamp in timestamps]
+    finally:
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes("user_visit"))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_add_index() -> None:
+    """Check that the index is built (CONCURRENTLY on PostgreSQL)."""
+    before = [("user_visit", "0006_uservisitdailysummary")]
+    after = [("user_visit", "0007_uservisit_user_history_idx")]
+    executor = MigrationExecutor(connection)
+    executor.migrate(before)
+    try:
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, "user_visit_uservisit"
+            )
+        assert "user_visit_user_history_idx" not in constraints
+        executor = MigrationExecutor(connection)
+        with CaptureQueriesContext(connection) as ctx:
+            executor.migrate(after)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, "user_visit_uservisit"
+            )
+        assert "user_visit_user_history_idx" in constraints
+        concurrently = [q for q in ctx.captured_queries if "CONCURRENTLY" in q["sql"]]
+        assert len(concurrently) == (connection.vendor == "postgresql")
+    finally:
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes("user_visit"))
@@ -1,12 +1,29 @@
 import datetime
+from typing import Any, List
 from unittest import mock
 
 import django.db
 import pytest
 from django.contrib.auth.models import User
+from django.http import HttpRequest
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from user_visit.models import UserVisit, parse_remote_addr, parse_ua_string
+from user_visit.models import (
+    UserAgent,
+    UserAgentData,
+    UserVisit,
+    UserVisitDailySummary,
+    decode_cursor,
+    encode_cursor,
+    get_user_agent,
+    parse_remote_addr,
+    parse_session_key,
+    parse_ua_string,
+    parse_user_agent,
+    request_visit_hash,
+    user_agent_data,
+)
 
 from .utils import mock_request
 
@@ -37,6 +54,34 @@ class TestUserVisitFunctions:
         request.headers["User-Agent"] = ua_string
         assert parse_ua_string(request) == ua_string
 
+    def test_session_key(self) -> None:
+        request = mock_request()
+        assert parse_session_key(request) == "test"
+        # e.g. a signed cookie session
+        request.session.session_key = "x" * 162
+        session_key = parse_session_key(request)
+        assert len(session_key) == 40
+        assert session_key == parse_session_key(request)
+
+    def test_user_agent_data(self) -> None:
+        parse_user_agent.cache_clear()
+        data = user_agent_data(TestUserVisit.UA_STRING)
+        assert data == UserAgentData(
+            browser="Chrome 83.0.4103", device="PC", os="Mac OS X 10.15.5"
+        )
+        assert user_agent_data(TestUserVisit.UA_STRING) == data
+        cache_info = parse_user_agent.cache_info()
+        assert cache_info.hits == 1
+        assert cache_info.misses == 1
+
+    def test_user_agent_data__truncated(self) -> None:
+        data = user_agent_data("x" * 300)
+        assert all(len(value) <= 200 for value in data)
+
+
+def foo_context(request: HttpRequest) -> dict:
+    return {"foo": "bar"}
+
 
 class TestUserVisitManager:
     def test_build(self) -> None:
@@ -46,12 +91,23 @@ class TestUserVisitManager:
         assert uv.user == request.user
         assert uv.timestamp == timestamp
         assert uv.date == timestamp.date()
+        assert uv.visit_date == timestamp.date()
         assert uv.session_key == "test"
         assert uv.ua_string == "Chrome 99"
         assert uv.remote_addr == "127.0.0.1"
         assert uv.hash == uv.md5().hexdigest()
         assert uv.uuid is not None
         assert uv.pk is None
+        assert (uv.browser, uv.device, uv.os) == user_agent_data("Chrome 99")
+
+    def test_build__without_user_agent_data(self) -> None:
+        request = mock_request()
+        uv = UserVisit.objects.build(
+            request, timezone.now(), with_user_agent_data=False
+        )
+        assert (uv.browser, uv.device, uv.os) == ("", "", "")
+        uv.update_user_agent_data()
+        assert (uv.browser, uv.device, uv.os) == user_agent_data("Chrome 99")
 
     def test_build__REQUEST_CONTEXT_EXTRACTOR(self) -> None:
         request = mock_request()
@@ -61,6 +117,28 @@ class TestUserVisitManager:
             uv = UserVisit.objects.build(request, timestamp)
         assert uv.context == {"foo": "bar"}
 
+    def test_build__without_context(self) -> None:
+        request = mock_request()
+        extractor = mock.Mock(return_value={"foo": "bar"})
+        with mock.patch("user_visit.models.REQUEST_CONTEXT_EXTRACTOR", extractor):
+            uv = UserVisit.objects.build(request, timezone.now(), with_context=False)
+            assert extractor.call_count == 0
+            assert uv.context == {}
+            uv.update_context()
+            uv.update_context()
+        extractor.assert_called_once_with(request)
+        assert uv.context == {"foo": "bar"}
+        assert uv.context_request is None
+
+    def test_build__REQUEST_CONTEXT_EXTRACTOR__path(self) -> None:
+        request = mock_request()
+        with mock.patch(
+            "user_visit.models.REQUEST_CONTEXT_EXTRACTOR",
+            "tests.test_models.foo_context",
+        ):
+            uv = UserVisit.objects.build(request, timezone.now())
+        assert uv.context == {"foo": "bar"}
+
 
 class TestUserVisit:
     UA_STRING = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.116 Safari/537.36"
@@ -77,8 +155,10 @@ class TestUserVisit:
         uv = UserVisit.objects.build(request, timestamp)
         uv.hash = None
         uv.context = {"foo": "bar"}
+        uv.visit_date = None
         uv.save()
         assert uv.hash == uv.md5().hexdigest()
+        assert uv.visit_date == timestamp.date()
 
     @pytest.mark.django_db
     def test_unique(self) -> None:
@@ -148,5 +228,248 @@ class TestUserVisit:
         assert uv.md5().hexdigest() != h1
         uv.remote_addr = "127.0.0.1"
 
-        uv.user.id = 2
+        uv.user_id = 2
         assert uv.md5().hexdigest() != h1
+
+    @pytest.mark.django_db
+    def test_md5__no_user_query(self) -> None:
+        """Check that hashing a visit does not fetch the user."""
+        user = User.objects.create(username="Bob")
+        UserVisit.objects.create(
+            user=user,
+            session_key="test",
+            ua_string="Chrome",
+            remote_addr="127.0.0.1",
+            timestamp=timezone.now(),
+        )
+        uv = UserVisit.objects.get()
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            assert uv.md5().hexdigest() == uv.hash
+        assert len(ctx.captured_queries) == 0
+
+    def test_request_visit_hash(self) -> None:
+        request = mock_request()
+        request.user.pk = 1
+        timestamp = timezone.now()
+        uv = UserVisit.objects.build(request, timestamp)
+        assert request_visit_hash(request, timestamp) == uv.hash
+
+
+@pytest.mark.django_db
+class TestUserVisitDailySummary:
+    def create_visit(self, user: User, session_key: str, ua_string: str) -> UserVisit:
+        return UserVisit.objects.create(
+            user=user,
+            session_key=session_key,
+            ua_string=ua_string,
+            remote_addr="127.0.0.1",
+            timestamp=timezone.now(),
+            browser=user_agent_data(ua_string).browser,
+            device=user_agent_data(ua_string).device,
+            os=user_agent_data(ua_string).os,
+        )
+
+    def get_counts(self) -> dict:
+        return {
+            (s.dimension, s.value): (s.visit_count, s.user_count)
+            for s in UserVisitDailySummary.objects.all()
+        }
+
+    def test_summarise(self) -> None:
+        bob = User.objects.create(username="Bob")
+        alice = User.objects.create(username="Alice")
+        self.create_visit(bob, "1", TestUserVisit.UA_STRING)
+        self.create_visit(bob, "2", "Chrome")
+        self.create_visit(alice, "3", TestUserVisit.UA_STRING)
+        today = timezone.now().date()
+        assert UserVisitDailySummary.objects.summarise(today) == 7
+        counts = self.get_counts()
+        assert counts[("all", "")] == (3, 2)
+        assert counts[("browser", "Chrome 83.0.4103")] == (2, 2)
+        assert counts[("browser", "Other")] == (1, 1)
+        assert counts[("os", "Mac OS X 10.15.5")] == (2, 2)
+        # summarising again replaces the rows
+        assert UserVisitDailySummary.objects.summarise(today) == 7
+        assert UserVisitDailySummary.objects.count() == 7
+
+    def test_summarise__no_visits(self) -> None:
+        assert UserVisitDailySummary.objects.summarise(timezone.now().date()) == 0
+
+    def test_increment(self) -> None:
+        bob = User.objects.create(username="Bob")
+        UserVisitDailySummary.objects.increment(
+            self.create_visit(bob, "1", TestUserVisit.UA_STRING)
+        )
+        UserVisitDailySummary.objects.increment(self.create_visit(bob, "2", "Chrome"))
+        alice = User.objects.create(username="Alice")
+        UserVisitDailySummary.objects.increment(
+            self.create_visit(alice, "3", TestUserVisit.UA_STRING)
+        )
+        incremented = self.get_counts()
+        UserVisitDailySummary.objects.summarise(timezone.now().date())
+        assert incremented == self.get_counts()
+
+    def test_increment__concurrent(self) -> None:
+        """Check concurrent first visits of the day still count the user."""
+        bob = User.objects.create(username="Bob")
+        # both visits are saved before either is added to the summary
+        visits = [self.create_visit(bob, str(i), "Chrome") for i in range(2)]
+        for uv in reversed(visits):
+            UserVisitDailySummary.objects.increment(uv)
+        assert self.get_counts()[("all", "")] == (2, 1)
+
+    @mock.patch("user_visit.models.USER_AGENT_TABLE", True)
+    def test_summarise__user_agent_table(self) -> None:
+        get_user_agent.cache_clear()
+        bob = User.objects.create(username="Bob")
+        alice = User.objects.create(username="Alice")
+        self.create_visit(bob, "1", TestUserVisit.UA_STRING)
+        self.create_visit(bob, "2", "Chrome")
+        # linked visits have blank browser / device / os fields
+        for session_key, user in (("3", alice), ("4", bob)):
+            uv = UserVisit(
+                user=user, session_key=session_key, ua_string=TestUserVisit.UA_STRING
+            )
+            uv.link_user_agent()
+            uv.save()
+            UserVisitDailySummary.objects.increment(uv)
+        incremented = self.get_counts()
+        UserVisitDailySummary.objects.summarise(timezone.now().date())
+        counts = self.get_counts()
+        assert counts[("browser", "Chrome 83.0.4103")] == (3, 2)
+        assert counts[("browser", "Other")] == (1, 1)
+        assert ("browser", "") not in counts
+        # only the linked visits were incremented - bob had already visited
+        # with the same (unlinked) browser
+        assert incremented[("browser", "Chrome 83.0.4103")] == (2, 1)
+
+
+@pytest.mark.django_db
+class TestUserAgent:
+    @pytest.fixture(autouse=True)
+    def clear_cache(self) -> None:
+        get_user_agent.cache_clear()
+
+    def test_get_for_ua_string(self) -> None:
+        user_agent = UserAgent.objects.get_for_ua_string(TestUserVisit.UA_STRING)
+        assert user_agent.ua_string == TestUserVisit.UA_STRING
+        assert user_agent.user_agent_data == user_agent_data(TestUserVisit.UA_STRING)
+        assert str(user_agent) == "Chrome 83.0.4103 / PC / Mac OS X 10.15.5"
+        assert UserAgent.objects.get_for_ua_string(TestUserVisit.UA_STRING) == (
+            user_agent
+        )
+        assert UserAgent.objects.count() == 1
+
+    def test_get_user_agent__cached(self) -> None:
+        user_agent = get_user_agent("Chrome")
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            assert get_user_agent("Chrome") == user_agent
+        assert not ctx.captured_queries
+
+    def test_link_user_agent(self) -> None:
+        user = User.objects.create(username="Bob")
+        uv = UserVisit(user=user, session_key="1", ua_string=TestUserVisit.UA_STRING)
+        assert uv.get_user_agent_data() == ("", "", "")
+        uv.link_user_agent()
+        uv.save()
+        uv = UserVisit.objects.get()
+        assert (uv.browser, uv.device, uv.os) == ("", "", "")
+        assert uv.get_user_agent_data() == user_agent_data(TestUserVisit.UA_STRING)
+
+
+@pytest.mark.django_db
+class TestUserVisitQuerySet:
+    START = datetime.datetime(2020, 7, 1, 12, tzinfo=datetime.timezone.utc)
+
+    def create_visits(self, user: User, count: int, **kwargs: Any) -> List[UserVisit]:
+        return [
+            UserVisit.objects.create(
+                user=user,
+                session_key=str(i),
+                timestamp=self.START + datetime.timedelta(hours=i),
+                **kwargs,
+            )
+            for i in range(count)
+        ]
+
+    def test_for_user__between(self) -> None:
+        bob = User.objects.create(username="Bob")
+        alice = User.objects.create(username="Alice")
+        self.create_visits(bob, 30)
+        self.create_visits(alice, 5)
+        visits = UserVisit.objects.for_user(bob)
+        assert visits.count() == 30
+        assert (
+            bob.user_visits.between(
+                self.START, self.START + datetime.timedelta(hours=3)
+            ).count()
+            == 3
+        )
+        # dates are inclusive - 12:00 on the 1st to 17:00 on the 2nd
+        assert (
+            visits.between(datetime.date(2020, 7, 1), datetime.date(2020, 7, 2)).count()
+            == 30
+        )
+
+    def test_keyset_page(self) -> None:
+        bob = User.objects.create(username="Bob")
+        visits = self.create_visits(bob, 7)
+        # two visits with the same timestamp are ordered by id
+        visits.append(
+            UserVisit.objects.create(
+                user=bob, session_key="tie", timestamp=visits[3].timestamp
+            )
+        )
+        expected = sorted(visits, key=lambda v: (v.timestamp, v.pk), reverse=True)
+        pages = []
+        cursor = None
+        while True:
+            page = UserVisit.objects.for_user(bob).keyset_page(cursor, size=3)
+            pages.append(page.visits)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        assert [len(p) for p in pages] == [3, 3, 2]
+        assert [v for p in pages for v in p] == expected
+
+    def test_keyset_page__exact(self) -> None:
+        bob = User.objects.create(username="Bob")
+        self.create_visits(bob, 3)
+        page = UserVisit.objects.keyset_page(size=3)
+        assert len(page.visits) == 3
+        assert page.next_cursor is None
+
+    def test_keyset_page__invalid_cursor(self) -> None:
+        with pytest.raises(ValueError):
+            UserVisit.objects.keyset_page("not-a-cursor")
+
+    def test_cursor(self) -> None:
+        cursor = encode_cursor(self.START, 123)
+        assert decode_cursor(cursor) == (self.START, 123)
+
+    def test_latest_per_device(self) -> None:
+        bob = User.objects.create(username="Bob")
+        alice = User.objects.create(username="Alice")
+        chrome = self.create_visits(bob, 3, ua_string="Chrome")
+        firefox = self.create_visits(bob, 2, ua_string="Firefox")
+        alices = self.create_visits(alice, 2, ua_string="Chrome")
+        with CaptureQueriesContext(django.db.connection) as ctx:
+            latest = list(UserVisit.objects.latest_per_device())
+        assert len(ctx.captured_queries) == 1
+        # newest first, ties on timestamp broken by id
+        assert latest == [chrome[2], alices[1], firefox[1]]
+        assert list(UserVisit.objects.for_user(bob).latest_per_device()) == [
+            chrome[2],
+            firefox[1],
+        ]
+
+    def test_distinct_ips(self) -> None:
+        bob = User.objects.create(username="Bob")
+        self.create_visits(bob, 3, remote_addr="1.1.1.1")
+        self.create_visits(bob, 1, remote_addr="2.2.2.2")
+        ips = list(UserVisit.objects.for_user(bob).distinct_ips())
+        assert [ip["remote_addr"] for ip in ips] == ["1.1.1.1", "2.2.2.2"]
+        assert ips[0]["visits"] == 3
+        assert ips[0]["first_seen"] == self.START
+        assert ips[0]["last_seen"] == self.START + datetime.timedelta(hours=2)
+        assert ips[1]["visits"] == 1
@@ -0,0 +1,312 @@
+import datetime
+from io import StringIO
+from typing import Optional
+from unittest import mock
+
+import pytest
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from freezegun import freeze_time
+
+from user_visit import partitioning
+from user_visit.admin import estimated_count
+from user_visit.models import UserVisit
+from user_visit.partitioning import (
+    Partition,
+    add_months,
+    expired_partitions,
+    months_to_create,
+    parse_partition,
+    partition_name,
+)
+
+requires_postgres = pytest.mark.skipif(
+    connection.vendor != "postgresql", reason="requires PostgreSQL"
+)
+
+JAN = datetime.date(2024, 1, 1)
+FEB = datetime.date(2024, 2, 1)
+MAR = datetime.date(2024, 3, 1)
+MAY = datetime.date(2024, 5, 1)
+
+
+@pytest.mark.parametrize(
+    "date,months,result",
+    (
+        (datetime.date(2024, 1, 15), 0, JAN),
+        (datetime.date(2024, 1, 31), 1, FEB),
+        (datetime.date(2024, 11, 30), 2, datetime.date(2025, 1, 1)),
+        (JAN, -1, datetime.date(2023, 12, 1)),
+    ),
+)
+def test_add_months(date: datetime.date, months: int, result: datetime.date) -> None:
+    assert add_months(date, months) == result
+
+
+def test_partition_name() -> None:
+    assert partition_name(FEB) == "user_visit_uservisit_p2024_02"
+
+
+@pytest.mark.parametrize(
+    "bound,start,end",
+    (
+        ("FOR VALUES FROM ('2024-01-01') TO ('2024-02-01')", JAN, FEB),
+        ("FOR VALUES FROM (MINVALUE) TO ('2024-02-01')", None, FEB),
+        ("DEFAULT", None, None),
+    ),
+)
+def test_parse_partition(
+    bound: str, start: Optional[datetime.date], end: Optional[datetime.date]
+) -> None:
+    assert parse_partition("p", bound) == Partition("p", start, end)
+
+
+def test_months_to_create() -> None:
+    partitions = [
+        Partition("legacy", None, FEB),
+        Partition("p2024_02", FEB, MAR),
+        Partition("default", None, None),
+    ]
+    today = datetime.date(2024, 1, 20)
+    assert months_to_create(partitions, today, 3) == [
+        MAR,
+        datetime.date(2024, 4, 1),
+    ]
+    assert months_to_create([], today, 0) == [JAN]
+
+
+def test_expired_partitions() -> None:
+    partitions = [
+        Partition("legacy", None, FEB),
+        Partition("p2024_02", FEB, MAR),
+        Partition("default", None, None),
+    ]
+    assert expired_partitions(partitions, datetime.date(2024, 2, 29)) == [partitions[0]]
+    assert expired_partitions(partitions, MAR) == partitions[:2]
+
+
+def test_create_partition_sql() -> None:
+    assert partitioning.create_partition_sql(connection, JAN) == (
+        'CREATE TABLE IF NOT EXISTS "user_visit_uservisit_p2024_01" '
+        'PARTITION OF "user_visit_uservisit" FOR VALUES '
+        "FROM ('2024-01-01') TO ('2024-02-01')"
+    )
+
+
+def test_move_from_default_sql() -> None:
+    statements = partitioning.move_from_default_sql(connection, JAN)
+    assert statements[0].endswith('DETACH PARTITION "user_visit_uservisit_default"')
+    assert statements[1] == partitioning.create_partition_sql(connection, JAN)
+    assert statements[2] == (
+        'INSERT INTO "user_visit_uservisit_p2024_01" '
+        'SELECT * FROM "user_visit_uservisit_default" '
+        "WHERE visit_date >= '2024-01-01' AND visit_date < '2024-02-01'"
+    )
+    assert statements[3].startswith('DELETE FROM "user_visit_uservisit_default"')
+    assert statements[4].endswith('"user_visit_uservisit_default" DEFAULT')
+
+
+def test_prepare_sql() -> None:
+    statements = partitioning.prepare_sql(connection, FEB)
+    assert "visit_date < '2024-02-01'" in statements[0]
+    assert statements[1].endswith(
+        'VALIDATE CONSTRAINT "user_visit_uservisit_partition_check"'
+    )
+    # a matching unique index for each unique column, plus the partition key
+    unique = [s for s in statements if "UNIQUE INDEX CONCURRENTLY" in s]
+    assert [s.split("(")[1] for s in unique] == [
+        '"id", "visit_date")',
+        '"uuid", "visit_date")',
+        '"hash", "visit_date")',
+    ]
+
+
+def test_convert_sql() -> None:
+    statements = partitioning.convert_sql(connection, FEB)
+    assert statements[0] == (
+        'ALTER TABLE "user_visit_uservisit" RENAME TO "user_visit_uservisit_legacy"'
+    )
+    assert (
+        'CREATE TABLE "user_visit_uservisit" (LIKE "user_visit_uservisit_legacy" '
+        "INCLUDING DEFAULTS) PARTITION BY RANGE (visit_date)"
+    ) in statements
+    assert any('PRIMARY KEY ("id", "visit_date")' in s for s in statements)
+    assert any('UNIQUE ("hash", "visit_date")' in s for s in statements)
+    assert any("user_visit_user_history_idx" in s for s in statements)
+    assert any('FOREIGN KEY ("user_id")' in s for s in statements)
+    assert statements[-1] == (
+        'ALTER TABLE "user_visit_uservisit" ATTACH PARTITION '
+        "\"user_visit_uservisit_legacy\" FOR VALUES FROM (MINVALUE) TO ('2024-02-01')"
+    )
+
+
+@pytest.mark.django_db
+class TestPartitionUserVisits:
+    def test_not_postgres(self) -> None:
+        if connection.vendor == "postgresql":
+            pytest.skip("requires a database other than PostgreSQL")
+        with pytest.raises(CommandError):
+            call_command("partition_user_visits")
+
+    @freeze_time("2024-01-20")
+    @mock.patch.object(connection, "vendor", "postgresql")
+    @mock.patch("user_visit.partitioning.is_partitioned", lambda c: False)
+    def test_convert__dry_run(self) -> None:
+        out = StringIO()
+        with mock.patch("user_visit.partitioning.list_partitions") as list_partitions:
+            call_command(
+                "partition_user_visits", convert=True, dry_run=True, stdout=out
+            )
+        assert list_partitions.call_count == 0
+        sql = out.getvalue()
+        assert "ATTACH PARTITION" in sql
+        # January is in the legacy partition
+        assert "user_visit_uservisit_p2024_01" not in sql
+        assert "user_visit_uservisit_p2024_02" in sql
+        assert "user_visit_uservisit_p2024_04" in sql
+        assert "user_visit_uservisit_p2024_05" not in sql
+        assert "DROP TABLE" not in sql
+        assert sql.splitlines()[-1] == (
+            'CREATE TABLE IF NOT EXISTS "user_visit_uservisit_default" '
+            'PARTITION OF "user_visit_uservisit" DEFAULT;'
+        )
+
+    @freeze_time("2024-04-10")
+    @mock.patch.object(connection, "vendor", "postgresql")
+    @mock.patch("user_visit.partitioning.is_partitioned", lambda c: True)
+    @mock.patch("user_visit.partitioning.has_default_rows", lambda c, m: False)
+    @pytest.mark.parametrize("detach,sql", ((False, "DROP TABLE"), (True, "DETACH")))
+    def test_expire__dry_run(self, detach: bool, sql: str) -> None:
+        partitions = [
+            Partition("user_visit_uservisit_legacy", None, FEB),
+            Partition("user_visit_uservisit_p2024_02", FEB, MAR),
+            Partition("user_visit_uservisit_p2024_03", MAR, add_months(MAR, 1)),
+            Partition("user_visit_uservisit_default", None, None),
+        ]
+        out = StringIO()
+        with mock.patch(
+            "user_visit.partitioning.list_partitions", return_value=partitions
+        ):
+            call_command(
+                "partition_user_visits",
+                days=40,
+                months=1,
+                detach=detach,
+                dry_run=True,
+                stdout=out,
+            )
+        lines = out.getvalue().splitlines()
+        assert len(lines) == 4
+        assert "user_visit_uservisit_p2024_04" in lines[0]
+        assert "user_visit_uservisit_p2024_05" in lines[1]
+        assert sql in lines[2] and "legacy" in lines[2]
+        assert sql in lines[3] and "p2024_02" in lines[3]
+
+    @freeze_time("2024-04-10")
+    @mock.patch.object(connection, "vendor", "postgresql")
+    @mock.patch("user_visit.partitioning.is_partitioned", lambda c: True)
+    def test_default__dry_run(self) -> None:
+        partitions = [
+            Partition("user_visit_uservisit_p2024_04", add_months(MAR, 1), MAY),
+            Partition("user_visit_uservisit_default", None, None),
+        ]
+        out = StringIO()
+        with mock.patch(
+            "user_visit.partitioning.list_partitions", return_value=partitions
+        ), mock.patch(
+            "user_visit.partitioning.has_default_rows", return_value=True
+        ) as has_default_rows:
+            call_command(
+                "partition_user_visits", days=None, months=1, dry_run=True, stdout=out
+            )
+        has_default_rows.assert_called_once_with(connection, MAY)
+        # May's visits are moved out of the DEFAULT partition
+        assert out.getvalue().splitlines() == [
+            f"{sql};" for sql in partitioning.move_from_default_sql(connection, MAY)
+        ]
+
+    @mock.patch.object(connection, "vendor", "postgresql")
+    @mock.patch("user_visit.partitioning.is_partitioned", lambda c: False)
+    def test_not_partitioned(self) -> None:
+        with pytest.raises(CommandError):
+            call_command("partition_user_visits", dry_run=True)
+
+    @mock.patch.object(connection, "vendor", "postgresql")
+    @mock.patch("user_visit.partitioning.is_partitioned", lambda c: True)
+    def test_convert__already_partitioned(self) -> None:
+        with pytest.raises(CommandError):
+            call_command("partition_user_visits", convert=True, dry_run=True)
+
+
+@requires_postgres
+@pytest.mark.django_db(transaction=True)
+def test_partitioned_table() -> None:
+    """
+    Convert the test database table, and check recording and expiry.
+
+    The table is left partitioned for the rest of the test run.
+
+    """
+    user = User.objects.create(username="Bob")
+    old = UserVisit.objects.create(
+        user=user,
+        session_key="old",
+        timestamp=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+    )
+    call_command("partition_user_visits", convert=True, days=None, stdout=StringIO())
+    assert partitioning.is_partitioned(connection)
+    partitions = partitioning.list_partitions(connection)
+    assert partitions[0].name == "user_visit_uservisit_legacy"
+    assert partitions[-1] == Partition("user_visit_uservisit_default", None, None)
+    assert len(partitions) == 5
+    # new visits get new ids, and the visit hash is still unique
+    new = UserVisit.objects.create(user=user, session_key="new")
+    assert new.pk > old.pk
+    with pytest.raises(IntegrityError), transaction.atomic():
+        UserVisit.objects.create(user=user, session_key="new", timestamp=new.timestamp)
+    assert list(UserVisit.objects.between(old.visit_date, old.visit_date)) == [old]
+    # visits for a month with no partition are recorded in the DEFAULT
+    # partition, and moved once the month's partition is created
+    month = add_months(partitions[-2].start, 2)
+    future = UserVisit.objects.create(
+        user=user,
+        session_key="future",
+        timestamp=datetime.datetime.combine(
+            month, datetime.time(12), tzinfo=datetime.timezone.utc
+        ),
+    )
+    call_command("partition_user_visits", months=6, days=None, stdout=StringIO())
+    assert partition_name(month) in [
+        p.name for p in partitioning.list_partitions(connection)
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT id FROM "{partition_name(month)}"')  # noqa: S608
+        assert cursor.fetchall() == [(future.pk,)]
+        cursor.execute('SELECT COUNT(*) FROM "user_visit_uservisit_default"')
+        assert cursor.fetchone() == (0,)
+    # once all the visits in the legacy partition have expired it is dropped
+    cutover = partitions[1].start
+    with freeze_time(cutover + datetime.timedelta(days=1)):
+        call_command("partition_user_visits", days=1, stdout=StringIO())
+    partitions = partitioning.list_partitions(connection)
+    assert partitions[0].start == cutover
+    assert list(UserVisit.objects.all()) == [future]
+
+
+@requires_postgres
+@pytest.mark.django_db(transaction=True)
+def test_partitioned_table__estimated_count() -> None:
+    """Check the admin row estimate sums the estimates of the partitions."""
+    if not partitioning.is_partitioned(connection):
+        call_command(
+            "partition_user_visits", convert=True, days=None, stdout=StringIO()
+        )
+    user = User.objects.create(username="Bob")
+    for i in range(3):
+        UserVisit.objects.create(user=user, session_key=str(i))
+    # autovacuum analyzes the partitions, never the partitioned table itself
+    with connection.cursor() as cursor:
+        for partition in partitioning.list_partitions(connection):
+            cursor.execute(f'ANALYZE "{partition.name}"')
+    assert estimated_count(UserVisit.objects.all()) == UserVisit.objects.count()
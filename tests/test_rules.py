@@ -0,0 +1,39 @@
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory
+
+from user_visit.rules import ExclusionRules
+
+
+@pytest.mark.parametrize(
+    "method,path,excluded",
+    (
+        ("GET", "/", False),
+        ("GET", "/api/poll/", True),
+        ("GET", "/api/poll/123", True),
+        ("GET", "/api/polls", False),
+        ("GET", "/api/v2/status/", True),
+        ("GET", "/api/vX/status/", False),
+        ("GET", "/x/api/v2/status/", False),
+        ("OPTIONS", "/", True),
+        ("HEAD", "/", True),
+    ),
+)
+def test_excludes(method: str, path: str, excluded: bool) -> None:
+    rules = ExclusionRules(
+        paths=["/api/poll/", r"^/api/v\d+/status/"], methods=["options", "HEAD"]
+    )
+    request = RequestFactory().generic(method, path)
+    assert rules.excludes(request) == excluded
+
+
+def test_no_rules() -> None:
+    rules = ExclusionRules()
+    assert not rules
+    assert not rules.excludes(RequestFactory().get("/"))
+    assert ExclusionRules(methods=["HEAD"])
+
+
+def test_invalid_regex() -> None:
+    with pytest.raises(ImproperlyConfigured):
+        ExclusionRules(paths=["^/api/(["])
@@ -0,0 +1,98 @@
+import threading
+from typing import List
+from unittest import mock
+
+from user_visit.models import UserVisit
+from user_visit.writers import BackgroundWriter, BatchWriter
+
+
+class TestBackgroundWriter:
+    def test_submit(self) -> None:
+        written: List[UserVisit] = []
+        writer = BackgroundWriter(written.append, max_queue_size=10)
+        uv = UserVisit(hash="foo")
+        assert writer.submit(uv) is True
+        assert writer.flush(timeout=1)
+        assert written == [uv]
+        assert writer.stats() == {
+            "queued": 0,
+            "submitted": 1,
+            "written": 1,
+            "dropped": 0,
+            "errors": 0,
+        }
+
+    def test_submit__queue_full(self) -> None:
+        started = threading.Event()
+        release = threading.Event()
+
+        def handler(uv: UserVisit) -> None:
+            started.set()
+            release.wait(1)
+
+        writer = BackgroundWriter(handler, max_queue_size=1)
+        # first visit is taken by the worker thread and blocks it
+        writer.submit(UserVisit(hash="foo"))
+        assert started.wait(1)
+        assert writer.submit(UserVisit(hash="bar")) is True
+        assert writer.submit(UserVisit(hash="baz")) is False
+        assert writer.dropped == 1
+        release.set()
+        assert writer.flush(timeout=1)
+        assert writer.written == 2
+
+    def test_handler_error(self) -> None:
+        handler = mock.Mock(side_effect=Exception("boom"))
+        writer = BackgroundWriter(handler, max_queue_size=10)
+        writer.submit(UserVisit(hash="foo"))
+        writer.submit(UserVisit(hash="bar"))
+        assert writer.flush(timeout=1)
+        assert writer.errors == 2
+        assert writer.written == 0
+
+    def test_flush__timeout(self) -> None:
+        release = threading.Event()
+        writer = BackgroundWriter(lambda uv: release.wait(1), max_queue_size=10)
+        writer.submit(UserVisit(hash="foo"))
+        assert writer.flush(timeout=0.01) is False
+        release.set()
+        assert writer.flush(timeout=1) is True
+
+
+class TestBatchWriter:
+    def test_batch_size(self) -> None:
+        batches: List[List[UserVisit]] = []
+        writer = BatchWriter(
+            batches.append, max_queue_size=10, batch_size=2, flush_interval=1
+        )
+        for h in ("foo", "bar", "baz", "qux"):
+            writer.submit(UserVisit(hash=h))
+        assert writer.flush(timeout=2)
+        assert [[uv.hash for uv in b] for b in batches] == [
+            ["foo", "bar"],
+            ["baz", "qux"],
+        ]
+        stats = writer.stats()
+        assert stats["written"] == 4
+        assert stats["flushes"] == 2
+        assert stats["max_flush_size"] == 2
+        assert stats["avg_flush_size"] == 2
+
+    def test_flush_interval(self) -> None:
+        batches: List[List[UserVisit]] = []
+        writer = BatchWriter(
+            batches.append, max_queue_size=10, batch_size=100, flush_interval=0.01
+        )
+        writer.submit(UserVisit(hash="foo"))
+        assert writer.flush(timeout=1)
+        assert len(batches) == 1
+        assert writer.last_flush_size == 1
+
+    def test_handler_error(self) -> None:
+        handler = mock.Mock(side_effect=Exception("boom"))
+        writer = BatchWriter(handler, max_queue_size=10, batch_size=2, flush_interval=1)
+        writer.submit(UserVisit(hash="foo"))
+        writer.submit(UserVisit(hash="bar"))
+        assert writer.flush(timeout=1)
+        assert writer.errors == 2
+        assert writer.flushes == 1
@@ -1,12 +1,117 @@
+from __future__ import annotations
+
+from typing import Sequence
+
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.http import HttpRequest, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _lazy
+
+from .export import stream_export
+from .models import UserAgent, UserVisit, UserVisitDailySummary
+from .settings import ADMIN_SCALABLE
+
+# Below this many (estimated) rows an exact COUNT(*) is cheap enough
+EXACT_COUNT_THRESHOLD = 100_000
+
+
+def estimated_count(queryset: QuerySet) -> int | None:
+    """
+    Return the planner's estimate of the number of rows in the table.
+
+    Only supported on PostgreSQL (pg_class.reltuples) - returns None for
+    other databases, or if the table has never been analyzed. The estimate
+    for a partitioned table (see user_visit.partitioning) is the sum of its
+    partitions' estimates, as the parent itself holds no rows.
+
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    table = queryset.model._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT relkind, reltuples FROM pg_class WHERE oid = %s::regclass",
+            [table],
+        )
+        row = cursor.fetchone()
+        reltuples = row[1] if row else None
+        if row and row[0] == "p":
+            # partitions that have never been analyzed are -1
+            cursor.execute(
+                "SELECT SUM(c.reltuples) FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = %s::regclass AND c.reltuples >= 0",
+                [table],
+            )
+            reltuples = cursor.fetchone()[0]
+    if reltuples is None or reltuples < 0:
+        return None
+    return int(reltuples)
+
+
+def export_response(queryset: QuerySet, fmt: str) -> StreamingHttpResponse:
+    """Return a streaming download of the visits in queryset."""
+    content_type = {"csv": "text/csv", "jsonl": "application/jsonl"}[fmt]
+    filename = f"user_visits_{timezone.now():%Y%m%d%H%M%S}.{fmt}"
+    response = StreamingHttpResponse(
+        stream_export(queryset, fmt), content_type=content_type
+    )
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+@admin.action(description=_lazy("Export selected visits as CSV"))
+def export_csv(
+    modeladmin: admin.ModelAdmin, request: HttpRequest, queryset: QuerySet
+) -> StreamingHttpResponse:
+    return export_response(queryset, "csv")
 
-from .models import UserVisit
+
+@admin.action(description=_lazy("Export selected visits as JSON lines"))
+def export_jsonl(
+    modeladmin: admin.ModelAdmin, request: HttpRequest, queryset: QuerySet
+) -> StreamingHttpResponse:
+    return export_response(queryset, "jsonl")
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that avoids COUNT(*) over an unfiltered large table.
+
+    The total for an unfiltered queryset is taken from the planner's
+    estimate, falling back to an exact count for small tables, filtered
+    querysets and databases that have no estimate.
+
+    """
+
+    @cached_property
+    def count(self) -> int:
+        queryset = self.object_list
+        if isinstance(queryset, QuerySet) and not queryset.query.where:
+            estimate = estimated_count(queryset)
+            if estimate is not None and estimate >= EXACT_COUNT_THRESHOLD:
+                return estimate
+        return super().count
 
 
 class UserVisitAdmin(admin.ModelAdmin):
-    list_display = ("timestamp", "user", "session_key", "remote_addr", "user_agent")
+    list_display = (
+        "timestamp",
+        "user",
+        "session_key",
+        "remote_addr",
+        "browser_name",
+        "device_type",
+        "os_name",
+    )
+    list_select_related = ("user", "agent")
     list_filter = ("timestamp",)
-    search_fields = (
+    search_fields: Sequence[str] = (
         "user__first_name",
         "user__last_name",
         "user__username",
@@ -23,10 +128,80 @@ class UserVisitAdmin(admin.ModelAdmin):
         "os",
         "browser",
         "ua_string",
+        "agent",
         "context",
         "created_at",
     )
     ordering = ("-timestamp",)
+    actions = (export_csv, export_jsonl)
+
+    # browser / device / os are read from the linked UserAgent, if any
+    @admin.display(description=_lazy("Browser"), ordering="browser")
+    def browser_name(self, obj: UserVisit) -> str:
+        return obj.get_user_agent_data().browser
+
+    @admin.display(description=_lazy("Device type"), ordering="device")
+    def device_type(self, obj: UserVisit) -> str:
+        return obj.get_user_agent_data().device
+
+    @admin.display(description=_lazy("Operating System"), ordering="os")
+    def os_name(self, obj: UserVisit) -> str:
+        return obj.get_user_agent_data().os
+
+
+class ScalableUserVisitAdmin(UserVisitAdmin):
+    """UserVisit admin for very large tables (see USER_VISIT_ADMIN_SCALABLE)."""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    date_hierarchy = "visit_date"
+    # prefix / exact matches only - no leading wildcard LIKE scans
+    search_fields = (
+        "^user__username",
+        "=user__email",
+        "=session_key",
+        "=remote_addr",
+        "=hash",
+    )
+
+
+admin.site.register(
+    UserVisit, ScalableUserVisitAdmin if ADMIN_SCALABLE else UserVisitAdmin
+)
+
+
+class UserAgentAdmin(admin.ModelAdmin):
+    list_display = ("browser", "device", "os", "created_at")
+    list_filter = ("device",)
+    search_fields = ("=hash", "browser", "os", "ua_string")
+    readonly_fields = (
+        "hash",
+        "ua_string",
+        "browser",
+        "device",
+        "os",
+        "created_at",
+    )
+    ordering = ("browser", "os")
+
+
+admin.site.register(UserAgent, UserAgentAdmin)
+
+
+class UserVisitDailySummaryAdmin(admin.ModelAdmin):
+    list_display = ("date", "dimension", "value", "visit_count", "user_count")
+    list_filter = ("dimension",)
+    date_hierarchy = "date"
+    search_fields = ("value",)
+    readonly_fields = (
+        "date",
+        "dimension",
+        "value",
+        "visit_count",
+        "user_count",
+        "updated_at",
+    )
+    ordering = ("-date", "dimension", "-visit_count")
 
 
-admin.site.register(UserVisit, UserVisitAdmin)
+admin.site.register(UserVisitDailySummary, UserVisitDailySummaryAdmin)
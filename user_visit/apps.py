@@ -5,3 +5,14 @@ class UserVisitAppConfig(AppConfig):
     name = "user_visit"
     verbose_name = "User visit log"
     default_auto_field = "django.db.models.AutoField"
+
+    def ready(self) -> None:
+        from .settings import DETECTION_ON_RECORD
+
+        if DETECTION_ON_RECORD:
+            from .detection import on_visit_recorded
+            from .signals import visit_recorded
+
+            visit_recorded.connect(
+                on_visit_recorded, dispatch_uid="user_visit.detection"
+            )
@@ -0,0 +1,143 @@
+"""
+Helpers for bulk operations over very large UserVisit tables.
+
+Functions in this module may be run in spawned worker processes, so it
+must be importable before Django has been set up - models are imported
+inside the functions that use them.
+
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
+
+import django
+from django.apps import apps
+
+if TYPE_CHECKING:
+    from django.db.models import QuerySet
+
+UPDATE_FIELDS = ["browser", "device", "os"]
+
+
+def keyset_ranges(
+    queryset: QuerySet,
+    size: int,
+    after_pk: Optional[int] = None,
+    until_pk: Optional[int] = None,
+) -> Iterator[Tuple[Optional[int], int]]:
+    """
+    Yield (after_pk, last_pk) ranges each containing `size` matching rows.
+
+    Uses keyset pagination (pk > last seen pk) so that each page is an
+    index range scan however far through the table it is. Ranges are
+    generated lazily - one small query per range.
+
+    """
+    while True:
+        page = queryset.order_by("pk")
+        if after_pk is not None:
+            page = page.filter(pk__gt=after_pk)
+        if until_pk is not None:
+            page = page.filter(pk__lte=until_pk)
+        pks: List[int] = list(page.values_list("pk", flat=True)[:size])
+        if not pks:
+            return
+        yield after_pk, pks[-1]
+        after_pk = pks[-1]
+
+
+class RateLimiter:
+    """Sleep as required to keep the average rate below max_per_second."""
+
+    def __init__(self, max_per_second: Optional[float]) -> None:
+        self.max_per_second = max_per_second
+        self.count = 0
+        self.start = time.monotonic()
+
+    def throttle(self, count: int) -> None:
+        """Record count items processed, and sleep if ahead of the limit."""
+        self.count += count
+        if not self.max_per_second:
+            return
+        ahead = self.count / self.max_per_second - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    """Return the contents of a checkpoint file (empty if missing)."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, data: Dict[str, Any]) -> None:
+    """Atomically (over)write a checkpoint file."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def init_worker() -> None:
+    """Set up Django in a spawned worker process."""
+    if not apps.ready:
+        django.setup()
+
+
+def get_user_agent_backfill(force: bool, link: bool = False) -> QuerySet:
+    """
+    Return visits whose browser, device and os fields need updating.
+
+    Visits linked to a UserAgent are skipped unless force is True.
+
+    If link is True, return the visits that are not linked to a UserAgent.
+
+    """
+    from django.db.models import Q
+
+    from .models import UserVisit
+
+    visits = UserVisit.objects.all()
+    if force:
+        return visits
+    if link:
+        return visits.filter(agent__isnull=True)
+    # linked visits store their UA data on the UserAgent, and keep the
+    # fields blank
+    return visits.filter(Q(browser="") | Q(device="") | Q(os=""), agent__isnull=True)
+
+
+def update_user_agent_chunk(
+    force: bool, pk_range: Tuple[Optional[int], int], link: bool = False
+) -> int:
+    """
+    Update browser, device and os of visits with after_pk < pk <= last_pk.
+
+    If link is True, link the visits to their UserAgent instead, and blank
+    the (now redundant) browser, device and os fields.
+
+    """
+    from .models import UserVisit, user_agent_data
+
+    after_pk, last_pk = pk_range
+    visits = get_user_agent_backfill(force, link).filter(pk__lte=last_pk)
+    if after_pk is not None:
+        visits = visits.filter(pk__gt=after_pk)
+    chunk = list(visits.only("pk", "ua_string"))
+    for visit in chunk:
+        # distinct UA strings are only parsed (and looked up) once thanks to
+        # the LRU caches
+        if link:
+            visit.link_user_agent()
+            visit.browser = visit.device = visit.os = ""
+        else:
+            visit.browser, visit.device, visit.os = user_agent_data(visit.ua_string)
+    fields = ["agent", *UPDATE_FIELDS] if link else UPDATE_FIELDS
+    UserVisit.objects.bulk_update(chunk, fields)
+    return len(chunk)
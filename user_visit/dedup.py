@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import datetime
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+def seconds_until_midnight(timestamp: datetime.datetime) -> int:
+    """Return the number of seconds from timestamp to the end of its day."""
+    midnight = datetime.datetime.combine(
+        timestamp.date() + datetime.timedelta(days=1),
+        datetime.time.min,
+        tzinfo=timestamp.tzinfo,
+    )
+    return max(int((midnight - timestamp).total_seconds()), 1)
+
+
+class SeenHashCache:
+    """
+    Bounded, day-scoped LRU cache of visit hashes known to be recorded.
+
+    Each worker process keeps one of these so that repeat requests from the
+    same user / session / device on the same day can skip the database
+    check entirely. The visit date is part of the hash, so hashes from a
+    previous day can never match - the cache is cleared on the first lookup
+    after the date rolls over to free the memory.
+
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._date: Optional[datetime.date] = None
+        self._hashes: OrderedDict[str, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def _rollover(self, date: datetime.date) -> None:
+        if date != self._date:
+            self._hashes.clear()
+            self._date = date
+
+    def contains(self, date: datetime.date, uv_hash: str) -> bool:
+        """Return True if the hash has been seen today, updating counters."""
+        with self._lock:
+            self._rollover(date)
+            if uv_hash in self._hashes:
+                self._hashes.move_to_end(uv_hash)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, date: datetime.date, uv_hash: str) -> None:
+        """Record hash as seen, evicting the least recently used if full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._rollover(date)
+            self._hashes[uv_hash] = None
+            self._hashes.move_to_end(uv_hash)
+            while len(self._hashes) > self.maxsize:
+                self._hashes.popitem(last=False)
+
+    def clear(self) -> None:
+        """Remove all hashes and reset counters."""
+        with self._lock:
+            self._hashes.clear()
+            self._date = None
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Return current size and hit / miss counters."""
+        return {
+            "size": len(self._hashes),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class RecentCheckCache:
+    """
+    Bounded LRU of keys (e.g. user + session) checked in the last interval.
+
+    Lets the middleware skip even hashing the request for a session that
+    has already been checked within the last `interval` seconds - so a
+    change of IP address or User-Agent within the window is not recorded
+    until the window expires. Entries are cleared when the date rolls over
+    so that the first request of a new day is always checked.
+
+    """
+
+    def __init__(self, maxsize: int, interval: float) -> None:
+        self.maxsize = maxsize
+        self.interval = interval
+        self.hits = 0
+        self._date: Optional[datetime.date] = None
+        self._checked: OrderedDict[Hashable, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._checked)
+
+    def _rollover(self, date: datetime.date) -> None:
+        if date != self._date:
+            self._checked.clear()
+            self._date = date
+
+    def contains(self, date: datetime.date, key: Hashable) -> bool:
+        """Return True if key was checked today, within the interval."""
+        with self._lock:
+            self._rollover(date)
+            checked_at = self._checked.get(key)
+            if checked_at is None or time.monotonic() - checked_at > self.interval:
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, date: datetime.date, key: Hashable) -> None:
+        """Record key as checked now, evicting the oldest entry if full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._rollover(date)
+            self._checked[key] = time.monotonic()
+            self._checked.move_to_end(key)
+            while len(self._checked) > self.maxsize:
+                self._checked.popitem(last=False)
+
+
+class SharedHashCache:
+    """
+    Cluster-wide record of visit hashes, backed by a Django cache.
+
+    Uses the atomic `cache.add` so that only the first request across all
+    workers / hosts for a given hash is told that the visit is new. Keys
+    expire at midnight (in the timezone of the visit timestamp), which is
+    when the hash would change anyway.
+
+    Any error talking to the cache is logged and reported as "unknown" so
+    that the caller can fall back to checking the database.
+
+    """
+
+    key_prefix = "user_visit:hash:"
+
+    def __init__(self, alias: str) -> None:
+        self.alias = alias
+        # fail fast on a misconfigured alias
+        caches[alias]
+
+    def key(self, uv_hash: str) -> str:
+        return f"{self.key_prefix}{uv_hash}"
+
+    def add(self, uv_hash: str, timestamp: datetime.datetime) -> Optional[bool]:
+        """
+        Claim the hash for this request.
+
+        Returns True if the hash was not in the cache (this is the first
+        request to see it), False if it was, and None if the cache could
+        not be reached.
+
+        """
+        try:
+            return caches[self.alias].add(
+                self.key(uv_hash), 1, timeout=seconds_until_midnight(timestamp)
+            )
+        except Exception:
+            logger.warning(
+                "UserVisit dedup cache '%s' is unavailable", self.alias, exc_info=True
+            )
+            return None
+
+    async def aadd(self, uv_hash: str, timestamp: datetime.datetime) -> Optional[bool]:
+        """Async version of add()."""
+        try:
+            return await caches[self.alias].aadd(
+                self.key(uv_hash), 1, timeout=seconds_until_midnight(timestamp)
+            )
+        except Exception:
+            logger.warning(
+                "UserVisit dedup cache '%s' is unavailable", self.alias, exc_info=True
+            )
+            return None
+
+    def discard(self, uv_hash: str) -> None:
+        """Release a claimed hash (e.g. if the visit could not be saved)."""
+        try:
+            caches[self.alias].delete(self.key(uv_hash))
+        except Exception:
+            logger.warning(
+                "UserVisit dedup cache '%s' is unavailable", self.alias, exc_info=True
+            )
+
+    async def adiscard(self, uv_hash: str) -> None:
+        """Async version of discard()."""
+        try:
+            await caches[self.alias].adelete(self.key(uv_hash))
+        except Exception:
+            logger.warning(
+                "UserVisit dedup cache '%s' is unavailable", self.alias, exc_info=True
+            )
@@ -0,0 +1,222 @@
+"""
+Suspicious activity detection over the stream of new visits.
+
+Each visit is fed (in roughly the order it was recorded) to a
+SuspiciousActivityDetector, which keeps a small sliding window of recent
+activity per user in memory - so that checking a visit never queries the
+user's history. Two patterns are flagged:
+
+* "combinations" - more than `max_combinations` distinct IP address /
+  User-Agent combinations for a user within `window` seconds.
+* "travel" - consecutive visits whose GeoIP locations (see
+  user_visit.geoip) are further apart than could be travelled at
+  `max_speed` km/h in the time between them.
+
+Alerts are sent as the `suspicious_activity` signal. The detector is run
+either by the `detect_suspicious_visits` management command (which reads
+new visits since a pk watermark) or, with USER_VISIT_DETECTION_ON_RECORD,
+on each `visit_recorded` signal in the process that recorded the visit.
+
+"""
+
+from __future__ import annotations
+
+import math
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from .models import UserVisit
+from .settings import (
+    DETECTION_MAX_COMBINATIONS,
+    DETECTION_MAX_SPEED,
+    DETECTION_WINDOW,
+)
+from .signals import suspicious_activity
+
+EARTH_RADIUS_KM = 6371.0
+
+# (remote_addr, ua_string)
+Combination = Tuple[str, str]
+
+# (timestamp, latitude, longitude)
+Location = Tuple[float, float, float]
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Return the great-circle distance between two points in km."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = (
+        math.sin(d_phi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def visit_location(uv: UserVisit) -> Optional[Tuple[float, float]]:
+    """Return the (latitude, longitude) from the visit GeoIP context."""
+    geoip = (uv.context or {}).get("geoip") or {}
+    latitude, longitude = geoip.get("latitude"), geoip.get("longitude")
+    if latitude is None or longitude is None:
+        return None
+    return float(latitude), float(longitude)
+
+
+class Alert(NamedTuple):
+    kind: str
+    user_id: int
+    user_visit: UserVisit
+    details: Dict[str, Any]
+
+
+class UserWindow:
+    """Sliding window of a single user's recent visits."""
+
+    def __init__(self) -> None:
+        self.events: Deque[Tuple[float, Combination]] = deque()
+        self.counts: Dict[Combination, int] = {}
+        self.newest = 0.0
+        self.location: Optional[Location] = None
+
+    def expire(self, before: float) -> None:
+        """Remove events older than before."""
+        while self.events and self.events[0][0] < before:
+            _, key = self.events.popleft()
+            self.counts[key] -= 1
+            if not self.counts[key]:
+                del self.counts[key]
+
+    def add(self, timestamp: float, key: Combination) -> bool:
+        """Add an event, returning True if key is new to the window."""
+        self.events.append((timestamp, key))
+        self.newest = max(self.newest, timestamp)
+        is_new = key not in self.counts
+        self.counts[key] = self.counts.get(key, 0) + 1
+        return is_new
+
+
+class SuspiciousActivityDetector:
+    """
+    Incremental, in-memory detector of suspicious visit patterns.
+
+    Checking a visit is O(1) amortised - events are expired from the front
+    of the user's window as newer ones arrive, and distinct combinations
+    are counted in a dict. Windows are kept for at most `max_users` users
+    (least recently active evicted first), so memory use is bounded.
+
+    A "combinations" alert is raised once as a user crosses the threshold,
+    not for every further combination while they remain above it.
+
+    """
+
+    def __init__(
+        self,
+        window: float = DETECTION_WINDOW,
+        max_combinations: int = DETECTION_MAX_COMBINATIONS,
+        max_speed: float = DETECTION_MAX_SPEED,
+        min_distance: float = 100,
+        max_users: int = 100_000,
+    ) -> None:
+        self.window = window
+        self.max_combinations = max_combinations
+        self.max_speed = max_speed
+        # GeoIP locations are approximate - ignore short "journeys"
+        self.min_distance = min_distance
+        self.max_users = max_users
+        self._windows: OrderedDict[int, UserWindow] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def get_window(self, user_id: int) -> UserWindow:
+        """Return the user's window, evicting the least recent if full."""
+        user_window = self._windows.get(user_id)
+        if user_window is None:
+            user_window = self._windows[user_id] = UserWindow()
+            while len(self._windows) > self.max_users:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(user_id)
+        return user_window
+
+    def process(self, uv: UserVisit) -> List[Alert]:
+        """Add a visit to the user's window, returning any alerts."""
+        timestamp = uv.timestamp.timestamp()
+        with self._lock:
+            user_window = self.get_window(uv.user_id)
+            alerts = self.check_combinations(user_window, uv, timestamp)
+            alerts += self.check_travel(user_window, uv, timestamp)
+        return alerts
+
+    def check_combinations(
+        self, user_window: UserWindow, uv: UserVisit, timestamp: float
+    ) -> List[Alert]:
+        if self.max_combinations <= 0:
+            return []
+        user_window.expire(max(timestamp, user_window.newest) - self.window)
+        if not user_window.add(timestamp, (uv.remote_addr, uv.ua_string)):
+            return []
+        if len(user_window.counts) != self.max_combinations + 1:
+            return []
+        details = {
+            "combinations": len(user_window.counts),
+            "window": self.window,
+            "remote_addrs": sorted({addr for addr, _ in user_window.counts}),
+        }
+        return [Alert("combinations", uv.user_id, uv, details)]
+
+    def check_travel(
+        self, user_window: UserWindow, uv: UserVisit, timestamp: float
+    ) -> List[Alert]:
+        if self.max_speed <= 0:
+            return []
+        location = visit_location(uv)
+        if location is None:
+            return []
+        previous, user_window.location = user_window.location, (timestamp, *location)
+        if previous is None:
+            return []
+        distance = haversine(previous[1], previous[2], *location)
+        if distance < self.min_distance:
+            return []
+        hours = abs(timestamp - previous[0]) / 3600
+        if hours and distance / hours <= self.max_speed:
+            return []
+        details = {
+            "distance": round(distance),
+            "seconds": round(hours * 3600),
+            "speed": round(distance / hours) if hours else None,
+        }
+        return [Alert("travel", uv.user_id, uv, details)]
+
+    def clear(self) -> None:
+        """Remove all windows."""
+        with self._lock:
+            self._windows.clear()
+
+
+def send_alerts(alerts: List[Alert], sender: Any = None) -> None:
+    """Send the suspicious_activity signal for each alert."""
+    for alert in alerts:
+        suspicious_activity.send(
+            sender=sender or SuspiciousActivityDetector, alert=alert
+        )
+
+
+_detector: Optional[SuspiciousActivityDetector] = None
+
+
+def get_detector() -> SuspiciousActivityDetector:
+    """Return the detector configured by the USER_VISIT_DETECTION_* settings."""
+    global _detector
+    if _detector is None:
+        _detector = SuspiciousActivityDetector()
+    return _detector
+
+
+def on_visit_recorded(sender: Any, user_visit: UserVisit, **kwargs: Any) -> None:
+    """visit_recorded receiver that checks each new visit."""
+    send_alerts(get_detector().process(user_visit), sender=sender)
@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import contextlib
+import csv
+import gzip
+import io
+import itertools
+import json
+import sys
+from typing import IO, TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, cast
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .settings import REQUEST_CONTEXT_ENCODER, USER_AGENT_TABLE
+
+if TYPE_CHECKING:
+    from django.db.models import QuerySet
+
+# UserVisit columns written by exports / archives
+EXPORT_FIELDS = [
+    "id",
+    "uuid",
+    "user_id",
+    "timestamp",
+    "visit_date",
+    "session_key",
+    "remote_addr",
+    "ua_string",
+    "browser",
+    "device",
+    "os",
+    "hash",
+    "created_at",
+    "context",
+]
+
+# UserAgent columns exported in place of the visit's own (blank) fields for
+# visits linked to the UserAgent table
+USER_AGENT_FIELDS = {
+    "browser": "agent__browser",
+    "device": "agent__device",
+    "os": "agent__os",
+}
+
+FORMATS = ("csv", "jsonl", "parquet")
+
+
+def infer_format(path: str) -> str:
+    """Return the export format from a file name, e.g. "visits.csv.gz"."""
+    name = path[:-3] if path.endswith(".gz") else path
+    for fmt in FORMATS:
+        if name.endswith(f".{fmt}"):
+            return fmt
+    raise ValueError(f"Unable to infer export format from '{path}'")
+
+
+@contextlib.contextmanager
+def open_output(
+    path: str, compress: bool = False, exclusive: bool = False
+) -> Iterator[IO[bytes]]:
+    """
+    Open a binary output stream, compressed with gzip if requested.
+
+    A path of "-" writes to stdout. Paths ending in ".gz" are always
+    compressed. If exclusive is True an existing file is not overwritten -
+    FileExistsError is raised instead.
+
+    """
+    if path == "-":
+        if compress:
+            with gzip.GzipFile(fileobj=sys.stdout.buffer, mode="wb") as gz:
+                yield cast(IO[bytes], gz)
+        else:
+            yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
+        return
+    mode = "xb" if exclusive else "wb"
+    if compress or path.endswith(".gz"):
+        with gzip.open(path, mode) as gz:
+            yield cast(IO[bytes], gz)
+    else:
+        with open(path, mode) as f:
+            yield f
+
+
+class VisitWriter:
+    """Write UserVisit rows (dicts of EXPORT_FIELDS) to a binary stream."""
+
+    def __init__(self, stream: IO[bytes], fields: List[str] = EXPORT_FIELDS) -> None:
+        self.stream = stream
+        self.fields = fields
+        self.count = 0
+
+    def write_rows(self, rows: Iterable[Dict[str, Any]]) -> None:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """Flush buffered output to the stream."""
+        self.stream.flush()
+
+    def close(self) -> None:
+        """Finish writing (the stream itself is not closed)."""
+        self.flush()
+
+
+class CsvVisitWriter(VisitWriter):
+    def __init__(self, stream: IO[bytes], fields: List[str] = EXPORT_FIELDS) -> None:
+        super().__init__(stream, fields)
+        self.text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        self.writer = csv.DictWriter(self.text, fieldnames=fields)
+        self.writer.writeheader()
+
+    def write_rows(self, rows: Iterable[Dict[str, Any]]) -> None:
+        for row in rows:
+            if "context" in row:
+                row["context"] = json.dumps(row["context"], cls=REQUEST_CONTEXT_ENCODER)
+            self.writer.writerow(row)
+            self.count += 1
+
+    def flush(self) -> None:
+        self.text.flush()
+        super().flush()
+
+    def close(self) -> None:
+        self.flush()
+        # don't let the wrapper close the underlying stream
+        self.text.detach()
+
+
+class JsonLinesVisitWriter(VisitWriter):
+    def write_rows(self, rows: Iterable[Dict[str, Any]]) -> None:
+        for row in rows:
+            line = json.dumps(row, cls=REQUEST_CONTEXT_ENCODER) + "\n"
+            self.stream.write(line.encode())
+            self.count += 1
+
+
+class ParquetVisitWriter(VisitWriter):
+    """
+    Write rows to a Parquet file, one row group per call to write_rows.
+
+    Requires the optional `pyarrow` package.
+
+    """
+
+    def __init__(self, stream: IO[bytes], fields: List[str] = EXPORT_FIELDS) -> None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImproperlyConfigured("Parquet export requires pyarrow")
+        super().__init__(stream, fields)
+        self.pyarrow = pyarrow
+        types = {
+            "id": pyarrow.int64(),
+            "user_id": pyarrow.int64(),
+            "timestamp": pyarrow.timestamp("us", tz="UTC"),
+            "created_at": pyarrow.timestamp("us", tz="UTC"),
+            "visit_date": pyarrow.date32(),
+        }
+        self.schema = pyarrow.schema(
+            [(field, types.get(field, pyarrow.string())) for field in fields]
+        )
+        self.writer = pyarrow.parquet.ParquetWriter(stream, self.schema)
+
+    def write_rows(self, rows: Iterable[Dict[str, Any]]) -> None:
+        batch = []
+        for row in rows:
+            if "uuid" in row:
+                row["uuid"] = str(row["uuid"])
+            if "context" in row:
+                row["context"] = json.dumps(row["context"], cls=REQUEST_CONTEXT_ENCODER)
+            batch.append(row)
+        if batch:
+            table = self.pyarrow.Table.from_pylist(batch, schema=self.schema)
+            self.writer.write_table(table)
+            self.count += len(batch)
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+WRITERS = {
+    "csv": CsvVisitWriter,
+    "jsonl": JsonLinesVisitWriter,
+    "parquet": ParquetVisitWriter,
+}
+
+
+def get_writer(fmt: str, stream: IO[bytes]) -> VisitWriter:
+    """Return a writer for the named format."""
+    try:
+        return WRITERS[fmt](stream)
+    except KeyError:
+        raise ValueError(f"Unsupported export format: '{fmt}'")
+
+
+def iter_chunks(queryset: QuerySet, chunk_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Yield lists of export rows from a UserVisit queryset.
+
+    Rows are fetched with a server-side cursor (where the database supports
+    it), so memory use is constant however many rows are exported.
+
+    """
+    fields = EXPORT_FIELDS
+    if USER_AGENT_TABLE:
+        fields = fields + list(USER_AGENT_FIELDS.values())
+    rows = queryset.order_by("pk").values(*fields).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        if USER_AGENT_TABLE:
+            for row in chunk:
+                for field, agent_field in USER_AGENT_FIELDS.items():
+                    value = row.pop(agent_field)
+                    if value is not None:
+                        row[field] = value
+        yield chunk
+
+
+def stream_export(
+    queryset: QuerySet, fmt: str, chunk_size: int = 2000
+) -> Iterator[bytes]:
+    """Yield an export of a UserVisit queryset as chunks of bytes."""
+    buffer = io.BytesIO()
+    writer = get_writer(fmt, buffer)
+    for chunk in iter_chunks(queryset, chunk_size):
+        writer.write_rows(chunk)
+        writer.flush()
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    writer.close()
+    yield buffer.getvalue()
@@ -0,0 +1,167 @@
+"""
+GeoIP request context extractor.
+
+Looks up the client IP address in a MaxMind (GeoLite2 / GeoIP2) City
+database, and returns the country, city and location as the "geoip"
+entry of the visit context:
+
+    USER_VISIT_REQUEST_CONTEXT_EXTRACTOR = "user_visit.geoip.geoip_context"
+    USER_VISIT_GEOIP_DATABASE = "/var/lib/GeoIP/GeoLite2-City.mmdb"
+
+Requires the optional `maxminddb` package. The database is memory-mapped
+(so shared between worker processes by the OS page cache) and opened on
+first use. Results are cached per IP address, and lookups are skipped
+for a cooldown period if they start to exceed a time budget.
+
+"""
+
+from __future__ import annotations
+
+import functools
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpRequest
+
+from .settings import (
+    GEOIP_CACHE_SIZE,
+    GEOIP_COOLDOWN,
+    GEOIP_DATABASE,
+    GEOIP_TIME_BUDGET,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def open_reader(path: str) -> Any:
+    """Open a memory-mapped MaxMind database reader."""
+    try:
+        import maxminddb
+    except ImportError:
+        raise ImproperlyConfigured("GeoIP context requires maxminddb")
+    return maxminddb.open_database(path, mode=maxminddb.MODE_MMAP)
+
+
+def parse_city(record: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Return the country, city and location from a City database record."""
+    if not record:
+        return {}
+    location = record.get("location", {})
+    return {
+        "country": record.get("country", {}).get("iso_code"),
+        "city": record.get("city", {}).get("names", {}).get("en"),
+        "latitude": location.get("latitude"),
+        "longitude": location.get("longitude"),
+    }
+
+
+class GeoIPContextExtractor:
+    """
+    Request context extractor that adds GeoIP data for the client IP.
+
+    Each lookup is timed against `time_budget` (seconds). A lookup cannot be
+    interrupted, but once one has gone over budget no further lookups are
+    made for `cooldown` seconds - visits are recorded with no "geoip"
+    context rather than letting a slow or failing reader add latency to
+    every new visit.
+
+    """
+
+    def __init__(
+        self,
+        path: str,
+        cache_size: int = 4096,
+        time_budget: float = 0.005,
+        cooldown: float = 60,
+    ) -> None:
+        self.path = path
+        self.time_budget = time_budget
+        self.cooldown = cooldown
+        self.skipped = 0
+        self.over_budget = 0
+        self.errors = 0
+        self._reader: Any = None
+        self._skip_until = 0.0
+        self._lock = threading.Lock()
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    @property
+    def reader(self) -> Any:
+        with self._lock:
+            if self._reader is None:
+                self._reader = open_reader(self.path)
+            return self._reader
+
+    def _lookup(self, ip_address: str) -> Dict[str, Any]:
+        return parse_city(self.reader.get(ip_address))
+
+    def __call__(self, request: HttpRequest) -> Dict[str, Any]:
+        from .models import parse_remote_addr
+
+        ip_address = parse_remote_addr(request).strip()
+        if not ip_address:
+            return {}
+        start = time.monotonic()
+        if start < self._skip_until:
+            self.skipped += 1
+            return {}
+        try:
+            geoip = self.lookup(ip_address)
+        except ValueError:
+            # not a valid IP address - not worth tripping the breaker
+            return {}
+        except ImproperlyConfigured:
+            raise
+        except Exception:
+            self.errors += 1
+            logger.exception("Error looking up GeoIP data for '%s'", ip_address)
+            self._skip_until = time.monotonic() + self.cooldown
+            return {}
+        elapsed = time.monotonic() - start
+        if elapsed > self.time_budget:
+            self.over_budget += 1
+            logger.warning(
+                "GeoIP lookup took %.1fms, skipping lookups for %is",
+                elapsed * 1000,
+                self.cooldown,
+            )
+            self._skip_until = time.monotonic() + self.cooldown
+        return {"geoip": geoip} if geoip else {}
+
+    def stats(self) -> Dict[str, Any]:
+        """Return cache hit / miss and budget counters."""
+        cache_info = self.lookup.cache_info()
+        return {
+            "hits": cache_info.hits,
+            "misses": cache_info.misses,
+            "size": cache_info.currsize,
+            "skipped": self.skipped,
+            "over_budget": self.over_budget,
+            "errors": self.errors,
+        }
+
+
+_extractor: Optional[GeoIPContextExtractor] = None
+
+
+def get_extractor() -> GeoIPContextExtractor:
+    """Return the extractor configured by the USER_VISIT_GEOIP_* settings."""
+    global _extractor
+    if _extractor is None:
+        if not GEOIP_DATABASE:
+            raise ImproperlyConfigured("USER_VISIT_GEOIP_DATABASE is not set")
+        _extractor = GeoIPContextExtractor(
+            GEOIP_DATABASE,
+            cache_size=GEOIP_CACHE_SIZE,
+            time_budget=GEOIP_TIME_BUDGET / 1000,
+            cooldown=GEOIP_COOLDOWN,
+        )
+    return _extractor
+
+
+def geoip_context(request: HttpRequest) -> Dict[str, Any]:
+    """Request context extractor using the configured GeoIP database."""
+    return get_extractor()(request)
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import argparse
+import datetime
+from typing import Any, Dict, Optional
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext as _, gettext_lazy as _lazy
+
+from user_visit.bulk import keyset_ranges, load_checkpoint, save_checkpoint
+from user_visit.detection import Alert, SuspiciousActivityDetector, send_alerts
+from user_visit.models import UserVisit
+from user_visit.settings import (
+    DETECTION_MAX_COMBINATIONS,
+    DETECTION_MAX_SPEED,
+    DETECTION_WINDOW,
+)
+
+# the only columns the detector needs
+DETECTION_FIELDS = ["id", "user_id", "timestamp", "remote_addr", "ua_string", "context"]
+
+
+class Command(BaseCommand):
+    help = _lazy(  # noqa: A003
+        "Check visits recorded since the last run for suspicious activity"
+    )
+
+    def add_arguments(self, parser: argparse.ArgumentParser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=5000,
+            help=_("Number of visits read per query."),
+        )
+        parser.add_argument(
+            "--since-pk",
+            type=int,
+            help=_("Only check visits with pk >= this value."),
+        )
+        parser.add_argument(
+            "--checkpoint-file",
+            help=_("File used to record the last pk checked (the watermark)."),
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            default=False,
+            help=_("Continue from the pk recorded in --checkpoint-file."),
+        )
+        parser.add_argument(
+            "--window",
+            type=int,
+            default=DETECTION_WINDOW,
+            help=_("Sliding window in seconds."),
+        )
+        parser.add_argument(
+            "--max-combinations",
+            type=int,
+            default=DETECTION_MAX_COMBINATIONS,
+            help=_("Distinct IP address / User-Agent combinations per window."),
+        )
+        parser.add_argument(
+            "--max-speed",
+            type=float,
+            default=DETECTION_MAX_SPEED,
+            help=_("Maximum plausible speed (km/h) between visit locations."),
+        )
+
+    def get_start_pk(self, options: Dict[str, Any]) -> Optional[int]:
+        """Return the pk to start after (None to start at the beginning)."""
+        if options["resume"]:
+            if not options["checkpoint_file"]:
+                raise CommandError(_("--resume requires --checkpoint-file."))
+            if options["since_pk"] is not None:
+                raise CommandError(_("--resume and --since-pk are exclusive."))
+            return load_checkpoint(options["checkpoint_file"]).get("last_pk")
+        if options["since_pk"] is not None:
+            return options["since_pk"] - 1
+        return None
+
+    def warm_up(
+        self, detector: SuspiciousActivityDetector, after_pk: int, batch_size: int
+    ) -> int:
+        """
+        Load the windows with visits up to the watermark.
+
+        Windows are not persisted between runs, so the visits before the
+        watermark that are still within the window of the first new visit
+        are replayed (ignoring any alerts, which were sent last time).
+
+        """
+        first = UserVisit.objects.filter(pk__gt=after_pk).order_by("pk").first()
+        if first is None:
+            return 0
+        since = first.timestamp - datetime.timedelta(seconds=detector.window)
+        visits = (
+            UserVisit.objects.filter(pk__lte=after_pk, timestamp__gte=since)
+            .order_by("pk")
+            .only(*DETECTION_FIELDS)
+        )
+        count = 0
+        for uv in visits.iterator(chunk_size=batch_size):
+            detector.process(uv)
+            count += 1
+        return count
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if options["batch_size"] < 1:
+            raise CommandError(_("--batch-size must be positive."))
+        detector = SuspiciousActivityDetector(
+            window=options["window"],
+            max_combinations=options["max_combinations"],
+            max_speed=options["max_speed"],
+        )
+        after_pk = self.get_start_pk(options)
+        if after_pk is not None:
+            replayed = self.warm_up(detector, after_pk, options["batch_size"])
+            self.stdout.write(f"Replayed {replayed} visits before pk {after_pk}.")
+        checked = alerted = 0
+        for after, last_pk in keyset_ranges(
+            UserVisit.objects.all(), options["batch_size"], after_pk=after_pk
+        ):
+            visits = UserVisit.objects.filter(pk__lte=last_pk)
+            if after is not None:
+                visits = visits.filter(pk__gt=after)
+            for uv in visits.order_by("pk").only(*DETECTION_FIELDS):
+                alerts = detector.process(uv)
+                send_alerts(alerts, sender=self.__class__)
+                for alert in alerts:
+                    self.write_alert(alert)
+                checked += 1
+                alerted += len(alerts)
+            if options["checkpoint_file"]:
+                save_checkpoint(options["checkpoint_file"], {"last_pk": last_pk})
+        self.stdout.write("---")
+        self.stdout.write(f"Checked {checked} visits, {alerted} alerts.")
+
+    def write_alert(self, alert: Alert) -> None:
+        details = ", ".join(f"{k}={v}" for k, v in alert.details.items())
+        self.stdout.write(
+            f"{alert.kind}: user {alert.user_id}, visit {alert.user_visit.pk} "
+            f"({details})"
+        )
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import argparse
+from typing import Any, List
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q, QuerySet
+from django.utils.translation import gettext as _, gettext_lazy as _lazy
+
+from user_visit.export import (
+    FORMATS,
+    get_writer,
+    infer_format,
+    iter_chunks,
+    open_output,
+)
+from user_visit.models import UserVisit
+
+from .update_user_visit_summary import parse_date
+
+
+def filter_users(visits: QuerySet, users: List[str]) -> QuerySet:
+    """Filter visits by user pk or username."""
+    username_field = get_user_model().USERNAME_FIELD
+    query = Q()
+    for user in users:
+        query |= Q(**{f"user__{username_field}": user})
+        if user.isdigit():
+            query |= Q(user_id=int(user))
+    return visits.filter(query)
+
+
+class Command(BaseCommand):
+    help = _lazy("Export UserVisit records to CSV, JSONL or Parquet")  # noqa: A003
+
+    def add_arguments(self, parser: argparse.ArgumentParser) -> None:
+        parser.add_argument(
+            "-o",
+            "--output",
+            default="-",
+            help=_("File to write to (defaults to stdout)."),
+        )
+        parser.add_argument(
+            "--format",
+            choices=FORMATS,
+            help=_("Export format (defaults to the --output extension, or csv)."),
+        )
+        parser.add_argument(
+            "--gzip",
+            action="store_true",
+            default=False,
+            help=_("Compress the output with gzip (not for parquet)."),
+        )
+        parser.add_argument(
+            "--since",
+            type=parse_date,
+            help=_("Only export visits on or after this date (YYYY-MM-DD)."),
+        )
+        parser.add_argument(
+            "--until",
+            type=parse_date,
+            help=_("Only export visits on or before this date (YYYY-MM-DD)."),
+        )
+        parser.add_argument(
+            "--user",
+            action="append",
+            default=[],
+            help=_("Only export visits by this user (pk or username, repeatable)."),
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            help=_("Number of rows fetched from the database at a time."),
+        )
+
+    def get_format(self, options: Any) -> str:
+        if options["format"]:
+            return options["format"]
+        if options["output"] == "-":
+            return "csv"
+        try:
+            return infer_format(options["output"])
+        except ValueError as ex:
+            raise CommandError(str(ex))
+
+    def get_queryset(self, options: Any) -> QuerySet:
+        visits = UserVisit.objects.all()
+        if options["since"]:
+            visits = visits.filter(visit_date__gte=options["since"])
+        if options["until"]:
+            visits = visits.filter(visit_date__lte=options["until"])
+        if options["user"]:
+            visits = filter_users(visits, options["user"])
+        return visits
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        fmt = self.get_format(options)
+        if fmt == "parquet" and (options["gzip"] or options["output"] == "-"):
+            raise CommandError(_("Parquet export requires an --output file."))
+        if options["chunk_size"] < 1:
+            raise CommandError(_("--chunk-size must be positive."))
+        visits = self.get_queryset(options)
+        with open_output(options["output"], compress=options["gzip"]) as stream:
+            try:
+                writer = get_writer(fmt, stream)
+            except ImproperlyConfigured as ex:
+                raise CommandError(str(ex))
+            for chunk in iter_chunks(visits, options["chunk_size"]):
+                writer.write_rows(chunk)
+            writer.close()
+        if options["output"] != "-":
+            self.stdout.write(f"Exported {writer.count} UserVisit objects.")
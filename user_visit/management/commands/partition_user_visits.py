@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import argparse
+import datetime
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.utils import timezone
+from django.utils.translation import gettext as _, gettext_lazy as _lazy
+
+from user_visit import partitioning
+from user_visit.models import UserVisit
+from user_visit.settings import RETENTION_DAYS
+
+
+class Command(BaseCommand):
+    help = _lazy(  # noqa: A003
+        "Create upcoming monthly UserVisit partitions and remove expired ones "
+        "(PostgreSQL only)"
+    )
+
+    def add_arguments(self, parser: argparse.ArgumentParser) -> None:
+        parser.add_argument(
+            "--convert",
+            action="store_true",
+            default=False,
+            help=_(
+                "Convert the existing UserVisit table to a partitioned table, "
+                "attaching it as the partition for visits before next month."
+            ),
+        )
+        parser.add_argument(
+            "--months",
+            type=int,
+            default=3,
+            help=_("Number of months ahead to create partitions for."),
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=RETENTION_DAYS,
+            help=_(
+                "Remove partitions holding only visits older than this many "
+                "days (defaults to settings.USER_VISIT_RETENTION_DAYS)."
+            ),
+        )
+        parser.add_argument(
+            "--detach",
+            action="store_true",
+            default=False,
+            help=_("Detach expired partitions (e.g. to archive them), not drop."),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help=_("Print the SQL statements without running them."),
+        )
+
+    def execute_sql(
+        self, connection: Any, statements: List[str], dry_run: bool
+    ) -> None:
+        for sql in statements:
+            self.stdout.write(f"{sql};")
+            if not dry_run:
+                with connection.cursor() as cursor:
+                    cursor.execute(sql)
+
+    def convert(
+        self, connection: Any, today: datetime.date, dry_run: bool
+    ) -> partitioning.Partition:
+        """Convert the table, returning the legacy partition."""
+        if partitioning.is_partitioned(connection):
+            raise CommandError(_("The UserVisit table is already partitioned."))
+        cutover = partitioning.add_months(today, 1)
+        # outside a transaction - CREATE INDEX CONCURRENTLY cannot run in one
+        self.execute_sql(
+            connection, partitioning.prepare_sql(connection, cutover), dry_run
+        )
+        with transaction.atomic(using=connection.alias):
+            self.execute_sql(
+                connection, partitioning.convert_sql(connection, cutover), dry_run
+            )
+        return partitioning.Partition(partitioning.legacy_name(), None, cutover)
+
+    def create_partitions(
+        self,
+        connection: Any,
+        partitions: List[partitioning.Partition],
+        today: datetime.date,
+        options: Any,
+    ) -> None:
+        """Create the upcoming monthly partitions, and the DEFAULT partition."""
+        dry_run = options["dry_run"]
+        has_default = partitioning.has_default(partitions)
+        for month in partitioning.months_to_create(
+            partitions, today, options["months"]
+        ):
+            if has_default and partitioning.has_default_rows(connection, month):
+                statements = partitioning.move_from_default_sql(connection, month)
+            else:
+                statements = [partitioning.create_partition_sql(connection, month)]
+            with transaction.atomic(using=connection.alias):
+                self.execute_sql(connection, statements, dry_run)
+        if not has_default:
+            self.execute_sql(
+                connection,
+                [partitioning.create_default_partition_sql(connection)],
+                dry_run,
+            )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        connection = connections[router.db_for_write(UserVisit)]
+        if connection.vendor != "postgresql":
+            raise CommandError(_("Partitioning is only supported on PostgreSQL."))
+        if options["months"] < 0:
+            raise CommandError(_("--months must not be negative."))
+        today = timezone.now().date()
+        dry_run = options["dry_run"]
+        if options["convert"]:
+            legacy = self.convert(connection, today, dry_run)
+            # a dry run conversion has not created the legacy partition
+            partitions = [legacy] if dry_run else []
+        elif not partitioning.is_partitioned(connection):
+            raise CommandError(
+                _("The UserVisit table is not partitioned - run with --convert.")
+            )
+        if not (options["convert"] and dry_run):
+            partitions = partitioning.list_partitions(connection)
+        self.create_partitions(connection, partitions, today, options)
+        if options["days"] is None:
+            return
+        cutoff = today - datetime.timedelta(days=options["days"])
+        for partition in partitioning.expired_partitions(partitions, cutoff):
+            sql = (
+                partitioning.detach_partition_sql(connection, partition.name)
+                if options["detach"]
+                else partitioning.drop_partition_sql(connection, partition.name)
+            )
+            self.execute_sql(connection, [sql], dry_run)
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import datetime
+import os
+import time
+from typing import Any, Iterator, Optional
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import QuerySet
+from django.utils import timezone
+from django.utils.translation import gettext as _, gettext_lazy as _lazy
+
+from user_visit.bulk import keyset_ranges
+from user_visit.export import (
+    VisitWriter,
+    get_writer,
+    infer_format,
+    iter_chunks,
+    open_output,
+)
+from user_visit.models import UserVisit
+from user_visit.settings import RETENTION_DAYS
+
+
+class Command(BaseCommand):
+    help = _lazy(  # noqa: A003
+        "Delete UserVisit records older than the retention period"
+    )
+
+    def add_arguments(self, parser: argparse.ArgumentParser) -> None:
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=RETENTION_DAYS,
+            help=_(
+                "Delete visits older than this many days "
+                "(defaults to settings.USER_VISIT_RETENTION_DAYS)."
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help=_("Number of objects deleted with each DELETE."),
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            help=_("Seconds to pause between batches."),
+        )
+        parser.add_argument(
+            "--archive",
+            help=_(
+                "Write deleted objects to this file before deleting them - "
+                "format is inferred from the name, e.g. visits.jsonl.gz or "
+                "visits.csv.gz. An existing file is not overwritten."
+            ),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help=_("Report how many objects would be deleted, then exit."),
+        )
+
+    @contextlib.contextmanager
+    def archive(self, path: Optional[str]) -> Iterator[Optional[VisitWriter]]:
+        if not path:
+            yield None
+            return
+        try:
+            fmt = infer_format(path)
+        except ValueError as ex:
+            raise CommandError(str(ex))
+        with contextlib.ExitStack() as stack:
+            try:
+                stream = stack.enter_context(open_output(path, exclusive=True))
+            except FileExistsError:
+                raise CommandError(_("Archive file %s already exists.") % path)
+            writer = get_writer(fmt, stream)
+            yield writer
+            writer.close()
+
+    def archive_batch(
+        self, writer: VisitWriter, batch: QuerySet, batch_size: int
+    ) -> None:
+        # the same rows as export_user_visits (including any User-Agent data
+        # held on the linked UserAgent)
+        for chunk in iter_chunks(batch, batch_size):
+            writer.write_rows(chunk)
+        # the rows must be on disk before they are deleted
+        writer.flush()
+        os.fsync(writer.stream.fileno())
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if options["days"] is None:
+            raise CommandError(
+                _("--days is required if USER_VISIT_RETENTION_DAYS is not set.")
+            )
+        if options["batch_size"] < 1:
+            raise CommandError(_("--batch-size must be positive."))
+        cutoff = timezone.now() - datetime.timedelta(days=options["days"])
+        visits = UserVisit.objects.filter(timestamp__lt=cutoff)
+        if options["dry_run"]:
+            count = visits.count()
+            self.stdout.write(
+                f"Would delete {count} UserVisit objects before {cutoff}."
+            )
+            return
+
+        deleted = 0
+        with self.archive(options["archive"]) as writer:
+            for after_pk, last_pk in keyset_ranges(visits, options["batch_size"]):
+                batch = visits.filter(pk__lte=last_pk)
+                if after_pk is not None:
+                    batch = batch.filter(pk__gt=after_pk)
+                if writer:
+                    self.archive_batch(writer, batch, options["batch_size"])
+                # a raw DELETE - nothing references UserVisit, so there is no
+                # need for the collector to load objects or send signals.
+                deleted += batch._raw_delete(batch.db)
+                if options["sleep"]:
+                    time.sleep(options["sleep"])
+        self.stdout.write(f"Deleted {deleted} UserVisit objects before {cutoff}.")
@@ -1,12 +1,30 @@
 from __future__ import annotations
 
 import argparse
-from typing import Any
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Deque, Dict, Iterator, Optional, Tuple
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.utils.translation import gettext as _, gettext_lazy as _lazy
 
-from user_visit.models import UserVisit
+from user_visit.bulk import (
+    RateLimiter,
+    get_user_agent_backfill,
+    init_worker,
+    keyset_ranges,
+    load_checkpoint,
+    save_checkpoint,
+    update_user_agent_chunk,
+)
+from user_visit.models import parse_user_agent
+
+PkRange = Tuple[Optional[int], int]
+
+# minimum number of seconds between progress reports
+PROGRESS_INTERVAL = 5
 
 
 class Command(BaseCommand):
@@ -21,23 +39,135 @@ class Command(BaseCommand):
             action="store_true",
             default=False,
             help=_(
-                "Use the --force option to update all UserVisit "
-                "objects (defaults to backfilling empty records only)."
+                "Use the --force option to update all UserVisit objects "
+                "(defaults to backfilling records with blank browser, "
+                "device or os fields only)."
+            ),
+        )
+        parser.add_argument(
+            "--link",
+            action="store_true",
+            default=False,
+            help=_(
+                "Link UserVisit objects to the UserAgent table (see "
+                "USER_VISIT_USER_AGENT_TABLE) and blank their browser, device "
+                "and os fields (defaults to linking unlinked records only)."
             ),
         )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help=_("Number of objects updated with each bulk UPDATE."),
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help=_("Number of worker processes used to update chunks in parallel."),
+        )
+        parser.add_argument(
+            "--since-pk",
+            type=int,
+            help=_("Only update objects with pk >= this value."),
+        )
+        parser.add_argument(
+            "--until-pk",
+            type=int,
+            help=_("Only update objects with pk <= this value."),
+        )
+        parser.add_argument(
+            "--checkpoint-file",
+            help=_("File used to record the last pk updated."),
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            default=False,
+            help=_("Continue from the pk recorded in --checkpoint-file."),
+        )
+        parser.add_argument(
+            "--max-rows-per-second",
+            type=float,
+            help=_("Throttle updates to this average rate."),
+        )
+
+    def get_start_pk(self, options: Dict[str, Any]) -> Optional[int]:
+        """Return the pk to start after (None to start at the beginning)."""
+        if options["resume"]:
+            if not options["checkpoint_file"]:
+                raise CommandError(_("--resume requires --checkpoint-file."))
+            if options["since_pk"] is not None:
+                raise CommandError(_("--resume and --since-pk are exclusive."))
+            return load_checkpoint(options["checkpoint_file"]).get("last_pk")
+        if options["since_pk"] is not None:
+            return options["since_pk"] - 1
+        return None
 
     def handle(self, *args: Any, **options: Any) -> None:
-        visits = UserVisit.objects.all()
-        if not options["force"]:
-            visits = visits.filter(ua_string="")
+        if options["batch_size"] < 1 or options["workers"] < 1:
+            raise CommandError(_("--batch-size and --workers must be positive."))
+        after_pk = self.get_start_pk(options)
+        ranges = keyset_ranges(
+            get_user_agent_backfill(options["force"], options["link"]),
+            options["batch_size"],
+            after_pk=after_pk,
+            until_pk=options["until_pk"],
+        )
+        limiter = RateLimiter(options["max_rows_per_second"])
+        last_report = time.monotonic()
         updated = 0
-        for v in visits.iterator():
-            user_agent = v.user_agent
-            v.device = user_agent.get_device()
-            v.os = user_agent.get_os()
-            v.browser = user_agent.get_browser()
-            v.save(update_fields=["device", "os", "browser"])
-            self.stdout.write(f"Updated UserVisit #{v.pk}")
-            updated += 1
+        for (_after, last_pk), count in self.update(options, ranges):
+            updated += count
+            if options["checkpoint_file"]:
+                save_checkpoint(options["checkpoint_file"], {"last_pk": last_pk})
+            limiter.throttle(count)
+            if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                rate = updated / (last_report - limiter.start)
+                self.stdout.write(
+                    f"Updated {updated} objects up to pk {last_pk} "
+                    f"({rate:.0f} objects/s)"
+                )
+
         self.stdout.write("---")
         self.stdout.write(f"Updated {updated} UserVisit objects.")
+        if options["workers"] == 1:
+            cache_info = parse_user_agent.cache_info()
+            self.stdout.write(
+                f"User-Agent cache: {cache_info.hits} hits, "
+                f"{cache_info.misses} misses."
+            )
+
+    def update(
+        self, options: Dict[str, Any], ranges: Iterator[PkRange]
+    ) -> Iterator[Tuple[PkRange, int]]:
+        """
+        Update each range, yielding results in pk order.
+
+        With more than one worker, ranges are farmed out to a process pool
+        with a bounded number in flight, so that results (and therefore the
+        checkpoint) still advance in pk order and throttling takes effect.
+
+        """
+        force, link, workers = options["force"], options["link"], options["workers"]
+        if workers == 1:
+            for pk_range in ranges:
+                yield pk_range, update_user_agent_chunk(force, pk_range, link)
+            return
+        # spawn (rather than fork) so workers never share our db connection
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+        ) as pool:
+            pending: Deque[Tuple[PkRange, Future]] = deque()
+            for pk_range in ranges:
+                future = pool.submit(update_user_agent_chunk, force, pk_range, link)
+                pending.append((pk_range, future))
+                if len(pending) >= workers * 2:
+                    done_range, done = pending.popleft()
+                    yield done_range, done.result()
+            while pending:
+                done_range, done = pending.popleft()
+                yield done_range, done.result()
@@ -0,0 +1,168 @@
+"""
+Counters and timings emitted by UserVisitMiddleware.
+
+The middleware reports to the backend configured by the
+USER_VISIT_METRICS_BACKEND setting (by default a no-op). Metric names:
+
+    Counters: excluded, anonymous, bypassed, recent_check_hit,
+    session_marker_hit, seen_cache_hit, duplicate.cache, duplicate.database,
+    duplicate.insert, recorded, dropped, error
+
+    Timings (seconds): overhead, build, dedup_check, insert
+
+"""
+
+from __future__ import annotations
+
+import contextlib
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .settings import METRICS_BACKEND, METRICS_OPTIONS
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsBackend:
+    """Base class for metrics backends - discards everything."""
+
+    def increment(self, name: str, value: int = 1) -> None:
+        """Increment the named counter."""
+
+    def timing(self, name: str, seconds: float) -> None:
+        """Record a duration (in seconds) in the named histogram."""
+
+    @contextlib.contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Record the time taken by the body of the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start)
+
+
+class NullMetrics(MetricsBackend):
+    """Backend used when no metrics backend is configured."""
+
+
+class InMemoryMetrics(MetricsBackend):
+    """
+    Keep counters and timings in memory.
+
+    Intended for tests and debugging - timings are kept in full, so this
+    should not be left running in production.
+
+    """
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.timings: Dict[str, List[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def timing(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.timings.clear()
+
+
+class StatsdMetrics(MetricsBackend):
+    """
+    Send metrics to a StatsD server over UDP.
+
+    Sends are fire-and-forget - errors are logged and otherwise ignored, so
+    a missing StatsD server never affects requests.
+
+    """
+
+    def __init__(
+        self, host: str = "localhost", port: int = 8125, prefix: str = "user_visit"
+    ) -> None:
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, stat: str) -> None:
+        try:
+            self.socket.sendto(f"{self.prefix}.{stat}".encode(), self.address)
+        except OSError:
+            logger.debug("Unable to send metric to StatsD", exc_info=True)
+
+    def increment(self, name: str, value: int = 1) -> None:
+        self.send(f"{name}:{value}|c")
+
+    def timing(self, name: str, seconds: float) -> None:
+        self.send(f"{name}:{seconds * 1000:.3f}|ms")
+
+
+# Prometheus collectors, keyed by (type, name) - a name can only be
+# registered once in the prometheus_client registry, so collectors are shared
+# by every PrometheusMetrics instance in the process (one per middleware).
+_prometheus_collectors: Dict[Tuple[str, str], Any] = {}
+_prometheus_lock = threading.Lock()
+
+
+class PrometheusMetrics(MetricsBackend):
+    """
+    Record metrics as Prometheus counters and histograms.
+
+    Requires the optional `prometheus_client` package - the metrics are
+    registered in its default registry, exported by whatever exposes that
+    registry in your project.
+
+    """
+
+    def __init__(self, namespace: str = "user_visit") -> None:
+        try:
+            import prometheus_client
+        except ImportError:
+            raise ImproperlyConfigured("PrometheusMetrics requires prometheus_client")
+        self.prometheus_client = prometheus_client
+        self.namespace = namespace
+
+    def _metric(self, cls: Any, name: str, doc: str) -> Any:
+        name = f"{self.namespace}_{name.replace('.', '_')}"
+        key = (cls.__name__, name)
+        with _prometheus_lock:
+            if key not in _prometheus_collectors:
+                _prometheus_collectors[key] = cls(name, doc)
+            return _prometheus_collectors[key]
+
+    def increment(self, name: str, value: int = 1) -> None:
+        counter = self._metric(
+            self.prometheus_client.Counter, name, f"UserVisit {name}"
+        )
+        counter.inc(value)
+
+    def timing(self, name: str, seconds: float) -> None:
+        histogram = self._metric(
+            self.prometheus_client.Histogram,
+            f"{name}_seconds",
+            f"UserVisit {name} time",
+        )
+        histogram.observe(seconds)
+
+
+def get_metrics_backend(
+    path: Optional[str] = METRICS_BACKEND,
+    options: Optional[Dict[str, Any]] = METRICS_OPTIONS,
+) -> MetricsBackend:
+    """Return a new instance of the configured metrics backend."""
+    if not path:
+        return NullMetrics()
+    return import_string(path)(**(options or {}))
@@ -1,46 +1,608 @@
+import contextlib
+import datetime
 import logging
+import time
 import typing
 
+import django
 import django.db
-from django.core.exceptions import MiddlewareNotUsed
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.dispatch import Signal
 from django.http import HttpRequest, HttpResponse
 from django.utils import timezone
 
-from user_visit.models import UserVisit
+from user_visit.models import (
+    UserVisit,
+    UserVisitDailySummary,
+    parse_remote_addr,
+    parse_session_key,
+    parse_ua_string,
+    request_visit_hash,
+    visit_md5,
+)
 
-from .settings import DUPLICATE_LOG_LEVEL, RECORDING_BYPASS, RECORDING_DISABLED
+from .dedup import RecentCheckCache, SeenHashCache, SharedHashCache
+from .metrics import get_metrics_backend
+from .rules import ExclusionRules
+from .settings import (
+    DEDUP_CACHE,
+    DUPLICATE_LOG_LEVEL,
+    EXCLUDE_METHODS,
+    EXCLUDE_PATHS,
+    RECHECK_CACHE_SIZE,
+    RECHECK_INTERVAL,
+    RECORDING_BYPASS,
+    RECORDING_DISABLED,
+    RECORDING_STRATEGY,
+    SEEN_HASH_CACHE_SIZE,
+    SESSION_MARKER,
+    SUMMARY_ON_WRITE,
+    USER_AGENT_PARSING,
+    USER_AGENT_TABLE,
+    WRITE_BATCH_INTERVAL,
+    WRITE_BATCH_SIZE,
+    WRITE_MODE,
+    WRITE_QUEUE_SIZE,
+)
+from .signals import visit_bypassed, visit_duplicate, visit_error, visit_recorded
+from .writers import BackgroundWriter, BatchWriter
 
 logger = logging.getLogger(__name__)
 
+# session key used to store the hash of the visit recorded for the session
+# (see USER_VISIT_SESSION_MARKER)
+SESSION_MARKER_KEY = "_user_visit_hash"
+
+
+def session_marker(request: HttpRequest, timestamp: datetime.datetime) -> str:
+    """
+    Return the value stored in the session once its visit has been recorded.
+
+    This is the visit hash without the session key - the marker is stored in
+    the session, so is already scoped to it, and the key of a signed cookie
+    session changes whenever the session data (e.g. the marker) changes.
+
+    """
+    return visit_md5(
+        request.user.pk,
+        timestamp.date(),
+        "",
+        parse_remote_addr(request),
+        parse_ua_string(request),
+    ).hexdigest()
+
 
 @django.db.transaction.atomic
-def save_user_visit(user_visit: UserVisit) -> None:
-    """Save the user visit and handle db.IntegrityError."""
+def save_user_visit(user_visit: UserVisit) -> bool:
+    """Save the user visit and handle db.IntegrityError, returning True if saved."""
     try:
         user_visit.save()
     except django.db.IntegrityError:
         getattr(logger, DUPLICATE_LOG_LEVEL)(
             "Error saving user visit (hash='%s')", user_visit.hash
         )
+        return False
+    return True
+
+
+async def asave_user_visit(user_visit: UserVisit) -> bool:
+    """Async version of save_user_visit."""
+    try:
+        await user_visit.asave()
+    except django.db.IntegrityError:
+        getattr(logger, DUPLICATE_LOG_LEVEL)(
+            "Error saving user visit (hash='%s')", user_visit.hash
+        )
+        return False
+    return True
+
+
+async def aget_request_user(request: HttpRequest) -> typing.Any:
+    """Load request.user without blocking the event loop."""
+    if hasattr(request, "auser"):
+        # Django 5.0+ - replace the lazy object with the loaded user so that
+        # sync code (e.g. RECORDING_BYPASS) can use request.user safely.
+        request.user = await request.auser()
+    else:
+        await sync_to_async(lambda: request.user.is_anonymous)()
+    return request.user
+
+
+def insert_sql(
+    connection: typing.Any, rows: int, returning: typing.Optional[str] = None
+) -> typing.Tuple[str, typing.List[typing.Any]]:
+    """Return the INSERT ... ON CONFLICT DO NOTHING statement and its fields."""
+    meta = UserVisit._meta
+    fields = [f for f in meta.concrete_fields if f is not meta.pk]
+    qn = connection.ops.quote_name
+    placeholders = "({})".format(", ".join(["%s"] * len(fields)))
+    # identifiers are quoted, values are parameters
+    sql = "INSERT INTO {} ({}) VALUES {} ON CONFLICT DO NOTHING".format(  # noqa: S608
+        qn(meta.db_table),
+        ", ".join(qn(f.column) for f in fields),
+        ", ".join([placeholders] * rows),
+    )
+    if returning:
+        sql += f" RETURNING {qn(returning)}"
+    return sql, fields
+
+
+def insert_values(
+    user_visit: UserVisit, fields: typing.List[typing.Any], connection: typing.Any
+) -> typing.List[typing.Any]:
+    """Return the INSERT parameters for the visit (setting its hash)."""
+    user_visit.visit_date = user_visit.date
+    user_visit.hash = user_visit.md5().hexdigest()
+    return [
+        f.get_db_prep_save(f.pre_save(user_visit, True), connection) for f in fields
+    ]
+
+
+def insert_user_visit(user_visit: UserVisit) -> bool:
+    """
+    Save the user visit with INSERT ... ON CONFLICT DO NOTHING.
+
+    A single statement (no pre-check, savepoint or IntegrityError handling)
+    that returns True if the row was inserted, False if a visit with the
+    same hash already exists. Falls back to save_user_visit on databases
+    that do not support ON CONFLICT.
+
+    """
+    connection = django.db.connections[
+        django.db.router.db_for_write(UserVisit, instance=user_visit)
+    ]
+    if connection.vendor not in ("postgresql", "sqlite"):
+        return save_user_visit(user_visit)
+    returning = connection.features.can_return_columns_from_insert
+    sql, fields = insert_sql(
+        connection, 1, UserVisit._meta.pk.column if returning else None
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, insert_values(user_visit, fields, connection))
+        if returning:
+            row = cursor.fetchone()
+            inserted = row is not None
+            user_visit.pk = row[0] if row else None
+        else:
+            inserted = cursor.rowcount == 1
+    if not inserted:
+        # an expected outcome, counted by the duplicate.insert metric
+        logger.debug("User visit already recorded (hash='%s')", user_visit.hash)
+        return False
+    user_visit._state.adding = False
+    user_visit._state.db = connection.alias
+    return True
+
+
+def _insert_user_visits(
+    connection: typing.Any, user_visits: typing.List[UserVisit]
+) -> typing.Set[str]:
+    """Insert the visits with ON CONFLICT DO NOTHING, returning the new hashes."""
+    inserted: typing.Set[str] = set()
+    _, fields = insert_sql(connection, 0)
+    # keep within the database limit on the number of query parameters
+    batch_size = max(connection.ops.bulk_batch_size(fields, user_visits), 1)
+    with connection.cursor() as cursor:
+        for start in range(0, len(user_visits), batch_size):
+            batch = user_visits[start : start + batch_size]
+            sql, _ = insert_sql(connection, len(batch), "hash")
+            cursor.execute(
+                sql,
+                [v for uv in batch for v in insert_values(uv, fields, connection)],
+            )
+            inserted.update(row[0] for row in cursor.fetchall())
+    return inserted
+
+
+def bulk_save_user_visits(user_visits: typing.List[UserVisit]) -> typing.Set[str]:
+    """
+    Save user visits in a single INSERT, skipping duplicate hashes.
+
+    Returns the hashes of the rows that were inserted. On databases that
+    cannot return rows from INSERT ... ON CONFLICT the hashes that already
+    exist are looked up first, so a concurrent insert may be reported as
+    inserted by both writers.
+
+    """
+    connection = django.db.connections[django.db.router.db_for_write(UserVisit)]
+    returning = connection.features.can_return_columns_from_insert
+    if connection.vendor in ("postgresql", "sqlite") and returning:
+        return _insert_user_visits(connection, user_visits)
+    hashes = {uv.hash for uv in user_visits}
+    existing = set(
+        UserVisit.objects.filter(hash__in=hashes).values_list("hash", flat=True)
+    )
+    UserVisit.objects.bulk_create(user_visits, ignore_conflicts=True)
+    return hashes - existing
 
 
 class UserVisitMiddleware:
     """Middleware to record user visits."""
 
+    sync_capable = True
+    # the async path relies on Model.asave (Django 4.2+)
+    async_capable = django.VERSION >= (4, 2)
+
     def __init__(self, get_response: typing.Callable) -> None:
         if RECORDING_DISABLED:
             raise MiddlewareNotUsed("UserVisit recording has been disabled")
+        self.check_settings()
         self.get_response = get_response
+        self.is_async = self.async_capable and iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        self.seen_cache = SeenHashCache(SEEN_HASH_CACHE_SIZE)
+        self.shared_cache = SharedHashCache(DEDUP_CACHE) if DEDUP_CACHE else None
+        self.recent_checks = (
+            RecentCheckCache(RECHECK_CACHE_SIZE, RECHECK_INTERVAL)
+            if RECHECK_INTERVAL
+            else None
+        )
+        self.rules = ExclusionRules(EXCLUDE_PATHS, EXCLUDE_METHODS)
+        self.metrics = get_metrics_backend()
+        self.writer: typing.Optional[BackgroundWriter] = None
+        if WRITE_MODE == "deferred":
+            self.writer = BackgroundWriter(self.record_visit, WRITE_QUEUE_SIZE)
+        elif WRITE_MODE == "batch":
+            self.writer = BatchWriter(
+                self.record_visits,
+                WRITE_QUEUE_SIZE,
+                batch_size=WRITE_BATCH_SIZE,
+                flush_interval=WRITE_BATCH_INTERVAL / 1000,
+            )
 
-    def __call__(self, request: HttpRequest) -> typing.Optional[HttpResponse]:
-        if request.user.is_anonymous:
-            return self.get_response(request)
+    @staticmethod
+    def check_settings() -> None:
+        """Raise ImproperlyConfigured for invalid USER_VISIT_* settings."""
+        if WRITE_MODE not in ("sync", "deferred", "batch"):
+            raise ImproperlyConfigured(f"Invalid USER_VISIT_WRITE_MODE: {WRITE_MODE}")
+        if WRITE_MODE == "batch" and SUMMARY_ON_WRITE:
+            raise ImproperlyConfigured(
+                "USER_VISIT_SUMMARY_ON_WRITE is not supported in the batch write mode"
+            )
+        if RECORDING_STRATEGY not in ("check", "upsert"):
+            raise ImproperlyConfigured(
+                f"Invalid USER_VISIT_RECORDING_STRATEGY: {RECORDING_STRATEGY}"
+            )
+        if USER_AGENT_PARSING not in ("eager", "lazy", "offline"):
+            raise ImproperlyConfigured(
+                f"Invalid USER_VISIT_USER_AGENT_PARSING: {USER_AGENT_PARSING}"
+            )
+
+    def __call__(
+        self, request: HttpRequest
+    ) -> typing.Union[HttpResponse, typing.Awaitable[HttpResponse], None]:
+        if self.is_async:
+            return self.__acall__(request)
 
-        if RECORDING_BYPASS(request):
+        start = time.perf_counter()
+        skip = self.skip_reason(request)
+        if skip == "bypassed":
+            visit_bypassed.send(sender=self.__class__, request=request)
+        uv = None if skip else self.new_visit(request)
+        if uv is None:
+            self.timing("overhead", time.perf_counter() - start)
             return self.get_response(request)
 
-        uv = UserVisit.objects.build(request, timezone.now())
-        if not UserVisit.objects.filter(hash=uv.hash).exists():
-            save_user_visit(uv)
+        if self.writer:
+            self.timing("overhead", time.perf_counter() - start)
+            try:
+                return self.get_response(request)
+            finally:
+                self.submit_visit(request, uv)
 
+        self.record_visit(uv)
+        self.mark_seen(request, uv)
+        self.timing("overhead", time.perf_counter() - start)
         return self.get_response(request)
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        start = time.perf_counter()
+        skip = await self.askip_reason(request)
+        if skip == "bypassed":
+            await self.asend(visit_bypassed, request=request)
+        uv = None if skip else self.new_visit(request)
+        if uv is None:
+            self.timing("overhead", time.perf_counter() - start)
+            return await self.get_response(request)
+
+        if self.writer:
+            self.timing("overhead", time.perf_counter() - start)
+            try:
+                return await self.get_response(request)
+            finally:
+                self.submit_visit(request, uv)
+
+        await self.arecord_visit(uv)
+        self.mark_seen(request, uv)
+        self.timing("overhead", time.perf_counter() - start)
+        return await self.get_response(request)
+
+    async def asend(self, signal: Signal, **kwargs: typing.Any) -> None:
+        """Send signal from async code (receivers may use the database)."""
+        if signal.has_listeners(self.__class__):
+            await sync_to_async(signal.send)(sender=self.__class__, **kwargs)
+
+    def increment(self, name: str) -> None:
+        """Increment the metrics counter - backend errors are only logged."""
+        try:
+            self.metrics.increment(name)
+        except Exception:
+            logger.exception("Error incrementing UserVisit metric '%s'", name)
+
+    def timing(self, name: str, seconds: float) -> None:
+        """Record the metrics timing - backend errors are only logged."""
+        try:
+            self.metrics.timing(name, seconds)
+        except Exception:
+            logger.exception("Error recording UserVisit metric '%s'", name)
+
+    @contextlib.contextmanager
+    def timer(self, name: str) -> typing.Iterator[None]:
+        """Record the time taken by the body of the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start)
+
+    def skip_reason(self, request: HttpRequest) -> typing.Optional[str]:
+        """Return why the request should not be recorded (None if it should)."""
+        reason: str
+        if self.rules.excludes(request):
+            reason = "excluded"
+        elif request.user.is_anonymous:
+            reason = "anonymous"
+        elif RECORDING_BYPASS(request):
+            reason = "bypassed"
+        else:
+            return None
+        self.increment(reason)
+        return reason
+
+    async def askip_reason(self, request: HttpRequest) -> typing.Optional[str]:
+        """Async version of skip_reason."""
+        reason: str
+        if self.rules.excludes(request):
+            reason = "excluded"
+        elif (await aget_request_user(request)).is_anonymous:
+            reason = "anonymous"
+        # RECORDING_BYPASS may use the database
+        elif await sync_to_async(RECORDING_BYPASS)(request):
+            reason = "bypassed"
+        else:
+            return None
+        self.increment(reason)
+        return reason
+
+    def new_visit(self, request: HttpRequest) -> typing.Optional[UserVisit]:
+        """Return the visit for the request, or None if it is known to exist."""
+        timestamp = timezone.now()
+        session = (request.user.pk, parse_session_key(request))
+        if self.recent_checks is not None and self.recent_checks.contains(
+            timestamp.date(), session
+        ):
+            self.increment("recent_check_hit")
+            return None
+        marker = session_marker(request, timestamp) if SESSION_MARKER else None
+        if marker and request.session.get(SESSION_MARKER_KEY) == marker:
+            self.increment("session_marker_hit")
+            return None
+        if self.seen_cache.contains(
+            timestamp.date(), request_visit_hash(request, timestamp)
+        ):
+            self.increment("seen_cache_hit")
+            if self.recent_checks is not None:
+                self.recent_checks.add(timestamp.date(), session)
+            if marker:
+                request.session[SESSION_MARKER_KEY] = marker
+            return None
+        with self.timer("build"):
+            return self.build_visit(request, timestamp)
+
+    def mark_seen(self, request: HttpRequest, uv: UserVisit) -> None:
+        """Remember that the visit has been recorded (or queued)."""
+        self.seen_cache.add(uv.date, uv.hash)
+        if self.recent_checks is not None:
+            self.recent_checks.add(uv.date, (uv.user_id, uv.session_key))
+        if SESSION_MARKER:
+            request.session[SESSION_MARKER_KEY] = session_marker(request, uv.timestamp)
+
+    def build_visit(
+        self, request: HttpRequest, timestamp: datetime.datetime
+    ) -> UserVisit:
+        """Build the visit for the current request, without saving it."""
+        return UserVisit.objects.build(
+            request,
+            timestamp,
+            with_user_agent_data=USER_AGENT_PARSING == "eager" and not USER_AGENT_TABLE,
+            # only extract the context for visits that are written
+            with_context=False,
+        )
+
+    def prepare_visit(self, uv: UserVisit) -> UserVisit:
+        """Complete a visit that is about to be written."""
+        if USER_AGENT_TABLE and USER_AGENT_PARSING != "offline":
+            uv.link_user_agent()
+        elif USER_AGENT_PARSING == "lazy":
+            uv.update_user_agent_data()
+        uv.update_context()
+        return uv
+
+    async def aprepare_visit(self, uv: UserVisit) -> UserVisit:
+        """Async version of prepare_visit."""
+        # the UserAgent lookup and REQUEST_CONTEXT_EXTRACTOR may use the
+        # database - this only runs for new visits, so the thread is cheap
+        return await sync_to_async(self.prepare_visit)(uv)
+
+    def submit_visit(self, request: HttpRequest, uv: UserVisit) -> None:
+        """Hand the visit to the background writer."""
+        if self.writer and self.writer.submit(uv):
+            self.mark_seen(request, uv)
+        else:
+            self.increment("dropped")
+
+    def write_visit(self, uv: UserVisit) -> bool:
+        """Write the visit using the recording strategy, True if saved."""
+        if RECORDING_STRATEGY == "upsert":
+            return insert_user_visit(uv)
+        return save_user_visit(uv)
+
+    async def awrite_visit(self, uv: UserVisit) -> bool:
+        """Async version of write_visit."""
+        if RECORDING_STRATEGY == "upsert":
+            return await sync_to_async(insert_user_visit)(uv)
+        return await asave_user_visit(uv)
+
+    def duplicate_source(
+        self, uv: UserVisit, claimed: typing.Optional[bool]
+    ) -> typing.Optional[str]:
+        """Return where the visit was found to be a duplicate (None if new)."""
+        if claimed is False:
+            # another request has already claimed this hash
+            return "cache"
+        if claimed is not None or RECORDING_STRATEGY == "upsert":
+            return None
+        # the hash includes the date - filtering on it too lets a partitioned
+        # table (see user_visit.partitioning) check a single partition
+        if UserVisit.objects.filter(hash=uv.hash, visit_date=uv.visit_date).exists():
+            return "database"
+        return None
+
+    def notify(self, metric: str, signal: Signal, **kwargs: typing.Any) -> None:
+        """Increment the metric counter and send the signal."""
+        self.increment(metric)
+        signal.send(sender=self.__class__, **kwargs)
+
+    async def anotify(self, metric: str, signal: Signal, **kwargs: typing.Any) -> None:
+        """Async version of notify."""
+        self.increment(metric)
+        await self.asend(signal, **kwargs)
+
+    def record_visit(self, uv: UserVisit) -> None:
+        """Save the visit unless it has already been recorded today."""
+        with self.timer("dedup_check"):
+            claimed = (
+                self.shared_cache.add(uv.hash, uv.timestamp)
+                if self.shared_cache
+                else None
+            )
+            duplicate = self.duplicate_source(uv, claimed)
+        if duplicate:
+            self.notify(
+                f"duplicate.{duplicate}",
+                visit_duplicate,
+                user_visit=uv,
+                source=duplicate,
+            )
+            return
+        try:
+            with self.timer("insert"):
+                saved = self.write_visit(self.prepare_visit(uv))
+        except Exception as ex:
+            if claimed and self.shared_cache:
+                self.shared_cache.discard(uv.hash)
+            self.notify("error", visit_error, user_visit=uv, exception=ex)
+            raise
+        if not saved:
+            self.notify(
+                "duplicate.insert", visit_duplicate, user_visit=uv, source="insert"
+            )
+            return
+        if SUMMARY_ON_WRITE:
+            UserVisitDailySummary.objects.increment(uv)
+        self.notify("recorded", visit_recorded, user_visit=uv)
+
+    async def arecord_visit(self, uv: UserVisit) -> None:
+        """Async version of record_visit."""
+        with self.timer("dedup_check"):
+            claimed = (
+                await self.shared_cache.aadd(uv.hash, uv.timestamp)
+                if self.shared_cache
+                else None
+            )
+            duplicate = "cache" if claimed is False else None
+            if (
+                claimed is None
+                and RECORDING_STRATEGY == "check"
+                and await UserVisit.objects.filter(
+                    hash=uv.hash, visit_date=uv.visit_date
+                ).aexists()
+            ):
+                duplicate = "database"
+        if duplicate:
+            await self.anotify(
+                f"duplicate.{duplicate}",
+                visit_duplicate,
+                user_visit=uv,
+                source=duplicate,
+            )
+            return
+        try:
+            with self.timer("insert"):
+                saved = await self.awrite_visit(await self.aprepare_visit(uv))
+        except Exception as ex:
+            if claimed and self.shared_cache:
+                await self.shared_cache.adiscard(uv.hash)
+            await self.anotify("error", visit_error, user_visit=uv, exception=ex)
+            raise
+        if not saved:
+            await self.anotify(
+                "duplicate.insert", visit_duplicate, user_visit=uv, source="insert"
+            )
+            return
+        if SUMMARY_ON_WRITE:
+            await sync_to_async(UserVisitDailySummary.objects.increment)(uv)
+        await self.anotify("recorded", visit_recorded, user_visit=uv)
+
+    def claim_visits(
+        self, visits: typing.List[UserVisit]
+    ) -> typing.Tuple[typing.List[UserVisit], typing.List[str]]:
+        """
+        Claim the visits in the shared cache, skipping those claimed elsewhere.
+
+        Returns the visits to save, and the hashes claimed for them (which
+        are released if the save fails).
+
+        """
+        if not self.shared_cache:
+            return visits, []
+        unclaimed, claimed = [], []
+        for uv in visits:
+            added = self.shared_cache.add(uv.hash, uv.timestamp)
+            if added is False:
+                self.notify(
+                    "duplicate.cache", visit_duplicate, user_visit=uv, source="cache"
+                )
+                continue
+            if added:
+                claimed.append(uv.hash)
+            unclaimed.append(uv)
+        return unclaimed, claimed
+
+    def record_visits(self, visits: typing.List[UserVisit]) -> None:
+        """Save a batch of visits, skipping those already claimed elsewhere."""
+        visits, claimed = self.claim_visits(visits)
+        if not visits:
+            return
+        try:
+            with self.timer("insert"):
+                inserted = bulk_save_user_visits(
+                    [self.prepare_visit(uv) for uv in visits]
+                )
+        except Exception:
+            # release the claims so that the visits can be recorded later
+            if self.shared_cache:
+                for uv_hash in claimed:
+                    self.shared_cache.discard(uv_hash)
+            raise
+        for uv in visits:
+            if uv.hash in inserted:
+                # a hash may be queued more than once - only one is recorded
+                inserted.discard(uv.hash)
+                self.notify("recorded", visit_recorded, user_visit=uv)
+            else:
+                self.notify(
+                    "duplicate.insert", visit_duplicate, user_visit=uv, source="insert"
+                )
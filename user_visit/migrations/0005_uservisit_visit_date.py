@@ -0,0 +1,86 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:41
+
+import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+BATCH_SIZE = 10000
+
+INDEXES = [
+    models.Index(fields=["user", "visit_date"], name="user_visit_user_date_idx"),
+    models.Index(fields=["visit_date"], name="user_visit_date_idx"),
+    models.Index(fields=["timestamp"], name="user_visit_timestamp_idx"),
+]
+
+
+def set_visit_date(apps, schema_editor):
+    """Backfill visit_date in pk batches, committing each batch."""
+    UserVisit = apps.get_model("user_visit", "UserVisit")
+    visits = UserVisit.objects.using(schema_editor.connection.alias).filter(
+        visit_date__isnull=True
+    )
+    last_pk = 0
+    while True:
+        pks = list(
+            visits.filter(pk__gt=last_pk)
+            .order_by("pk")
+            .values_list("pk", flat=True)[:BATCH_SIZE]
+        )
+        if not pks:
+            return
+        visits.filter(pk__gte=pks[0], pk__lte=pks[-1]).update(
+            visit_date=TruncDate("timestamp", tzinfo=datetime.timezone.utc)
+        )
+        last_pk = pks[-1]
+
+
+def add_indexes(apps, schema_editor):
+    """Add the indexes - CONCURRENTLY on PostgreSQL, so writes are not blocked."""
+    UserVisit = apps.get_model("user_visit", "UserVisit")
+    for index in INDEXES:
+        if schema_editor.connection.vendor == "postgresql":
+            schema_editor.add_index(UserVisit, index, concurrently=True)
+        else:
+            schema_editor.add_index(UserVisit, index)
+
+
+def remove_indexes(apps, schema_editor):
+    UserVisit = apps.get_model("user_visit", "UserVisit")
+    for index in INDEXES:
+        if schema_editor.connection.vendor == "postgresql":
+            schema_editor.remove_index(UserVisit, index, concurrently=True)
+        else:
+            schema_editor.remove_index(UserVisit, index)
+
+
+class Migration(migrations.Migration):
+    # each backfill batch is committed separately, and CREATE INDEX
+    # CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ("user_visit", "0004_uservisit_browser_uservisit_device_uservisit_os"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="uservisit",
+            name="visit_date",
+            field=models.DateField(
+                blank=True,
+                help_text="The date of the visit (denormalised from timestamp)",
+                null=True,
+            ),
+        ),
+        migrations.RunPython(set_visit_date, migrations.RunPython.noop),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(add_indexes, remove_indexes)],
+            state_operations=[
+                migrations.AddIndex(model_name="uservisit", index=index)
+                for index in INDEXES
+            ],
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user_visit", "0005_uservisit_visit_date"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserVisitDailySummary",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                (
+                    "dimension",
+                    models.CharField(
+                        choices=[
+                            ("all", "All visits"),
+                            ("browser", "Browser"),
+                            ("device", "Device type"),
+                            ("os", "Operating System"),
+                        ],
+                        max_length=10,
+                    ),
+                ),
+                (
+                    "value",
+                    models.CharField(
+                        blank=True,
+                        default="",
+                        help_text="The browser / device / OS (blank for 'all')",
+                        max_length=200,
+                    ),
+                ),
+                ("visit_count", models.PositiveIntegerField(default=0)),
+                (
+                    "user_count",
+                    models.PositiveIntegerField(
+                        default=0, help_text="Number of distinct users"
+                    ),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "verbose_name_plural": "User visit daily summaries",
+                "get_latest_by": "date",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("date", "dimension", "value"),
+                        name="user_visit_summary_unique_row",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:58
+
+from django.conf import settings
+from django.db import migrations, models
+
+INDEX = models.Index(
+    fields=["user", "-timestamp", "-id"], name="user_visit_user_history_idx"
+)
+
+
+def add_index(apps, schema_editor):
+    """Add the index - CONCURRENTLY on PostgreSQL, so writes are not blocked."""
+    UserVisit = apps.get_model("user_visit", "UserVisit")
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.add_index(UserVisit, INDEX, concurrently=True)
+    else:
+        schema_editor.add_index(UserVisit, INDEX)
+
+
+def remove_index(apps, schema_editor):
+    UserVisit = apps.get_model("user_visit", "UserVisit")
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.remove_index(UserVisit, INDEX, concurrently=True)
+    else:
+        schema_editor.remove_index(UserVisit, INDEX)
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ("user_visit", "0006_uservisitdailysummary"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(add_index, remove_index)],
+            state_operations=[migrations.AddIndex(model_name="uservisit", index=INDEX)],
+        ),
+    ]
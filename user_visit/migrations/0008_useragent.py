@@ -0,0 +1,77 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user_visit", "0007_uservisit_user_history_idx"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserAgent",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "hash",
+                    models.CharField(
+                        help_text="MD5 hash of the User-Agent string",
+                        max_length=32,
+                        unique=True,
+                    ),
+                ),
+                (
+                    "ua_string",
+                    models.TextField(
+                        blank=True,
+                        help_text="Client User-Agent HTTP header",
+                        verbose_name="User agent (raw)",
+                    ),
+                ),
+                ("browser", models.CharField(blank=True, default="", max_length=200)),
+                (
+                    "device",
+                    models.CharField(
+                        blank=True,
+                        default="",
+                        max_length=200,
+                        verbose_name="Device type",
+                    ),
+                ),
+                (
+                    "os",
+                    models.CharField(
+                        blank=True,
+                        default="",
+                        max_length=200,
+                        verbose_name="Operating System",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="uservisit",
+            name="agent",
+            field=models.ForeignKey(
+                blank=True,
+                db_index=False,
+                help_text="Parsed User-Agent (see USER_VISIT_USER_AGENT_TABLE)",
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="user_visits",
+                to="user_visit.useragent",
+            ),
+        ),
+    ]
@@ -1,18 +1,33 @@
 from __future__ import annotations
 
+import base64
+import binascii
 import datetime
+import functools
 import hashlib
 import uuid
-from typing import Any
+from typing import Any, NamedTuple
 
 import user_agents
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
 from django.http import HttpRequest
 from django.utils import timezone
+from django.utils.module_loading import import_string
 from django.utils.translation import gettext_lazy as _lazy
 
-from user_visit.settings import REQUEST_CONTEXT_ENCODER, REQUEST_CONTEXT_EXTRACTOR
+from user_visit.settings import (
+    REQUEST_CONTEXT_ENCODER,
+    REQUEST_CONTEXT_EXTRACTOR,
+    USER_AGENT_CACHE_SIZE,
+    USER_AGENT_TABLE,
+)
+
+ONE_DAY = datetime.timedelta(days=1)
+
+# max_length of UserVisit.session_key (the length of a db session key)
+SESSION_KEY_MAX_LENGTH = 40
 
 
 def parse_remote_addr(request: HttpRequest) -> str:
@@ -23,31 +38,355 @@ def parse_remote_addr(request: HttpRequest) -> str:
     return request.META.get("REMOTE_ADDR", "")
 
 
+def parse_session_key(request: HttpRequest) -> str:
+    """
+    Extract the session key from request.
+
+    Keys longer than UserVisit.session_key allows (e.g. those of signed
+    cookie sessions, which contain the session data) are replaced with a
+    fixed-length digest.
+
+    """
+    session_key = request.session.session_key
+    if session_key and len(session_key) > SESSION_KEY_MAX_LENGTH:
+        return hashlib.blake2b(
+            session_key.encode(), digest_size=SESSION_KEY_MAX_LENGTH // 2
+        ).hexdigest()
+    return session_key
+
+
 def parse_ua_string(request: HttpRequest) -> str:
     """Extract client user-agent from request."""
     return request.headers.get("User-Agent", "")
 
 
-class UserVisitManager(models.Manager):
+def extract_context(request: HttpRequest) -> dict:
+    """Return the context for a visit using REQUEST_CONTEXT_EXTRACTOR."""
+    extractor = REQUEST_CONTEXT_EXTRACTOR
+    if isinstance(extractor, str):
+        extractor = import_string(extractor)
+    return extractor(request)
+
+
+# see https://github.com/python/typeshed/issues/2928 re. return type
+def visit_md5(
+    user_id: Any,
+    date: datetime.date,
+    session_key: str,
+    remote_addr: str,
+    ua_string: str,
+) -> hashlib._Hash:
+    """Generate MD5 hash used to identify duplicate visits."""
+    h = hashlib.md5(str(user_id).encode())  # noqa: S303, S324
+    h.update(date.isoformat().encode())
+    h.update(session_key.encode())
+    h.update(remote_addr.encode())
+    h.update(ua_string.encode())
+    return h
+
+
+def request_visit_hash(request: HttpRequest, timestamp: datetime.datetime) -> str:
+    """
+    Return the hash of the visit a request would record, as a hex string.
+
+    This is the same value as UserVisit.hash for the object that
+    UserVisitManager.build would return, without building it.
+
+    """
+    return visit_md5(
+        request.user.pk,
+        timestamp.date(),
+        parse_session_key(request),
+        parse_remote_addr(request),
+        parse_ua_string(request),
+    ).hexdigest()
+
+
+class UserAgentData(NamedTuple):
+    """Denormalised browser, device and OS values from a User-Agent."""
+
+    browser: str
+    device: str
+    os: str
+
+
+@functools.lru_cache(maxsize=USER_AGENT_CACHE_SIZE)
+def parse_user_agent(ua_string: str) -> user_agents.parsers.UserAgent:
+    """
+    Parse a User-Agent string, caching the result.
+
+    Parsing is regex-heavy and real traffic contains relatively few
+    distinct User-Agents, so results are cached in a per-process LRU cache
+    shared by the model, middleware and management commands. Use
+    `parse_user_agent.cache_info()` to see the hit rate.
+
+    """
+    return user_agents.parsers.parse(ua_string)
+
+
+def user_agent_data(ua_string: str) -> UserAgentData:
+    """Return browser, device and OS (truncated to fit the model fields)."""
+    user_agent = parse_user_agent(ua_string)
+    return UserAgentData(
+        browser=user_agent.get_browser()[:200],
+        device=user_agent.get_device()[:200],
+        os=user_agent.get_os()[:200],
+    )
+
+
+def user_agent_hash(ua_string: str) -> str:
+    """Return the MD5 hash (hex) used to identify a UserAgent."""
+    return hashlib.md5(ua_string.encode()).hexdigest()  # noqa: S303, S324
+
+
+@functools.lru_cache(maxsize=USER_AGENT_CACHE_SIZE)
+def get_user_agent(ua_string: str) -> UserAgent:
+    """
+    Return the UserAgent for a User-Agent string, creating it if required.
+
+    Results are cached per process (like parse_user_agent), so the table
+    is only queried once per distinct User-Agent. Referenced rows cannot be
+    deleted, but call `get_user_agent.cache_clear()` if they are.
+
+    """
+    return UserAgent.objects.get_for_ua_string(ua_string)
+
+
+def user_agent_field(name: str) -> Any:
+    """
+    Return an expression for a visit's browser, device or os.
+
+    With USER_VISIT_USER_AGENT_TABLE this is the value from the linked
+    UserAgent, falling back to the visit's own (denormalised) field for
+    visits that are not linked.
+
+    """
+    if not USER_AGENT_TABLE:
+        return models.F(name)
+    return Coalesce(models.F(f"agent__{name}"), models.F(name))
+
+
+class VisitPage(NamedTuple):
+    """A page of visits, and the cursor for the next page (None if last)."""
+
+    visits: list[UserVisit]
+    next_cursor: str | None
+
+
+def encode_cursor(timestamp: datetime.datetime, pk: int) -> str:
+    """Return an opaque keyset pagination cursor for a visit."""
+    value = f"{timestamp.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(value).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    """Return the (timestamp, pk) from a cursor, raising ValueError if invalid."""
+    try:
+        timestamp, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.datetime.fromisoformat(timestamp), int(pk)
+    except (binascii.Error, UnicodeDecodeError) as ex:
+        raise ValueError(f"Invalid cursor: {cursor}") from ex
+
+
+class UserVisitQuerySet(models.QuerySet):
+    """
+    Queries over a user's visit history.
+
+    Histories are ordered newest first, on (timestamp, id) - which is
+    backed by the (user, -timestamp, -id) index - so that per-user queries
+    and keyset pagination are index range scans however far back they go.
+
+    """
+
+    def for_user(self, user: Any) -> UserVisitQuerySet:
+        """Filter to the visits of a user (or user pk)."""
+        return self.filter(user=user)
+
+    def between(
+        self,
+        start: datetime.date | datetime.datetime,
+        end: datetime.date | datetime.datetime,
+    ) -> UserVisitQuerySet:
+        """
+        Filter to visits between start and end.
+
+        Dates are inclusive (on visit_date); datetimes are a half-open
+        [start, end) range on timestamp. Datetime ranges are also bounded on
+        visit_date (allowing a day either side for timezones), so that they
+        are pruned to the matching partitions of a partitioned table.
+
+        """
+        if isinstance(start, datetime.datetime) and isinstance(end, datetime.datetime):
+            return self.filter(
+                timestamp__gte=start,
+                timestamp__lt=end,
+                visit_date__gte=start.date() - ONE_DAY,
+                visit_date__lte=end.date() + ONE_DAY,
+            )
+        return self.filter(visit_date__gte=start, visit_date__lte=end)
+
+    def newest_first(self) -> UserVisitQuerySet:
+        """Order by (timestamp, id) descending - the keyset order."""
+        return self.order_by("-timestamp", "-id")
+
+    def before(self, timestamp: datetime.datetime, pk: int) -> UserVisitQuerySet:
+        """Filter to visits after (timestamp, pk) in newest first order."""
+        # timestamp__lte bounds the index scan, the OR resolves ties
+        return self.filter(
+            models.Q(timestamp__lt=timestamp) | models.Q(id__lt=pk),
+            timestamp__lte=timestamp,
+        )
+
+    def keyset_page(self, cursor: str | None = None, size: int = 50) -> VisitPage:
+        """
+        Return a page of visits, newest first, starting after cursor.
+
+        Unlike OFFSET pagination each page is a single index range scan,
+        however deep. Pass the returned next_cursor to get the next page.
+
+        """
+        visits = self.newest_first()
+        if cursor:
+            visits = visits.before(*decode_cursor(cursor))
+        page = list(visits[: size + 1])
+        if len(page) <= size:
+            return VisitPage(page, None)
+        last = page[size - 1]
+        return VisitPage(page[:size], encode_cursor(last.timestamp, last.pk))
+
+    def latest_per_device(self) -> UserVisitQuerySet:
+        """Filter to the most recent visit for each user and User-Agent."""
+        latest = (
+            UserVisit.objects.filter(
+                user=models.OuterRef("user"), ua_string=models.OuterRef("ua_string")
+            )
+            .newest_first()
+            .values("pk")[:1]
+        )
+        return self.filter(pk=models.Subquery(latest)).newest_first()
+
+    def distinct_ips(self) -> models.QuerySet:
+        """
+        Return the distinct IP addresses, most recently used first.
+
+        Each row is a dict of remote_addr, first_seen, last_seen and visits.
+
+        """
+        return (
+            self.order_by()
+            .values("remote_addr")
+            .annotate(
+                first_seen=models.Min("timestamp"),
+                last_seen=models.Max("timestamp"),
+                visits=models.Count("id"),
+            )
+            .order_by("-last_seen")
+        )
+
+
+class UserVisitManager(models.Manager.from_queryset(UserVisitQuerySet)):  # type: ignore
     """Custom model manager for UserVisit objects."""
 
-    def build(self, request: HttpRequest, timestamp: datetime.datetime) -> UserVisit:
-        """Build a new UserVisit object from a request, without saving it."""
+    def build(
+        self,
+        request: HttpRequest,
+        timestamp: datetime.datetime,
+        with_user_agent_data: bool = True,
+        with_context: bool = True,
+    ) -> UserVisit:
+        """
+        Build a new UserVisit object from a request, without saving it.
+
+        If `with_user_agent_data` is False the browser, device and os fields
+        are left blank - call `update_user_agent_data` to populate them.
+
+        If `with_context` is False the request context extractor is not
+        called - call `update_context` to call it before saving.
+
+        """
         uv = UserVisit(
             user=request.user,
             timestamp=timestamp,
-            session_key=request.session.session_key,
+            session_key=parse_session_key(request),
             remote_addr=parse_remote_addr(request),
             ua_string=parse_ua_string(request),
-            context=REQUEST_CONTEXT_EXTRACTOR(request),
         )
+        if with_context:
+            uv.context = extract_context(request)
+        else:
+            uv.context_request = request
+        uv.visit_date = uv.date
         uv.hash = uv.md5().hexdigest()
-        uv.browser = uv.user_agent.get_browser()[:200]
-        uv.device = uv.user_agent.get_device()[:200]
-        uv.os = uv.user_agent.get_os()[:200]
+        if with_user_agent_data:
+            uv.update_user_agent_data()
         return uv
 
 
+class UserAgentManager(models.Manager):
+    """Custom model manager for UserAgent objects."""
+
+    def get_for_ua_string(self, ua_string: str) -> UserAgent:
+        """Return the UserAgent for a User-Agent string, creating it if required."""
+        user_agent, _ = self.get_or_create(
+            hash=user_agent_hash(ua_string),
+            defaults={"ua_string": ua_string, **user_agent_data(ua_string)._asdict()},
+        )
+        return user_agent
+
+
+class UserAgent(models.Model):
+    """
+    A distinct User-Agent string, with its parsed browser, device and OS.
+
+    Real traffic contains relatively few distinct User-Agents, so storing
+    the parsed values once here and linking visits to them (see
+    USER_VISIT_USER_AGENT_TABLE) keeps the UserVisit rows small, and
+    reports grouped by browser / device / OS join against a tiny table.
+
+    """
+
+    hash = models.CharField(  # noqa: A003
+        max_length=32,
+        help_text=_lazy("MD5 hash of the User-Agent string"),
+        unique=True,
+    )
+    ua_string = models.TextField(
+        _lazy("User agent (raw)"),
+        help_text=_lazy("Client User-Agent HTTP header"),
+        blank=True,
+    )
+    browser = models.CharField(
+        max_length=200,
+        blank=True,
+        default="",
+    )
+    device = models.CharField(
+        _lazy("Device type"),
+        max_length=200,
+        blank=True,
+        default="",
+    )
+    os = models.CharField(
+        _lazy("Operating System"),
+        max_length=200,
+        blank=True,
+        default="",
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = UserAgentManager()
+
+    def __str__(self) -> str:
+        return f"{self.browser} / {self.device} / {self.os}"
+
+    def __repr__(self) -> str:
+        return f"<UserAgent id={self.id} hash='{self.hash}'>"
+
+    @property
+    def user_agent_data(self) -> UserAgentData:
+        return UserAgentData(self.browser, self.device, self.os)
+
+
 class UserVisit(models.Model):
     """
     Record of a user visiting the site on a given day.
@@ -71,7 +410,14 @@ class UserVisit(models.Model):
         help_text=_lazy("The time at which the first visit of the day was recorded"),
         default=timezone.now,
     )
-    session_key = models.CharField(help_text="Django session identifier", max_length=40)
+    visit_date = models.DateField(
+        help_text=_lazy("The date of the visit (denormalised from timestamp)"),
+        null=True,
+        blank=True,
+    )
+    session_key = models.CharField(
+        help_text="Django session identifier", max_length=SESSION_KEY_MAX_LENGTH
+    )
     remote_addr = models.CharField(
         help_text=_lazy(
             "Client IP address (from X-Forwarded-For HTTP header, "
@@ -102,6 +448,16 @@ class UserVisit(models.Model):
         blank=True,
         default="",
     )
+    agent = models.ForeignKey(
+        UserAgent,
+        related_name="user_visits",
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        # joins are from visits to user agents - no need for the index
+        db_index=False,
+        help_text=_lazy("Parsed User-Agent (see USER_VISIT_USER_AGENT_TABLE)"),
+    )
     uuid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     hash = models.CharField(  # noqa: A003
         max_length=32,
@@ -124,8 +480,23 @@ class UserVisit(models.Model):
 
     objects = UserVisitManager()
 
+    # The request the visit was built from, while its context has yet to be
+    # extracted (see UserVisitManager.build) - not saved.
+    context_request: HttpRequest | None = None
+
     class Meta:
         get_latest_by = "timestamp"
+        indexes = [
+            models.Index(
+                fields=["user", "visit_date"], name="user_visit_user_date_idx"
+            ),
+            models.Index(fields=["visit_date"], name="user_visit_date_idx"),
+            models.Index(fields=["timestamp"], name="user_visit_timestamp_idx"),
+            models.Index(
+                fields=["user", "-timestamp", "-id"],
+                name="user_visit_user_history_idx",
+            ),
+        ]
 
     def __str__(self) -> str:
         return f"{self.user} visited the site on {self.timestamp}"
@@ -134,14 +505,35 @@ class UserVisit(models.Model):
         return f"<UserVisit id={self.id} user_id={self.user_id} date='{self.date}'>"
 
     def save(self, *args: Any, **kwargs: Any) -> None:
-        """Set hash property and save object."""
+        """Set hash and visit_date properties and save object."""
+        self.visit_date = self.date
         self.hash = self.md5().hexdigest()
         super().save(*args, **kwargs)
 
+    def update_user_agent_data(self) -> None:
+        """Set browser, device and os from the raw user agent string."""
+        self.browser, self.device, self.os = user_agent_data(self.ua_string)
+
+    def link_user_agent(self) -> None:
+        """Link the visit to the UserAgent for the raw user agent string."""
+        self.agent = get_user_agent(self.ua_string)
+
+    def get_user_agent_data(self) -> UserAgentData:
+        """Return browser, device and OS - from the linked UserAgent if set."""
+        if self.agent_id is not None:
+            return self.agent.user_agent_data
+        return UserAgentData(self.browser, self.device, self.os)
+
+    def update_context(self) -> None:
+        """Set context from the request, if its extraction is pending."""
+        if self.context_request is not None:
+            self.context = extract_context(self.context_request)
+            self.context_request = None
+
     @property
     def user_agent(self) -> user_agents.parsers.UserAgent:
         """Return UserAgent object from the raw user_agent string."""
-        return user_agents.parsers.parse(self.ua_string)
+        return parse_user_agent(self.ua_string)
 
     @property
     def date(self) -> datetime.date:
@@ -151,9 +543,153 @@ class UserVisit(models.Model):
     # see https://github.com/python/typeshed/issues/2928 re. return type
     def md5(self) -> hashlib._Hash:
         """Generate MD5 hash used to identify duplicate visits."""
-        h = hashlib.md5(str(self.user.id).encode())  # noqa: S303, S324
-        h.update(self.date.isoformat().encode())
-        h.update(self.session_key.encode())
-        h.update(self.remote_addr.encode())
-        h.update(self.ua_string.encode())
-        return h
+        return visit_md5(
+            self.user_id,
+            self.date,
+            self.session_key,
+            self.remote_addr,
+            self.ua_string,
+        )
+
+
+class UserVisitDailySummaryManager(models.Manager):
+    """Custom model manager for UserVisitDailySummary objects."""
+
+    def summarise(self, date: datetime.date) -> int:
+        """
+        (Re)build the summary rows for a single day from UserVisit.
+
+        Returns the number of summary rows written.
+
+        """
+        visits = UserVisit.objects.filter(visit_date=date)
+        totals = visits.aggregate(
+            visits=models.Count("id"), users=models.Count("user", distinct=True)
+        )
+        rows = []
+        if totals["visits"]:
+            rows.append(
+                self.model(
+                    date=date,
+                    dimension=UserVisitDailySummary.Dimension.ALL,
+                    visit_count=totals["visits"],
+                    user_count=totals["users"],
+                )
+            )
+        for dimension in UserVisitDailySummary.BREAKDOWNS:
+            breakdown = (
+                visits.order_by()
+                .annotate(dimension_value=user_agent_field(dimension))
+                .values("dimension_value")
+                .annotate(
+                    visits=models.Count("id"),
+                    users=models.Count("user", distinct=True),
+                )
+            )
+            rows.extend(
+                self.model(
+                    date=date,
+                    dimension=dimension,
+                    value=row["dimension_value"],
+                    visit_count=row["visits"],
+                    user_count=row["users"],
+                )
+                for row in breakdown
+            )
+        with transaction.atomic():
+            self.filter(date=date).delete()
+            self.bulk_create(rows)
+        return len(rows)
+
+    def increment(self, user_visit: UserVisit) -> None:
+        """
+        Add a newly saved visit to the summary rows for its day.
+
+        The user count for each row is only incremented if this is the
+        user's first visit of the day matching that row, which is a cheap
+        lookup on the (user, visit_date) index. Only visits with a lower pk
+        count as earlier, so that concurrent first visits (each committed
+        before the other's lookup) do not both skip the user - the visit
+        with the lowest pk always counts. (Under a race the count can still
+        be slightly high; update_user_visit_summary recalculates it.)
+
+        """
+        date = user_visit.visit_date or user_visit.date
+        same_day = UserVisit.objects.filter(
+            user_id=user_visit.user_id, visit_date=date, pk__lt=user_visit.pk
+        )
+        user_agent = user_visit.get_user_agent_data()
+        dimensions = [(UserVisitDailySummary.Dimension.ALL, "", same_day)] + [
+            (
+                dimension,
+                getattr(user_agent, dimension),
+                same_day.alias(dimension_value=user_agent_field(dimension)).filter(
+                    dimension_value=getattr(user_agent, dimension)
+                ),
+            )
+            for dimension in UserVisitDailySummary.BREAKDOWNS
+        ]
+        for dimension, value, previous in dimensions:
+            is_new_user = 0 if previous.exists() else 1
+            summary, created = self.get_or_create(
+                date=date,
+                dimension=dimension,
+                value=value,
+                defaults={"visit_count": 1, "user_count": is_new_user},
+            )
+            if not created:
+                self.filter(pk=summary.pk).update(
+                    visit_count=models.F("visit_count") + 1,
+                    user_count=models.F("user_count") + is_new_user,
+                )
+
+
+class UserVisitDailySummary(models.Model):
+    """
+    Daily visit and unique user counts, overall and by browser / device / OS.
+
+    Reporting on the raw UserVisit table gets slower as it grows; these
+    rows are maintained by the `update_user_visit_summary` management
+    command (and optionally incremented as visits are recorded) so that
+    dashboards only need to read a handful of rows per day.
+
+    The row with dimension "all" holds the daily active users (DAU) count.
+
+    """
+
+    class Dimension(models.TextChoices):
+        ALL = "all", _lazy("All visits")
+        BROWSER = "browser", _lazy("Browser")
+        DEVICE = "device", _lazy("Device type")
+        OS = "os", _lazy("Operating System")
+
+    BREAKDOWNS = ("browser", "device", "os")
+
+    date = models.DateField()
+    dimension = models.CharField(max_length=10, choices=Dimension.choices)
+    value = models.CharField(
+        max_length=200,
+        blank=True,
+        default="",
+        help_text=_lazy("The browser / device / OS (blank for 'all')"),
+    )
+    visit_count = models.PositiveIntegerField(default=0)
+    user_count = models.PositiveIntegerField(
+        default=0, help_text=_lazy("Number of distinct users")
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = UserVisitDailySummaryManager()
+
+    class Meta:
+        get_latest_by = "date"
+        verbose_name_plural = "User visit daily summaries"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["date", "dimension", "value"],
+                name="user_visit_summary_unique_row",
+            )
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.date} {self.dimension} {self.value}".strip()
@@ -0,0 +1,315 @@
+"""
+Monthly range partitioning of the UserVisit table (PostgreSQL only).
+
+The table is partitioned on visit_date (the denormalised date of the
+timestamp) rather than timestamp itself, because PostgreSQL requires every
+unique constraint on a partitioned table to include the partition key. The
+visit hash already includes the date, so a unique (hash, visit_date)
+constraint rejects exactly the same duplicates as the unique hash - the
+"check" and "upsert" recording strategies work unchanged, and each dedup
+lookup only touches the partition for the day of the visit.
+
+An existing table is converted in place: it is renamed and attached as a
+single "legacy" partition holding every visit before the cutover date, so
+no rows are copied. Monthly partitions are created from the cutover on, and
+expired partitions (the legacy partition included, once its newest visit
+has expired) are detached or dropped - a metadata operation rather than a
+mass DELETE. A DEFAULT partition catches visits for months that have no
+partition yet (e.g. if the command has not run), and its rows are moved
+when their month's partition is created. See the `partition_user_visits`
+management command.
+
+"""
+
+from __future__ import annotations
+
+import datetime
+import re
+from typing import Any, List, NamedTuple, Optional
+
+from .models import UserVisit
+
+# name suffix of the original table, once attached as a partition
+LEGACY_SUFFIX = "_legacy"
+
+# name suffix of the DEFAULT partition
+DEFAULT_SUFFIX = "_default"
+
+PARTITION_BOUND = re.compile(r"FROM \((?P<start>[^)]+)\) TO \((?P<end>[^)]+)\)")
+
+
+class Partition(NamedTuple):
+    """A partition and its range of visit dates - [start, end)."""
+
+    name: str
+    start: Optional[datetime.date]
+    end: Optional[datetime.date]
+
+
+def add_months(date: datetime.date, months: int) -> datetime.date:
+    """Return the first day of the month `months` after that of date."""
+    month = date.year * 12 + date.month - 1 + months
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+
+def table_name() -> str:
+    return UserVisit._meta.db_table
+
+
+def legacy_name() -> str:
+    """Return the name of the original table, once converted."""
+    return f"{table_name()}{LEGACY_SUFFIX}"
+
+
+def default_name() -> str:
+    """Return the name of the DEFAULT partition."""
+    return f"{table_name()}{DEFAULT_SUFFIX}"
+
+
+def partition_name(month: datetime.date) -> str:
+    """Return the name of the partition for a month."""
+    return f"{table_name()}_p{month:%Y_%m}"
+
+
+def parse_bound_value(value: str) -> Optional[datetime.date]:
+    value = value.strip().strip("'")
+    if value in ("MINVALUE", "MAXVALUE"):
+        return None
+    return datetime.date.fromisoformat(value)
+
+
+def parse_partition(name: str, bound: str) -> Partition:
+    """Return a Partition from its name and pg_get_expr(relpartbound)."""
+    match = PARTITION_BOUND.search(bound)
+    if not match:
+        # the DEFAULT partition - has no range, and never expires
+        return Partition(name, None, None)
+    return Partition(
+        name,
+        parse_bound_value(match.group("start")),
+        parse_bound_value(match.group("end")),
+    )
+
+
+def is_partitioned(connection: Any) -> bool:
+    """Return True if the UserVisit table is partitioned."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass",
+            [table_name()],
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions(connection: Any) -> List[Partition]:
+    """Return the partitions of the UserVisit table, oldest (DEFAULT last)."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+            "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass",
+            [table_name()],
+        )
+        partitions = [parse_partition(name, bound) for name, bound in cursor]
+    return sorted(
+        partitions,
+        key=lambda p: (
+            p.start is None and p.end is None,
+            p.start or datetime.date.min,
+            p.name,
+        ),
+    )
+
+
+def has_default(partitions: List[Partition]) -> bool:
+    """Return True if there is a DEFAULT partition (one with no range)."""
+    return any(p.start is None and p.end is None for p in partitions)
+
+
+def has_default_rows(connection: Any, month: datetime.date) -> bool:
+    """Return True if the DEFAULT partition holds visits for the month."""
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT 1 FROM {qn(default_name())} "  # noqa: S608
+            "WHERE visit_date >= %s AND visit_date < %s LIMIT 1",
+            [month, add_months(month, 1)],
+        )
+        return cursor.fetchone() is not None
+
+
+def months_to_create(
+    partitions: List[Partition], today: datetime.date, months: int
+) -> List[datetime.date]:
+    """Return the months from today's on (for months more) with no partition."""
+
+    def covered(month: datetime.date) -> bool:
+        return any(
+            (p.start is None or p.start <= month) and (p.end is None or month < p.end)
+            for p in partitions
+            if p.start or p.end
+        )
+
+    upcoming = [add_months(today, i) for i in range(months + 1)]
+    return [month for month in upcoming if not covered(month)]
+
+
+def expired_partitions(
+    partitions: List[Partition], cutoff: datetime.date
+) -> List[Partition]:
+    """Return the partitions holding only visits before the cutoff date."""
+    return [p for p in partitions if p.end is not None and p.end <= cutoff]
+
+
+def create_partition_sql(connection: Any, month: datetime.date) -> str:
+    qn = connection.ops.quote_name
+    return (
+        f"CREATE TABLE IF NOT EXISTS {qn(partition_name(month))} "
+        f"PARTITION OF {qn(table_name())} FOR VALUES "
+        f"FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+
+
+def create_default_partition_sql(connection: Any) -> str:
+    qn = connection.ops.quote_name
+    return (
+        f"CREATE TABLE IF NOT EXISTS {qn(default_name())} "
+        f"PARTITION OF {qn(table_name())} DEFAULT"
+    )
+
+
+def move_from_default_sql(connection: Any, month: datetime.date) -> List[str]:
+    """
+    Return the statements that create a month's partition from the DEFAULT.
+
+    A partition cannot be created while the DEFAULT partition holds rows in
+    its range, so the DEFAULT partition is detached while they are moved.
+    Run in a single transaction - recording visits waits for it to commit.
+
+    """
+    qn = connection.ops.quote_name
+    table, default = table_name(), default_name()
+    in_month = (
+        f"visit_date >= '{month.isoformat()}' "
+        f"AND visit_date < '{add_months(month, 1).isoformat()}'"
+    )
+    return [
+        detach_partition_sql(connection, default),
+        create_partition_sql(connection, month),
+        f"INSERT INTO {qn(partition_name(month))} "  # noqa: S608
+        f"SELECT * FROM {qn(default)} WHERE {in_month}",
+        f"DELETE FROM {qn(default)} WHERE {in_month}",  # noqa: S608
+        f"ALTER TABLE {qn(table)} ATTACH PARTITION {qn(default)} DEFAULT",
+    ]
+
+
+def detach_partition_sql(connection: Any, name: str) -> str:
+    qn = connection.ops.quote_name
+    return f"ALTER TABLE {qn(table_name())} DETACH PARTITION {qn(name)}"
+
+
+def drop_partition_sql(connection: Any, name: str) -> str:
+    return f"DROP TABLE {connection.ops.quote_name(name)}"
+
+
+def unique_columns() -> List[List[str]]:
+    """Return the primary key / unique columns, each with the partition key."""
+    meta = UserVisit._meta
+    return [
+        [field.column, "visit_date"]
+        for field in meta.concrete_fields
+        if field.primary_key or field.unique
+    ]
+
+
+def prepare_sql(connection: Any, cutover: datetime.date) -> List[str]:
+    """
+    Return the statements that prepare the table for conversion.
+
+    These run outside a transaction without blocking writes (indexes are
+    built CONCURRENTLY, and the range constraint is validated separately
+    from being added), so that the conversion itself only needs locks for
+    metadata changes.
+
+    """
+    qn = connection.ops.quote_name
+    table = table_name()
+    check = f"{table}_partition_check"
+    statements = [
+        f"ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(check)} CHECK ("
+        f"visit_date IS NOT NULL AND visit_date < '{cutover.isoformat()}'"
+        ") NOT VALID",
+        f"ALTER TABLE {qn(table)} VALIDATE CONSTRAINT {qn(check)}",
+        # proven by the constraint, so no scan
+        f"ALTER TABLE {qn(table)} ALTER COLUMN visit_date SET NOT NULL",
+    ]
+    # matching indexes are used when the table is attached as a partition
+    for columns in unique_columns():
+        name = f"{table}_{columns[0]}{LEGACY_SUFFIX}_uniq"
+        statements.append(
+            f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {qn(name)} "
+            f"ON {qn(table)} ({', '.join(qn(c) for c in columns)})"
+        )
+    return statements
+
+
+def convert_sql(connection: Any, cutover: datetime.date) -> List[str]:
+    """
+    Return the statements that convert the table to a partitioned table.
+
+    The original table is renamed (along with its named indexes) and
+    attached as the legacy partition for visits before the cutover date.
+    Run in a single transaction, after the prepare_sql statements.
+
+    """
+    qn = connection.ops.quote_name
+    meta = UserVisit._meta
+    table = table_name()
+    legacy = legacy_name()
+    sequence = f"{table}_partitioned_id_seq"
+    statements = [f"ALTER TABLE {qn(table)} RENAME TO {qn(legacy)}"]
+    statements += [
+        f"ALTER INDEX {qn(index.name)} RENAME TO {qn(index.name + LEGACY_SUFFIX)}"
+        for index in meta.indexes
+    ]
+    statements += [
+        # replaced by the (id, visit_date) index created by prepare_sql
+        f"ALTER TABLE {qn(legacy)} DROP CONSTRAINT {qn(f'{table}_pkey')}",
+        # partitions may not have identity columns - ids come from a sequence
+        # owned by the partitioned table instead
+        f"ALTER TABLE {qn(legacy)} ALTER COLUMN id DROP IDENTITY IF EXISTS",
+        f"CREATE TABLE {qn(table)} (LIKE {qn(legacy)} INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (visit_date)",
+        f"CREATE SEQUENCE {qn(sequence)} OWNED BY {qn(table)}.id",
+        f"SELECT setval('{sequence}', "  # noqa: S608
+        f"COALESCE((SELECT MAX(id) FROM {qn(legacy)}), 0) + 1, false)",
+        f"ALTER TABLE {qn(table)} ALTER COLUMN id "
+        f"SET DEFAULT nextval('{sequence}')",
+    ]
+    for columns in unique_columns():
+        constraint = "PRIMARY KEY" if columns[0] == meta.pk.column else "UNIQUE"
+        statements.append(
+            f"ALTER TABLE {qn(table)} ADD CONSTRAINT "
+            f"{qn(f'{table}_{columns[0]}_partitioned_uniq')} "
+            f"{constraint} ({', '.join(qn(c) for c in columns)})"
+        )
+    schema_editor = connection.schema_editor()
+    statements += [
+        str(index.create_sql(UserVisit, schema_editor)) for index in meta.indexes
+    ]
+    for field in meta.concrete_fields:
+        if field.remote_field is None:
+            continue
+        remote = field.target_field
+        statements.append(
+            f"ALTER TABLE {qn(table)} ADD CONSTRAINT "
+            f"{qn(f'{table}_{field.column}_partitioned_fk')} "
+            f"FOREIGN KEY ({qn(field.column)}) "
+            f"REFERENCES {qn(remote.model._meta.db_table)} ({qn(remote.column)}) "
+            "DEFERRABLE INITIALLY DEFERRED"
+        )
+    statements.append(
+        f"ALTER TABLE {qn(table)} ATTACH PARTITION {qn(legacy)} "
+        f"FOR VALUES FROM (MINVALUE) TO ('{cutover.isoformat()}')"
+    )
+    return statements
@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import re
+from typing import Iterable, Optional, Pattern
+
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpRequest
+
+
+class ExclusionRules:
+    """
+    Path and method rules for requests that are never recorded.
+
+    Paths are matched against `request.path_info` - entries starting with
+    "^" are regular expressions, anything else is a path prefix. All rules
+    are compiled once, so that checking a request is a set lookup, a
+    single `str.startswith` and (only if there are any regexes) a single
+    regex match.
+
+    """
+
+    def __init__(self, paths: Iterable[str] = (), methods: Iterable[str] = ()) -> None:
+        paths = list(paths)
+        self.prefixes = tuple(p for p in paths if not p.startswith("^"))
+        self.methods = frozenset(m.upper() for m in methods)
+        patterns = [p for p in paths if p.startswith("^")]
+        self.pattern: Optional[Pattern[str]] = None
+        if patterns:
+            try:
+                self.pattern = re.compile("|".join(f"(?:{p})" for p in patterns))
+            except re.error as ex:
+                raise ImproperlyConfigured(f"Invalid USER_VISIT_EXCLUDE_PATHS: {ex}")
+
+    def __bool__(self) -> bool:
+        return bool(self.prefixes or self.methods or self.pattern)
+
+    def excludes(self, request: HttpRequest) -> bool:
+        """Return True if the request matches any of the rules."""
+        if request.method in self.methods:
+            return True
+        if self.prefixes and request.path_info.startswith(self.prefixes):
+            return True
+        return bool(self.pattern and self.pattern.match(request.path_info))
@@ -1,5 +1,5 @@
 from os import getenv
-from typing import Any, Callable
+from typing import Any, Callable, List, Optional, Union
 
 from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
@@ -15,15 +15,103 @@ RECORDING_DISABLED = _env_or_setting(
 )
 
 
+# Alias of a Django cache (see settings.CACHES) used to share the set of
+# visit hashes already recorded today across all worker processes and
+# hosts. Only the first request cluster-wide for a given hash goes to the
+# database. If the cache cannot be reached the middleware falls back to
+# checking the database. Disabled (None) by default.
+DEDUP_CACHE: Optional[str] = _env_or_setting("USER_VISIT_DEDUP_CACHE", None)
+
+
+# Maximum number of visit hashes each worker process remembers as already
+# recorded today. Requests whose hash is in this cache skip the database
+# check altogether. Set to 0 to disable the cache.
+SEEN_HASH_CACHE_SIZE: int = _env_or_setting(
+    "USER_VISIT_SEEN_HASH_CACHE_SIZE", 10000, int
+)
+
+
+# How new visits are written to the database:
+#   "sync" - saved inline, before the view is called (default)
+#   "deferred" - handed to a background thread after the response has been
+#   generated, so that the INSERT is off the request path. Visits are
+#   dropped (and counted) if the queue of pending writes is full.
+#   "batch" - as "deferred", but visits are collected and written using a
+#   single multi-row INSERT (ignoring duplicate hashes) every
+#   WRITE_BATCH_SIZE visits or WRITE_BATCH_INTERVAL milliseconds.
+WRITE_MODE: str = _env_or_setting("USER_VISIT_WRITE_MODE", "sync").lower()
+
+# Maximum number of visits waiting to be written in "deferred" mode.
+WRITE_QUEUE_SIZE: int = _env_or_setting("USER_VISIT_WRITE_QUEUE_SIZE", 1000, int)
+
+# Maximum number of visits written per INSERT in "batch" mode.
+WRITE_BATCH_SIZE: int = _env_or_setting("USER_VISIT_WRITE_BATCH_SIZE", 100, int)
+
+# Maximum time (ms) a visit waits for its batch to fill in "batch" mode.
+WRITE_BATCH_INTERVAL: int = _env_or_setting(
+    "USER_VISIT_WRITE_BATCH_INTERVAL", 1000, int
+)
+
+
+# If True, the UserVisitDailySummary rows for the day are incremented as
+# each new visit is saved, so that they are always up to date (at the cost
+# of a few extra queries per new visit). Not supported in "batch" write
+# mode. Otherwise the rows are only updated by the
+# `update_user_visit_summary` management command.
+SUMMARY_ON_WRITE: bool = _env_or_setting(
+    "USER_VISIT_SUMMARY_ON_WRITE", False, lambda x: bool(x)
+)
+
+
+# Default number of days of UserVisit records kept by the
+# `prune_user_visits` management command. None (default) means that the
+# command must be given an explicit --days value.
+RETENTION_DAYS: Optional[int] = _env_or_setting(
+    "USER_VISIT_RETENTION_DAYS", None, lambda x: int(x) if x else None
+)
+
+
 # function that takes a request object and returns a dictionary of info
 # that will be stored against the request. By default returns empty
 # dict. canonical example of a use case for this is extracting GeoIP
-# info.
-REQUEST_CONTEXT_EXTRACTOR: Callable[[HttpRequest], dict] = getattr(
+# info. May also be the dotted path to the function, e.g.
+# "user_visit.geoip.geoip_context". Only called for visits that are about
+# to be written.
+REQUEST_CONTEXT_EXTRACTOR: Union[str, Callable[[HttpRequest], dict]] = getattr(
     settings, "USER_VISIT_REQUEST_CONTEXT_EXTRACTOR", lambda r: {}
 )
 
 
+# When to extract the denormalised browser, device and os fields from the
+# User-Agent string:
+#   "eager" - when the visit is built, on every request (default)
+#   "lazy" - only once the visit is known to be new, just before it is
+#   written (on the background thread in "deferred" / "batch" write modes)
+#   "offline" - never on the request path; run the management command
+#   `update_user_visit_user_agent_data` to fill in the blank fields later
+USER_AGENT_PARSING: str = _env_or_setting(
+    "USER_VISIT_USER_AGENT_PARSING", "eager"
+).lower()
+
+
+# Maximum number of distinct User-Agent strings whose parsed values are
+# cached (per process).
+USER_AGENT_CACHE_SIZE: int = _env_or_setting(
+    "USER_VISIT_USER_AGENT_CACHE_SIZE", 1024, int
+)
+
+
+# Store the browser, device and OS of each distinct User-Agent once, in the
+# UserAgent table, and link new visits to it (UserVisit.agent) instead of
+# filling in the denormalised browser / device / os fields of every row.
+# The UserAgent is looked up (or created) when the visit is written, once
+# per process per User-Agent (see USER_VISIT_USER_AGENT_CACHE_SIZE). Run
+# `update_user_visit_user_agent_data --link` to link existing visits.
+USER_AGENT_TABLE: bool = _env_or_setting(
+    "USER_VISIT_USER_AGENT_TABLE", False, lambda x: bool(x)
+)
+
+
 # Can be used to override the JSON encoder used for the context JSON
 # fields
 REQUEST_CONTEXT_ENCODER = getattr(
@@ -40,7 +128,101 @@ RECORDING_BYPASS = getattr(settings, "USER_VISIT_RECORDING_BYPASS", lambda r: Fa
 
 # The log level to use when logging duplicate hashes. This is WARNING by
 # default, but if it's noisy you can turn this down by setting this
-# value. Must be one of "debug", "info", "warning", "error"
+# value. Must be one of "debug", "info", "warning", "error". (The expected
+# conflicts of the "upsert" recording strategy are always logged at DEBUG.)
 DUPLICATE_LOG_LEVEL: str = getattr(
     settings, "USER_VISIT_DUPLICATE_LOG_LEVEL", "warning"
 ).lower()
+
+
+# Register the UserVisit admin tuned for very large tables: an estimated
+# row count (no COUNT(*) over the whole table), date hierarchy navigation
+# on the indexed visit_date field and prefix / exact match searches that
+# can use indexes. Disabled by default.
+ADMIN_SCALABLE: bool = _env_or_setting(
+    "USER_VISIT_ADMIN_SCALABLE", False, lambda x: bool(x)
+)
+
+
+# Dotted path to the MetricsBackend class that the middleware reports
+# counters and timings to, e.g. "user_visit.metrics.StatsdMetrics". None
+# (default) disables metrics. USER_VISIT_METRICS_OPTIONS is passed to the
+# class as keyword arguments, e.g. {"host": "statsd", "port": 8125}.
+METRICS_BACKEND: Optional[str] = getattr(settings, "USER_VISIT_METRICS_BACKEND", None)
+METRICS_OPTIONS: dict = getattr(settings, "USER_VISIT_METRICS_OPTIONS", {})
+
+
+# Requests that are never recorded, checked before anything else (including
+# loading the user). EXCLUDE_PATHS entries are path prefixes, e.g.
+# "/api/poll/", or regular expressions if they start with "^", e.g.
+# r"^/api/v\d+/status/". EXCLUDE_METHODS is a list of HTTP methods, e.g.
+# ["OPTIONS", "HEAD"].
+EXCLUDE_PATHS: List[str] = getattr(settings, "USER_VISIT_EXCLUDE_PATHS", [])
+EXCLUDE_METHODS: List[str] = getattr(settings, "USER_VISIT_EXCLUDE_METHODS", [])
+
+
+# Number of seconds after a user's session has been checked during which
+# further requests from the same session skip the check altogether (no
+# hashing, no cache or database lookups). Changes of IP address or device
+# within the window are not recorded until it expires. The first request
+# of each day is always checked. Set to 0 (default) to disable.
+RECHECK_INTERVAL: int = _env_or_setting("USER_VISIT_RECHECK_INTERVAL", 0, int)
+
+
+# Maximum number of sessions each worker process remembers for the recheck
+# interval (independent of USER_VISIT_SEEN_HASH_CACHE_SIZE).
+RECHECK_CACHE_SIZE: int = _env_or_setting("USER_VISIT_RECHECK_CACHE_SIZE", 10000, int)
+
+
+# How new visits are checked and written in the "sync" and "deferred"
+# write modes:
+#   "check" - query for an existing visit with the same hash, then INSERT
+#   (in a savepoint, handling the IntegrityError if another request won
+#   the race) (default)
+#   "upsert" - a single INSERT ... ON CONFLICT DO NOTHING with no pre-check
+#   (PostgreSQL and SQLite; other databases fall back to "check" style
+#   saves without the pre-check)
+RECORDING_STRATEGY: str = _env_or_setting(
+    "USER_VISIT_RECORDING_STRATEGY", "check"
+).lower()
+
+
+# Store the hash of the visit recorded for the current session (i.e. for
+# today, this IP address and device) in the session itself, so that later
+# requests in the session skip the seen cache and database checks. The
+# session is only modified when the hash changes - at most once per day
+# per device, IP address or session - and with signed cookie sessions no
+# server-side state is needed. Disabled by default.
+SESSION_MARKER: bool = _env_or_setting(
+    "USER_VISIT_SESSION_MARKER", False, lambda x: bool(x)
+)
+
+
+# GeoIP context extractor (user_visit.geoip.geoip_context) - path to a
+# MaxMind City database, the number of IP addresses whose results are
+# cached (per process), the time budget for a lookup in milliseconds, and
+# the number of seconds for which lookups are skipped after one has gone
+# over budget or failed.
+GEOIP_DATABASE: Optional[str] = _env_or_setting("USER_VISIT_GEOIP_DATABASE", None)
+GEOIP_CACHE_SIZE: int = _env_or_setting("USER_VISIT_GEOIP_CACHE_SIZE", 4096, int)
+GEOIP_TIME_BUDGET: float = _env_or_setting("USER_VISIT_GEOIP_TIME_BUDGET", 5, float)
+GEOIP_COOLDOWN: float = _env_or_setting("USER_VISIT_GEOIP_COOLDOWN", 60, float)
+
+
+# Suspicious activity detection (user_visit.detection) - the sliding window
+# in seconds, the number of distinct IP address / User-Agent combinations
+# a user may have within the window, and the maximum plausible speed (in
+# km/h) between the GeoIP locations of consecutive visits (0 disables
+# either check). DETECTION_ON_RECORD checks each visit as it is recorded,
+# in the recording process, as well as / instead of running the
+# detect_suspicious_visits command.
+DETECTION_WINDOW: int = _env_or_setting("USER_VISIT_DETECTION_WINDOW", 3600, int)
+DETECTION_MAX_COMBINATIONS: int = _env_or_setting(
+    "USER_VISIT_DETECTION_MAX_COMBINATIONS", 5, int
+)
+DETECTION_MAX_SPEED: float = _env_or_setting(
+    "USER_VISIT_DETECTION_MAX_SPEED", 1000, float
+)
+DETECTION_ON_RECORD: bool = _env_or_setting(
+    "USER_VISIT_DETECTION_ON_RECORD", False, lambda x: bool(x)
+)
@@ -0,0 +1,22 @@
+from django.dispatch import Signal
+
+# Sent when a new UserVisit has been written to the database.
+# Args: user_visit
+visit_recorded = Signal()
+
+# Sent when a visit was not written because it had already been recorded
+# (found in the shared dedup cache or database, or an IntegrityError on
+# insert). Args: user_visit, source ("cache", "database" or "insert")
+visit_duplicate = Signal()
+
+# Sent when recording is skipped by USER_VISIT_RECORDING_BYPASS.
+# Args: request
+visit_bypassed = Signal()
+
+# Sent when writing a visit raises an unexpected error. Args: user_visit,
+# exception
+visit_error = Signal()
+
+# Sent for each suspicious pattern found by user_visit.detection.
+# Args: alert (a detection.Alert - kind, user_id, user_visit, details)
+suspicious_activity = Signal()
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from django.db import close_old_connections
+
+from .models import UserVisit
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWriter:
+    """
+    Persist UserVisit objects on a worker thread, off the request path.
+
+    Visits are pushed onto a bounded queue and handed to `handler` one at a
+    time by a single daemon thread. If the queue is full the visit is dropped
+    (and counted) rather than blocking the request - recording a visit is
+    never worth slowing down the response.
+
+    """
+
+    def __init__(
+        self, handler: Callable[[UserVisit], None], max_queue_size: int
+    ) -> None:
+        self.handler = handler
+        self.queue: queue.Queue[UserVisit] = queue.Queue(maxsize=max_queue_size)
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            if self._thread is None:
+                # give queued visits a chance to be written on shutdown
+                atexit.register(self.flush, timeout=5)
+            self._thread = threading.Thread(
+                target=self._run, name="user-visit-writer", daemon=True
+            )
+            self._thread.start()
+
+    def _count(self, attr: str) -> None:
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def submit(self, user_visit: UserVisit) -> bool:
+        """Queue visit for writing, returning False if it was dropped."""
+        if not (self._thread and self._thread.is_alive()):
+            self._start()
+        try:
+            self.queue.put_nowait(user_visit)
+        except queue.Full:
+            self._count("dropped")
+            logger.warning(
+                "UserVisit write queue is full, dropping visit (hash='%s')",
+                user_visit.hash,
+            )
+            return False
+        self._count("submitted")
+        return True
+
+    def _run(self) -> None:
+        while True:
+            if self.queue.empty():
+                # don't hold on to broken / expired connections while idle
+                close_old_connections()
+            user_visit = self.queue.get()
+            try:
+                self.handler(user_visit)
+            except Exception:
+                self._count("errors")
+                logger.exception(
+                    "Error writing user visit (hash='%s')", user_visit.hash
+                )
+            else:
+                self._count("written")
+            finally:
+                self.queue.task_done()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait for queued visits to be written, returning False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        """Return queue depth and submitted / written / dropped / error counts."""
+        return {
+            "queued": self.queue.qsize(),
+            "submitted": self.submitted,
+            "written": self.written,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+
+class BatchWriter(BackgroundWriter):
+    """
+    Persist UserVisit objects in batches, off the request path.
+
+    The worker thread collects queued visits until it has `batch_size` of
+    them, or `flush_interval` seconds have passed since the first one
+    arrived, and then passes the whole batch to `handler` - typically a
+    single multi-row INSERT.
+
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[UserVisit]], None],
+        max_queue_size: int,
+        batch_size: int,
+        flush_interval: float,
+    ) -> None:
+        super().__init__(lambda uv: handler([uv]), max_queue_size)
+        self.batch_handler = handler
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        self.last_flush_size = 0
+        self.max_flush_size = 0
+        self.last_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.total_flush_time = 0.0
+
+    def _next_batch(self) -> List[UserVisit]:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch: List[UserVisit]) -> None:
+        start = time.monotonic()
+        try:
+            self.batch_handler(batch)
+        except Exception:
+            with self._lock:
+                self.errors += len(batch)
+            logger.exception("Error writing batch of %i user visits", len(batch))
+        else:
+            with self._lock:
+                self.written += len(batch)
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self.flushes += 1
+                self.last_flush_size = len(batch)
+                self.max_flush_size = max(self.max_flush_size, len(batch))
+                self.last_flush_time = elapsed
+                self.max_flush_time = max(self.max_flush_time, elapsed)
+                self.total_flush_time += elapsed
+            for _ in batch:
+                self.queue.task_done()
+
+    def _run(self) -> None:
+        while True:
+            if self.queue.empty():
+                # don't hold on to broken / expired connections while idle
+                close_old_connections()
+            self._write_batch(self._next_batch())
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue counters plus flush size and latency metrics."""
+        stats: Dict[str, Any] = dict(super().stats())
+        stats.update(
+            flushes=self.flushes,
+            last_flush_size=self.last_flush_size,
+            max_flush_size=self.max_flush_size,
+            avg_flush_size=(
+                (self.written + self.errors) / self.flushes if self.flushes else 0.0
+            ),
+            last_flush_time=self.last_flush_time,
+            max_flush_time=self.max_flush_time,
+            avg_flush_time=(
+                self.total_flush_time / self.flushes if self.flushes else 0.0
+            ),
+        )
+        return stats